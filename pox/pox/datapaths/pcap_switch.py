@@ -17,15 +17,29 @@ Software switch with PCap ports
 
 Example:
 ./pox.py --no-openflow datapaths.pcap_switch --address=localhost
+
+With --workers=N, packets are forwarded by N worker processes instead of
+by the POX process itself.  The interfaces are divided among the workers,
+each of which captures on its own interfaces and has its own copy of the
+flow table.  The POX process still talks to the controller, keeps the
+copies in sync, and handles the packets which miss the table.
 """
 
 from pox.core import core
 from pox.datapaths import do_launch
 from pox.datapaths.switch import SoftwareSwitchBase, OFConnection
+from pox.openflow.flow_table import TableEntry
 from pox.datapaths.switch import ExpireMixin
 import pox.lib.pxpcap as pxpcap
 from Queue import Queue
 from threading import Thread
+from collections import deque
+import multiprocessing
+import time
+import mmap
+import struct
+import os
+import select
 import pox.openflow.libopenflow_01 as of
 from pox.lib.packet import ethernet
 import logging
@@ -34,6 +48,8 @@ log = core.getLogger()
 
 DEFAULT_CTL_PORT = 7791
 
+DEFAULT_RING_SLOTS = 1024
+
 _switches = {}
 
 def _do_ctl (event):
@@ -85,6 +101,7 @@ def _do_ctl2 (event):
         s.append("Switch %s" % (sw.name,))
         for no,p in sw.ports.iteritems():
           s.append(" %3s %s" % (no, p.name))
+        s.append(" buffers: %s" % (sw.packet_buffer,))
       return "\n".join(s)
 
     else:
@@ -96,8 +113,8 @@ def _do_ctl2 (event):
 
 
 def launch (address = '127.0.0.1', port = 6633, max_retry_delay = 16,
-    dpid = None, ports = '', extra = None, ctl_port = None,
-    __INSTANCE__ = None):
+    dpid = None, ports = '', extra = None, ctl_port = None, workers = 0,
+    ring_slots = DEFAULT_RING_SLOTS, __INSTANCE__ = None):
   """
   Launches a switch
   """
@@ -121,12 +138,108 @@ def launch (address = '127.0.0.1', port = 6633, max_retry_delay = 16,
     ports = [p for p in _ports.split(",") if p]
 
     sw = do_launch(PCapSwitch, address, port, max_retry_delay, dpid,
-                   ports=ports, extra_args=extra)
+                   ports=ports, workers=int(workers),
+                   ring_slots=int(ring_slots), extra_args=extra)
     _switches[sw.name] = sw
 
   core.addListenerByName("UpEvent", up)
 
 
+class FrameRing (object):
+  """
+  A single-producer/single-consumer ring of frames in shared memory
+
+  Frames are copied into preallocated slots of an anonymous mmap, each
+  with a length header.  The producer only ever writes the head index and
+  the consumer only ever writes the tail index, so no locking is needed
+  (this relies on stores not being reordered with each other, which holds
+  on the platforms POX runs on).  Since the mmap is shared, a ring created
+  before forking can be used between processes.
+
+  Frames bigger than slot_size (e.g., from GRO/TSO) are kept aside in a
+  deque, with a placeholder in their slot, so they still come out in the
+  order they went in.  The deque is local to the process, though, so
+  between processes only frames which fit can be passed.
+
+  The consumer drains everything available at once with get_all().  When
+  it wants to sleep, it calls set_waiting() and waits for the wakeup file
+  descriptor to become readable; the producer writes a byte to it for the
+  first frame after that.  The consumer should still wake up periodically,
+  since the flag and the head index can race.
+  """
+  _HEAD = 0
+  _TAIL = 8
+  _WAITING = 16
+  _HEADER_SIZE = 64 # So head and tail aren't on the same cache line
+  _OVERSIZE = 0xffff # Length header of a slot standing in for a big frame
+
+  def __init__ (self, slots = DEFAULT_RING_SLOTS, slot_size = 2048,
+                wakeup = None):
+    assert slot_size < self._OVERSIZE
+    self.slots = slots
+    self.slot_size = slot_size
+    self.wakeup = wakeup
+    self._stride = slot_size + 2
+    self._mem = mmap.mmap(-1, self._HEADER_SIZE + slots * self._stride)
+    self.dropped = 0 # Only meaningful on the producer side
+    self._oversize = deque() # Frames too big for their slots
+
+  def __len__ (self):
+    mem = self._mem
+    return (struct.unpack_from("Q", mem, self._HEAD)[0]
+            - struct.unpack_from("Q", mem, self._TAIL)[0])
+
+  def put (self, data):
+    """
+    Adds a frame, returning False if it was dropped (because it's full)
+    """
+    mem = self._mem
+    head = struct.unpack_from("Q", mem, self._HEAD)[0]
+    tail = struct.unpack_from("Q", mem, self._TAIL)[0]
+    if head - tail >= self.slots:
+      self.dropped += 1
+      return False
+    offset = self._HEADER_SIZE + (head % self.slots) * self._stride
+    size = len(data)
+    if size > self.slot_size:
+      self._oversize.append(data)
+      struct.pack_into("H", mem, offset, self._OVERSIZE)
+    else:
+      struct.pack_into("H", mem, offset, size)
+      mem[offset+2:offset+2+size] = data
+    struct.pack_into("Q", mem, self._HEAD, head + 1)
+    if mem[self._WAITING] != '\0':
+      mem[self._WAITING] = '\0'
+      if self.wakeup is not None:
+        os.write(self.wakeup, 'x')
+    return True
+
+  def get_all (self):
+    """
+    Removes and returns all available frames
+    """
+    mem = self._mem
+    head = struct.unpack_from("Q", mem, self._HEAD)[0]
+    tail = struct.unpack_from("Q", mem, self._TAIL)[0]
+    if head == tail: return []
+    frames = []
+    slots = self.slots
+    stride = self._stride
+    base = self._HEADER_SIZE + 2
+    for i in xrange(tail, head):
+      offset = base + (i % slots) * stride
+      size = struct.unpack_from("H", mem, offset - 2)[0]
+      if size == self._OVERSIZE:
+        frames.append(self._oversize.popleft())
+      else:
+        frames.append(mem[offset:offset+size])
+    struct.pack_into("Q", mem, self._TAIL, head)
+    return frames
+
+  def set_waiting (self):
+    self._mem[self._WAITING] = '\1'
+
+
 class PCapSwitch (ExpireMixin, SoftwareSwitchBase):
   # Default level for loggers of this class
   default_log_level = logging.INFO
@@ -138,11 +251,24 @@ class PCapSwitch (ExpireMixin, SoftwareSwitchBase):
     Additional options over superclass:
     log_level (default to default_log_level) is level for this instance
     ports is a list of interface names
+    workers is the number of forwarding worker processes (0 for none)
+    ring_slots is the size of each interface's FrameRing (0 to use a Queue)
     """
     log_level = kw.pop('log_level', self.default_log_level)
+    workers = kw.pop('workers', 0)
+    self.ring_slots = kw.pop('ring_slots', DEFAULT_RING_SLOTS)
 
     self.q = Queue()
-    self.t = Thread(target=self._consumer_threadproc)
+    self._rings = {} # port_no -> FrameRing
+    if workers:
+      # The workers capture, so there's nothing for us to consume
+      self.ring_slots = 0
+      self.t = None
+    elif self.ring_slots:
+      self._ring_wakeup = os.pipe()
+      self.t = Thread(target=self._ring_consumer_threadproc)
+    else:
+      self.t = Thread(target=self._consumer_threadproc)
     core.addListeners(self)
 
     ports = kw.pop('ports', [])
@@ -159,15 +285,32 @@ class PCapSwitch (ExpireMixin, SoftwareSwitchBase):
 
     self.log.setLevel(log_level)
 
-    for px in self.px.itervalues():
-      px.start()
+    # Worker state (see _start_workers())
+    self._workers = []
+    self._worker_q = None
+    self._entry_ids = {} # TableEntry -> ID shared with workers
+    self._entries_by_id = {}
+    self._entry_actions = {} # TableEntry -> actions the workers have
+    self._next_entry_id = 1
+
+    if workers:
+      # Our pcap handles are only used for sending
+      self._start_workers(workers)
+    else:
+      for px in self.px.itervalues():
+        px.start()
 
-    self.t.start()
+    if self.t is not None:
+      self.t.start()
 
   def add_interface (self, name, port_no=-1, on_error=None, start=False):
     if on_error is None:
       on_error = log.error
 
+    if getattr(self, '_workers', None):
+      on_error("Can't add interfaces when using worker processes")
+      return
+
     devs = pxpcap.PCap.get_devices()
     if name not in devs:
       on_error("Device %s not available -- ignoring", name)
@@ -205,6 +348,10 @@ class PCapSwitch (ExpireMixin, SoftwareSwitchBase):
 
     self.add_port(phy)
 
+    if self.ring_slots:
+      self._rings[phy.port_no] = FrameRing(self.ring_slots,
+                                           wakeup=self._ring_wakeup[1])
+
     px = pxpcap.PCap(name, callback = self._pcap_rx, start = False)
     px.port_no = phy.port_no
     self.px[phy.port_no] = px
@@ -222,13 +369,23 @@ class PCapSwitch (ExpireMixin, SoftwareSwitchBase):
           return
       raise ValueError("No such interface")
 
+    if self._workers:
+      raise RuntimeError("Can't remove interfaces when using worker processes")
+
     px = self.px[name_or_num]
     px.stop()
     px.port_no = None
+    self._rings.pop(name_or_num, None)
     self.delete_port(name_or_num)
 
   def _handle_GoingDownEvent (self, event):
     self.q.put(None)
+    if self.ring_slots:
+      os.write(self._ring_wakeup[1], 'x')
+    for worker,ctl_q in self._workers:
+      ctl_q.put(None)
+    if self._worker_q is not None:
+      self._worker_q.put(None)
 
   def _consumer_threadproc (self):
     timeout = 3
@@ -244,8 +401,7 @@ class PCapSwitch (ExpireMixin, SoftwareSwitchBase):
       while True:
         self.q.task_done()
         port_no,data = data
-        data = ethernet(data)
-        batch.append((data,port_no))
+        batch.append((ethernet(data),port_no,data))
         try:
           data = self.q.get(block=False)
         except:
@@ -253,12 +409,51 @@ class PCapSwitch (ExpireMixin, SoftwareSwitchBase):
       core.callLater(self.rx_batch, batch)
 
   def rx_batch (self, batch):
-    for data,port_no in batch:
-      self.rx_packet(data, port_no)
+    self.rx_packets(batch)
+
+  def _ring_consumer_threadproc (self):
+    """
+    Drains the interfaces' FrameRings, passing batches to the POX thread
+    """
+    wakeup = self._ring_wakeup[0]
+    dropped = {} # port_no -> drops already accounted for
+    while core.running:
+      batch = []
+      drops = []
+      rings = self._rings.items()
+      for port_no,ring in rings:
+        for data in ring.get_all():
+          batch.append((ethernet(data),port_no,data))
+      for port_no,ring in rings:
+        count = ring.dropped - dropped.get(port_no, 0)
+        if count:
+          dropped[port_no] = ring.dropped
+          drops.append((port_no, count))
+      if batch or drops:
+        core.callLater(self._rx_ring_batch, batch, drops)
+        continue
+
+      for port_no,ring in rings:
+        ring.set_waiting()
+      if any(len(ring) for port_no,ring in rings): continue
+      if select.select([wakeup], [], [], 0.1)[0]:
+        os.read(wakeup, 4096)
+
+  def _rx_ring_batch (self, batch, drops):
+    for port_no,count in drops:
+      stats = self.port_stats.get(port_no)
+      if stats is not None:
+        stats.rx_dropped += count
+    if batch:
+      self.rx_batch(batch)
 
   def _pcap_rx (self, px, data, sec, usec, length):
     if px.port_no is None: return
-    self.q.put((px.port_no, data))
+    ring = self._rings.get(px.port_no)
+    if ring is not None:
+      ring.put(data)
+    else:
+      self.q.put((px.port_no, data))
 
   def _output_packet_physical (self, packet, port_no):
     """
@@ -268,4 +463,300 @@ class PCapSwitch (ExpireMixin, SoftwareSwitchBase):
     """
     px = self.px.get(port_no)
     if not px: return
-    px.inject(packet)
+    px.inject(self._packet_data(packet))
+
+  def _start_workers (self, count):
+    """
+    Starts forwarding worker processes, dividing the interfaces among them
+    """
+    ports = [p.pack() for p in self.ports.itervalues()]
+    devices = dict((no, px.device) for no,px in self.px.iteritems())
+    groups = [[] for _ in range(min(count, len(devices)))]
+    for i,port_no in enumerate(sorted(devices)):
+      groups[i % len(groups)].append(port_no)
+
+    self._worker_q = multiprocessing.Queue()
+    for group in groups:
+      ctl_q = multiprocessing.Queue()
+      worker = multiprocessing.Process(target=_worker_main,
+          name="%s-worker%s" % (self.name, len(self._workers)),
+          args=(self.dpid, ports, devices, group, self.miss_send_len,
+                ctl_q, self._worker_q))
+      worker.daemon = True
+      worker.start()
+      self._workers.append((worker, ctl_q))
+      self.log.debug("Worker %s forwarding for ports %s", worker.pid, group)
+
+    Thread(target=self._worker_threadproc).start()
+
+  def _send_to_workers (self, msg):
+    for worker,ctl_q in self._workers:
+      ctl_q.put(msg)
+
+  def _handle_FlowTableModification (self, event):
+    super(PCapSwitch,self)._handle_FlowTableModification(event)
+    if not self._workers: return
+    for entry in event.removed:
+      entry_id = self._entry_ids.pop(entry, None)
+      if entry_id is None: continue
+      del self._entries_by_id[entry_id]
+      del self._entry_actions[entry]
+      self._send_to_workers(('remove', entry_id))
+    for entry in event.added:
+      entry_id = self._next_entry_id
+      self._next_entry_id += 1
+      self._entry_ids[entry] = entry_id
+      self._entries_by_id[entry_id] = entry
+      self._entry_actions[entry] = entry.actions
+      self._send_to_workers(('add', entry_id, entry.to_flow_mod().pack()))
+
+  def _flow_mod_modify (self, flow_mod, connection, table, strict=False):
+    super(PCapSwitch,self)._flow_mod_modify(flow_mod, connection, table,
+                                            strict=strict)
+    if not self._workers: return
+    # Modifying replaces entries' actions without raising an event
+    for entry,actions in self._entry_actions.iteritems():
+      if entry.actions is not actions:
+        self._entry_actions[entry] = entry.actions
+        self._send_to_workers(('modify', self._entry_ids[entry],
+                               entry.to_flow_mod().pack()))
+
+  def _rx_port_mod (self, port_mod, connection):
+    super(PCapSwitch,self)._rx_port_mod(port_mod, connection)
+    if not self._workers: return
+    self._send_to_workers(('ports', [(p.port_no, p.config, p.state)
+                                     for p in self.ports.itervalues()]))
+
+  def _worker_threadproc (self):
+    """
+    Collects messages from the workers and passes them to the POX thread
+    """
+    q = self._worker_q
+    while core.running:
+      try:
+        msg = q.get(timeout=3)
+      except:
+        continue
+      if msg is None: break
+      batch = [msg]
+      while True:
+        try:
+          msg = q.get(block=False)
+        except:
+          break
+        if msg is None: return
+        batch.append(msg)
+      core.callLater(self._rx_worker_batch, batch)
+
+  def _rx_worker_batch (self, batch):
+    for msg in batch:
+      kind = msg[0]
+      if kind == 'miss':
+        # A packet which missed in a worker's table
+        in_port,data = msg[1:]
+        self._rx_worker_miss(ethernet(data), in_port, data)
+      elif kind == 'packet_in':
+        # Sent to the controller by an action
+        in_port,data,reason,data_length = msg[1:]
+        buffer_id = self._buffer_packet(ethernet(data), in_port)
+        self.send_packet_in(in_port, buffer_id, data, reason=reason,
+                            data_length=data_length)
+      elif kind == 'counters':
+        entries,ports,lookups,matched = msg[1:]
+        for entry_id,packets,byte_count,last_touched in entries:
+          entry = self._entries_by_id.get(entry_id)
+          if entry is None: continue # Removed since
+          entry.touch_packet(byte_count, now=last_touched,
+                             packet_count=packets)
+        for port_no,counts in ports:
+          stats = self.port_stats.get(port_no)
+          if stats is None: continue
+          stats.rx_packets += counts[0]
+          stats.rx_bytes += counts[1]
+          stats.tx_packets += counts[2]
+          stats.tx_bytes += counts[3]
+        self._lookup_count += lookups
+        self._matched_count += matched
+
+  def _rx_worker_miss (self, packet, in_port, packet_data):
+    """
+    Handles a packet which missed in a worker's table
+
+    The worker has already counted it, but our table may have changed
+    since, so it's looked up again.
+    """
+    port = self.ports.get(in_port)
+    if port is None: return
+    self._set_packet_data(packet, packet_data)
+    match = of.ofp_match.from_packet(packet, in_port, spec_frags = True)
+    entry = self._flow_cache.entry_for_match(self.table, match)
+    if entry is not None:
+      self._matched_count += 1
+      entry.touch_packet(len(packet))
+      self._compiled_actions_for(entry)(packet, in_port)
+    else:
+      self._rx_table_miss(packet, in_port, port, packet_data)
+
+
+def _worker_main (dpid, ports, devices, capture, miss_send_len, ctl_q, out_q):
+  """
+  Entry point for forwarding worker processes
+  """
+  phy_ports = []
+  for raw in ports:
+    p = of.ofp_phy_port()
+    p.unpack(raw)
+    phy_ports.append(p)
+  sw = _PCapWorkerSwitch(dpid=dpid, ports=phy_ports,
+                         miss_send_len=miss_send_len, out_q=out_q)
+  sw.run(devices, capture, ctl_q)
+
+
+class _PCapWorkerSwitch (SoftwareSwitchBase):
+  """
+  The switch a PCapSwitch forwarding worker process runs
+
+  It has no connection to the controller.  Its table is kept in sync by
+  the POX process, and anything which would go to the controller goes to
+  the POX process instead.  Counters are sent back periodically.
+  """
+  report_period = 1
+
+  def __init__ (self, out_q, **kw):
+    self._out_q = out_q
+    self.q = Queue()
+    self.px = {}
+    self._entries_by_id = {}
+    self._entry_ids = {}
+    self._reported = {} # TableEntry -> (packet_count, byte_count)
+    self._reported_ports = {} # port_no -> (rx_pkts, rx_bytes, tx_pkts, ...)
+    self._reported_lookups = (0, 0)
+    super(_PCapWorkerSwitch,self).__init__(**kw)
+
+  def run (self, devices, capture, ctl_q):
+    for port_no,name in devices.iteritems():
+      cb = self._pcap_rx if port_no in capture else None
+      px = pxpcap.PCap(name, callback = cb, start = False)
+      px.port_no = port_no
+      self.px[port_no] = px
+
+    t = Thread(target=self._ctl_threadproc, args=(ctl_q,))
+    t.daemon = True
+    t.start()
+    for port_no in capture:
+      self.px[port_no].start()
+
+    next_report = time.time() + self.report_period
+    while True:
+      try:
+        item = self.q.get(timeout=self.report_period)
+      except:
+        item = False
+      batch = []
+      while item is not False:
+        port_no,data = item
+        if port_no is None:
+          # Control message
+          if batch:
+            self.rx_packets(batch)
+            batch = []
+          if data is None:
+            for px in self.px.itervalues():
+              px.stop()
+            return
+          self._rx_ctl(data)
+        else:
+          batch.append((ethernet(data), port_no, data))
+        try:
+          item = self.q.get(block=False)
+        except:
+          item = False
+      if batch:
+        self.rx_packets(batch)
+
+      now = time.time()
+      if now >= next_report:
+        self._report()
+        next_report = now + self.report_period
+
+  def _ctl_threadproc (self, ctl_q):
+    while True:
+      msg = ctl_q.get()
+      self.q.put((None, msg))
+      if msg is None: break
+
+  def _pcap_rx (self, px, data, sec, usec, length):
+    if px.port_no is None: return
+    self.q.put((px.port_no, data))
+
+  def _rx_ctl (self, msg):
+    kind = msg[0]
+    if kind == 'add':
+      entry_id,raw = msg[1:]
+      entry = TableEntry.from_flow_mod(of.ofp_flow_mod.unpack_new(raw)[1])
+      self._entries_by_id[entry_id] = entry
+      self._entry_ids[entry] = entry_id
+      self._reported[entry] = (0, 0)
+      self.table.add_entry(entry)
+    elif kind == 'remove':
+      entry = self._entries_by_id.pop(msg[1], None)
+      if entry is None: return
+      del self._entry_ids[entry]
+      del self._reported[entry]
+      self.table.remove_entry(entry)
+    elif kind == 'modify':
+      entry_id,raw = msg[1:]
+      entry = self._entries_by_id.get(entry_id)
+      if entry is None: return
+      entry.actions = of.ofp_flow_mod.unpack_new(raw)[1].actions
+    elif kind == 'ports':
+      for port_no,config,state in msg[1]:
+        port = self.ports.get(port_no)
+        if port is None: continue
+        port.config = config
+        port.state = state
+
+  def _report (self):
+    """
+    Sends the counter changes since the last report to the POX process
+    """
+    entries = []
+    for entry,(packets,byte_count) in self._reported.iteritems():
+      if entry.packet_count == packets: continue
+      entries.append((self._entry_ids[entry], entry.packet_count - packets,
+                      entry.byte_count - byte_count, entry.last_touched))
+      self._reported[entry] = (entry.packet_count, entry.byte_count)
+    ports = []
+    for port_no,stats in self.port_stats.iteritems():
+      counts = (stats.rx_packets, stats.rx_bytes,
+                stats.tx_packets, stats.tx_bytes)
+      old = self._reported_ports.get(port_no, (0, 0, 0, 0))
+      if counts == old: continue
+      ports.append((port_no, tuple(a - b for a,b in zip(counts, old))))
+      self._reported_ports[port_no] = counts
+    lookups = (self._lookup_count, self._matched_count)
+    old = self._reported_lookups
+    if entries or ports or lookups != old:
+      self._out_q.put(('counters', entries, ports,
+                       lookups[0] - old[0], lookups[1] - old[1]))
+      self._reported_lookups = lookups
+
+  def _rx_table_miss (self, packet, in_port, port, packet_data = None):
+    if port.config & of.OFPPC_NO_PACKET_IN:
+      return
+    self._out_q.put(('miss', in_port, self._packet_data(packet)))
+
+  def _buffer_packet (self, packet, in_port=None):
+    # The POX process buffers packets sent to the controller
+    return None
+
+  def send_packet_in (self, in_port, buffer_id=None, packet=b'', reason=None,
+                      data_length=None):
+    if hasattr(packet, 'pack'):
+      packet = self._packet_data(packet)
+    self._out_q.put(('packet_in', in_port, packet, reason, data_length))
+
+  def _output_packet_physical (self, packet, port_no):
+    px = self.px.get(port_no)
+    if not px: return
+    px.inject(self._packet_data(packet))
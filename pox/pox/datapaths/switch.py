@@ -37,12 +37,14 @@ from pox.lib.recoco import Timer
 from pox.openflow.libopenflow_01 import *
 import pox.openflow.libopenflow_01 as of
 from pox.openflow.util import make_type_to_unpacker_table
-from pox.openflow.flow_table import FlowTable, TableEntry
+from pox.openflow.flow_table import FlowTable, TableEntry, FlowCache
 from pox.lib.packet import *
 
 import logging
 import struct
 import time
+import weakref
+from collections import deque
 
 
 # Multicast address used for STP 802.1D
@@ -61,7 +63,118 @@ class DpPacketOut (Event):
     self.switch = node # For backwards compatability
 
 
+class PacketBuffer (object):
+  """
+  Holds packets sent to the controller so that they can be referred to later
+
+  There are a fixed number of slots.  Free ones are kept in a deque, so
+  allocating one is O(1).  Whenever a packet is buffered, packets which
+  have been buffered for max_age seconds or more are evicted first, so
+  memory stays bounded even if the controller never uses the buffers.  If
+  there's still no free slot, the new packet isn't buffered.
+
+  A buffer ID is the slot number combined with the number of times the slot
+  has been used, so an ID whose packet has since been released or evicted
+  doesn't refer to whatever is in the slot now.
+  """
+  def __init__ (self, capacity, max_age=5):
+    assert 0 <= capacity < 0xffFF
+    self.capacity = capacity
+    self.max_age = max_age
+    self._slots = [None] * capacity # (buffer_id, packet, in_port, time)
+    self._uses = [0] * capacity
+    self._free = deque(xrange(capacity))
+    self._order = deque() # buffer_ids, oldest first (may be stale)
+
+    self.allocated = 0 # Packets buffered
+    self.released = 0 # Buffers used by the controller
+    self.evicted = 0 # Buffers dropped for being too old
+    self.failed = 0 # Packets not buffered since we were full
+    self.stale = 0 # Attempts to use an invalid or already-released buffer
+    self.reused = 0 # Allocations of a slot which had been used before
+
+  def __len__ (self):
+    return self.capacity - len(self._free)
+
+  def _entry (self, buffer_id):
+    """
+    Returns the slot and its contents for a buffer_id, or (None, None)
+    """
+    if buffer_id is None: return None,None
+    slot = (buffer_id & 0xffFF) - 1
+    if slot < 0 or slot >= self.capacity: return None,None
+    entry = self._slots[slot]
+    if entry is None or entry[0] != buffer_id: return None,None
+    return slot,entry
+
+  def _evict_old (self, now):
+    """
+    Evicts packets older than max_age
+    """
+    order = self._order
+    while order:
+      slot,entry = self._entry(order[0])
+      if entry is None:
+        order.popleft() # Stale
+        continue
+      if self.max_age is None or now - entry[3] < self.max_age:
+        break
+      order.popleft()
+      self._slots[slot] = None
+      self._free.append(slot)
+      self.evicted += 1
+
+  def allocate (self, packet, in_port, now):
+    """
+    Buffers a packet, returning its buffer_id (or None if there's no room)
+    """
+    self._evict_old(now)
+    if not self._free:
+      self.failed += 1
+      return None
+    slot = self._free.popleft()
+    uses = self._uses[slot]
+    if uses: self.reused += 1
+    uses = (uses + 1) & 0xffFF
+    self._uses[slot] = uses
+    buffer_id = (uses << 16) | (slot + 1)
+    self._slots[slot] = (buffer_id, packet, in_port, now)
+    self._order.append(buffer_id)
+    if len(self._order) > 2 * self.capacity:
+      self._order = deque(b for b in self._order
+                          if self._entry(b)[1] is not None)
+    self.allocated += 1
+    return buffer_id
+
+  def release (self, buffer_id):
+    """
+    Removes a packet from the buffer, returning (packet, in_port)
+
+    Returns None if there's no such buffer (e.g., it has been evicted).
+    """
+    slot,entry = self._entry(buffer_id)
+    if entry is None:
+      self.stale += 1
+      return None
+    self._slots[slot] = None
+    self._free.append(slot)
+    self.released += 1
+    return entry[1],entry[2]
+
+  def get_stats (self):
+    return dict(capacity=self.capacity, in_use=len(self),
+                allocated=self.allocated, released=self.released,
+                evicted=self.evicted, failed=self.failed,
+                stale=self.stale, reused=self.reused)
+
+  def __str__ (self):
+    return " ".join("%s=%s" % kv for kv in sorted(self.get_stats().items()))
+
+
 class SoftwareSwitchBase (object):
+  # Minimum seconds between warnings that the packet buffer is full
+  buffer_warn_period = 10
+
   def __init__ (self, dpid, name=None, ports=4, miss_send_len=128,
                 max_buffers=100, max_entries=0x7fFFffFF, features=None):
     """
@@ -88,6 +201,12 @@ class SoftwareSwitchBase (object):
     self.table = FlowTable()
     self.table.addListeners(self)
 
+    # Caches lookups in self.table (and notices if it's replaced)
+    self._flow_cache = FlowCache()
+
+    # TableEntry -> (actions, function) (see _compiled_actions_for())
+    self._compiled_actions = weakref.WeakKeyDictionary()
+
     self._lookup_count = 0
     self._matched_count = 0
 
@@ -95,7 +214,8 @@ class SoftwareSwitchBase (object):
     self._connection = None
 
     # buffer for packets during packet_in
-    self._packet_buffer = []
+    self.packet_buffer = PacketBuffer(max_buffers)
+    self._buffer_warn_time = None # When we last complained it was full
 
     # Map port_no -> openflow.pylibopenflow_01.ofp_phy_ports
     self.ports = {}
@@ -420,7 +540,7 @@ class SoftwareSwitchBase (object):
     Send PacketIn
     """
     if hasattr(packet, 'pack'):
-      packet = packet.pack()
+      packet = self._packet_data(packet)
     assert assert_type("packet", packet, bytes)
     self.log.debug("Send PacketIn")
     if reason is None:
@@ -474,19 +594,141 @@ class SoftwareSwitchBase (object):
     """
     assert assert_type("packet", packet, ethernet, none_ok=False)
     assert assert_type("in_port", in_port, int, none_ok=False)
+    port = self._check_rx_packet(packet, in_port)
+    if port is None: return
+
+    packet_data = self._set_packet_data(packet, packet_data)
+    self.port_stats[in_port].rx_packets += 1
+    self.port_stats[in_port].rx_bytes += len(packet_data)
+
+    self._lookup_count += 1
+    match = ofp_match.from_packet(packet, in_port, spec_frags = True)
+    entry = self._flow_cache.entry_for_match(self.table, match)
+    if entry is not None:
+      self._matched_count += 1
+      entry.touch_packet(len(packet))
+      self._compiled_actions_for(entry)(packet, in_port)
+    else:
+      self._rx_table_miss(packet, in_port, port, packet_data)
+
+  def rx_packets (self, batch):
+    """
+    process a batch of dataplane packets
+
+    batch: a sequence of (packet, in_port) or (packet, in_port, packet_data)
+           tuples, with the same meanings as for rx_packet()
+
+    This has the same effect as calling rx_packet() for each packet, but
+    does the per-flow work once for all the packets of a flow in the batch:
+    the table lookup, updating the entry's counters, and fetching the
+    entry's compiled actions.  Port counters are also updated once per port.
+    Packets of the same flow are processed in the order they were given,
+    but packets of different flows may be reordered relative to each other.
+    """
+    groups = {} # match key -> (match, port, [(packet, packet_data)])
+    order = []
+    rx_counts = {} # in_port -> [packets, bytes]
+
+    for item in batch:
+      packet = item[0]
+      in_port = item[1]
+      packet_data = item[2] if len(item) > 2 else None
+      assert assert_type("packet", packet, ethernet, none_ok=False)
+      assert assert_type("in_port", in_port, int, none_ok=False)
+      port = self._check_rx_packet(packet, in_port)
+      if port is None: continue
+
+      packet_data = self._set_packet_data(packet, packet_data)
+      counts = rx_counts.get(in_port)
+      if counts is None:
+        counts = rx_counts[in_port] = [0, 0]
+      counts[0] += 1
+      counts[1] += len(packet_data)
+
+      match = ofp_match.from_packet(packet, in_port, spec_frags = True)
+      group = groups.get(match.key)
+      if group is None:
+        group = groups[match.key] = (match, port, [])
+        order.append(group)
+      group[2].append((packet, packet_data))
+
+    for in_port,(packets,byte_count) in rx_counts.iteritems():
+      stats = self.port_stats[in_port]
+      stats.rx_packets += packets
+      stats.rx_bytes += byte_count
+
+    for match,port,packets in order:
+      in_port = match.in_port
+      self._lookup_count += len(packets)
+      entry = self._flow_cache.entry_for_match(self.table, match)
+      if entry is None:
+        for packet,packet_data in packets:
+          self._rx_table_miss(packet, in_port, port, packet_data)
+        continue
+
+      self._matched_count += len(packets)
+      entry.touch_packet(sum(len(packet) for packet,_ in packets),
+                         packet_count=len(packets))
+
+      process = self._compiled_actions_for(entry)
+      for packet,_ in packets:
+        process(packet, in_port)
+
+  @staticmethod
+  def _set_packet_data (packet, packet_data = None):
+    """
+    Attaches the packed form of a packet to it
+
+    If packet_data isn't given, the packet is packed.  Returns the data.
+
+    The data stays with the packet until an action rewrites one of its
+    headers (see _packet_modified()), so that a packet which is forwarded
+    unmodified never needs to be packed again.
+    """
+    if packet_data is None:
+      packet_data = packet.pack()
+    packet._switch_packet_data = packet_data
+    return packet_data
+
+  @staticmethod
+  def _packet_data (packet):
+    """
+    Returns the packed form of a packet, packing it only if needed
+    """
+    packet_data = getattr(packet, '_switch_packet_data', None)
+    if packet_data is None:
+      packet_data = packet.pack()
+    return packet_data
+
+  @staticmethod
+  def _packet_modified (packet):
+    """
+    Called by actions which rewrite a packet's headers
+
+    Discards the packet's attached data, since it no longer matches.
+    """
+    packet._switch_packet_data = None
+
+  def _check_rx_packet (self, packet, in_port):
+    """
+    Checks whether a dataplane packet should be processed at all
+
+    Returns the ofp_phy_port the packet arrived on, or None if the packet
+    should be dropped.
+    """
     port = self.ports.get(in_port)
     if port is None:
       self.log.warn("Got packet on missing port %i", in_port)
-      return
+      return None
 
     is_stp = packet.dst == _STP_MAC
 
     if (port.config & OFPPC_NO_RECV) and not is_stp:
       # Drop all except STP
-      return
+      return None
     if (port.config & OFPPC_NO_RECV_STP) and is_stp:
       # Drop STP
-      return
+      return None
 
     if self.config_flags & OFPC_FRAG_MASK:
       ipp = packet.find(ipv4)
@@ -495,7 +737,7 @@ class SoftwareSwitchBase (object):
           frag_mode = self.config_flags & OFPC_FRAG_MASK
           if frag_mode == OFPC_FRAG_DROP:
             # Drop fragment
-            return
+            return None
           elif frag_mode == OFPC_FRAG_REASM:
             if self.features.cap_ip_reasm:
               #TODO: Implement fragment reassembly
@@ -503,27 +745,19 @@ class SoftwareSwitchBase (object):
           else:
             self.log.warn("Illegal fragment processing mode: %i", frag_mode)
 
-    self.port_stats[in_port].rx_packets += 1
-    if packet_data is not None:
-      self.port_stats[in_port].rx_bytes += len(packet_data)
-    else:
-      self.port_stats[in_port].rx_bytes += len(packet.pack()) # Expensive
+    return port
 
-    self._lookup_count += 1
-    entry = self.table.entry_for_packet(packet, in_port)
-    if entry is not None:
-      self._matched_count += 1
-      entry.touch_packet(len(packet))
-      self._process_actions_for_packet(entry.actions, packet, in_port)
-    else:
-      # no matching entry
-      if port.config & OFPPC_NO_PACKET_IN:
-        return
-      buffer_id = self._buffer_packet(packet, in_port)
-      if packet_data is None:
-        packet_data = packet.pack()
-      self.send_packet_in(in_port, buffer_id, packet_data,
-                          reason=OFPR_NO_MATCH, data_length=self.miss_send_len)
+  def _rx_table_miss (self, packet, in_port, port, packet_data = None):
+    """
+    Handles a dataplane packet which didn't match any table entry
+    """
+    if port.config & OFPPC_NO_PACKET_IN:
+      return
+    buffer_id = self._buffer_packet(packet, in_port)
+    if packet_data is None:
+      packet_data = self._packet_data(packet)
+    self.send_packet_in(in_port, buffer_id, packet_data,
+                        reason=OFPR_NO_MATCH, data_length=self.miss_send_len)
 
   def delete_port (self, port):
     """
@@ -652,7 +886,7 @@ class SoftwareSwitchBase (object):
         self.log.debug("Dropping packet sent on port %i: Link down", port_no)
         return
       self.port_stats[port_no].tx_packets += 1
-      self.port_stats[port_no].tx_bytes += len(packet.pack()) #FIXME: Expensive
+      self.port_stats[port_no].tx_bytes += len(self._packet_data(packet))
       self._output_packet_physical(packet, port_no)
 
     if out_port < OFPP_MAX:
@@ -677,7 +911,7 @@ class SoftwareSwitchBase (object):
       # Do we disable send-to-controller when performing this?
       # (Currently, there's the possibility that a table miss from this
       # will result in a send-to-controller which may send back to table...)
-      self.rx_packet(packet, in_port)
+      self.rx_packet(packet, in_port, self._packet_data(packet))
     else:
       self.log.warn("Unsupported virtual output port: %d", out_port)
 
@@ -687,18 +921,16 @@ class SoftwareSwitchBase (object):
 
     If no buffer is available, return None.
     """
-    # Do we have an empty slot?
-    for (i, value) in enumerate(self._packet_buffer):
-      if value is None:
-        # Yes -- use it
-        self._packet_buffer[i] = (packet, in_port)
-        return i + 1
-    # No -- create a new slow
-    if len(self._packet_buffer) >= self.max_buffers:
-      # No buffers available!
-      return None
-    self._packet_buffer.append( (packet, in_port) )
-    return len(self._packet_buffer)
+    now = self._time
+    buffer_id = self.packet_buffer.allocate(packet, in_port, now)
+    if buffer_id is None and self.max_buffers:
+      # The controller isn't keeping up.  Say so, but not for every packet.
+      last = self._buffer_warn_time
+      if last is None or now - last >= self.buffer_warn_period:
+        self._buffer_warn_time = now
+        self.log.warn("Packet buffer full, sending whole packets (%s)",
+                      self.packet_buffer)
+    return buffer_id
 
   def _process_actions_for_packet_from_buffer (self, actions, buffer_id,
                                                ofp=None):
@@ -708,16 +940,13 @@ class SoftwareSwitchBase (object):
     ofp is the message which triggered this processing, if any (used for error
     generation)
     """
-    buffer_id = buffer_id - 1
-    if (buffer_id >= len(self._packet_buffer)) or (buffer_id < 0):
-      self.log.warn("Invalid output buffer id: %d", buffer_id + 1)
-      return
-    if self._packet_buffer[buffer_id] is None:
-      self.log.warn("Buffer %d has already been flushed", buffer_id + 1)
+    buffered = self.packet_buffer.release(buffer_id)
+    if buffered is None:
+      self.log.warn("Buffer %d is invalid or has already been flushed",
+                    buffer_id)
       return
-    (packet, in_port) = self._packet_buffer[buffer_id]
+    (packet, in_port) = buffered
     self._process_actions_for_packet(actions, packet, in_port, ofp)
-    self._packet_buffer[buffer_id] = None
 
   def _process_actions_for_packet (self, actions, packet, in_port, ofp=None):
     """
@@ -728,7 +957,9 @@ class SoftwareSwitchBase (object):
     """
     assert assert_type("packet", packet, (ethernet, bytes), none_ok=False)
     if not isinstance(packet, ethernet):
-      packet = ethernet.unpack(packet)
+      packet_data = packet
+      packet = ethernet.unpack(packet_data)
+      self._set_packet_data(packet, packet_data)
 
     for action in actions:
       #if action.type is ofp_action_resubmit:
@@ -741,6 +972,75 @@ class SoftwareSwitchBase (object):
         return
       packet = h(action, packet, in_port)
 
+  def _compiled_actions_for (self, entry):
+    """
+    Returns a function which applies a table entry's actions to a packet
+
+    The function takes (packet, in_port).  It's compiled the first time it's
+    needed, and compiled again if the entry's actions are replaced (as
+    modify flow_mods do).
+    """
+    compiled = self._compiled_actions.get(entry)
+    if compiled is None or compiled[0] is not entry.actions:
+      compiled = (entry.actions, self._compile_actions(entry.actions))
+      self._compiled_actions[entry] = compiled
+    return compiled[1]
+
+  def _compile_actions (self, actions):
+    """
+    Compiles a list of actions into a function of (packet, in_port)
+
+    The function does what _process_actions_for_packet() would.  The usual
+    shapes of action list (nothing but outputs, or header rewrites followed
+    by outputs) get functions which skip the per-action dispatch.
+    """
+    handlers = []
+    for action in actions:
+      h = self.action_handlers.get(action.type)
+      if h is None:
+        # Leave it to the general path to report the error
+        def process (packet, in_port):
+          self._process_actions_for_packet(actions, packet, in_port)
+        return process
+      handlers.append((h, action))
+
+    if not handlers:
+      def process (packet, in_port):
+        pass
+      return process
+
+    # Split into header rewrites followed by outputs, if it has that shape
+    output_handler = self.action_handlers.get(OFPAT_OUTPUT)
+    first_output = len(handlers)
+    while first_output and handlers[first_output-1][0] == output_handler:
+      first_output -= 1
+    rewrites = handlers[:first_output]
+    outputs = [(a.port, a.max_len) for h,a in handlers[first_output:]]
+    if (output_handler != self._action_output or
+        any(h == output_handler for h,a in rewrites)):
+      # Some other shape; just do them in order
+      def process (packet, in_port):
+        for h,action in handlers:
+          packet = h(action, packet, in_port)
+      return process
+
+    output = self._output_packet
+    if not rewrites and len(outputs) == 1:
+      out_port,max_len = outputs[0]
+      def process (packet, in_port):
+        output(packet, out_port, in_port, max_len)
+    elif not rewrites:
+      def process (packet, in_port):
+        for out_port,max_len in outputs:
+          output(packet, out_port, in_port, max_len)
+    else:
+      def process (packet, in_port):
+        for h,action in rewrites:
+          packet = h(action, packet, in_port)
+        for out_port,max_len in outputs:
+          output(packet, out_port, in_port, max_len)
+    return process
+
   def _flow_mod_add (self, flow_mod, connection, table):
     """
     Process an OFPFC_ADD flow mod sent to the switch.
@@ -849,6 +1149,7 @@ class SoftwareSwitchBase (object):
       packet.type = ethernet.VLAN_TYPE
       packet.payload = vl
     packet.payload.id = action.vlan_vid
+    self._packet_modified(packet)
     return packet
   def _action_set_vlan_pcp (self, action, packet, in_port):
     if not isinstance(packet.payload, vlan):
@@ -858,17 +1159,21 @@ class SoftwareSwitchBase (object):
       packet.payload = vl
       packet.type = ethernet.VLAN_TYPE
     packet.payload.pcp = action.vlan_pcp
+    self._packet_modified(packet)
     return packet
   def _action_strip_vlan (self, action, packet, in_port):
     if isinstance(packet.payload, vlan):
       packet.type = packet.payload.eth_type
       packet.payload = packet.payload.payload
+      self._packet_modified(packet)
     return packet
   def _action_set_dl_src (self, action, packet, in_port):
     packet.src = action.dl_addr
+    self._packet_modified(packet)
     return packet
   def _action_set_dl_dst (self, action, packet, in_port):
     packet.dst = action.dl_addr
+    self._packet_modified(packet)
     return packet
   def _action_set_nw_src (self, action, packet, in_port):
     nw = packet.payload
@@ -876,6 +1181,7 @@ class SoftwareSwitchBase (object):
       nw = nw.payload
     if isinstance(nw, ipv4):
       nw.srcip = action.nw_addr
+      self._packet_modified(packet)
     return packet
   def _action_set_nw_dst (self, action, packet, in_port):
     nw = packet.payload
@@ -883,6 +1189,7 @@ class SoftwareSwitchBase (object):
       nw = nw.payload
     if isinstance(nw, ipv4):
       nw.dstip = action.nw_addr
+      self._packet_modified(packet)
     return packet
   def _action_set_nw_tos (self, action, packet, in_port):
     nw = packet.payload
@@ -890,6 +1197,7 @@ class SoftwareSwitchBase (object):
       nw = nw.payload
     if isinstance(nw, ipv4):
       nw.tos = action.nw_tos
+      self._packet_modified(packet)
     return packet
   def _action_set_tp_src (self, action, packet, in_port):
     nw = packet.payload
@@ -899,6 +1207,7 @@ class SoftwareSwitchBase (object):
       tp = nw.payload
       if isinstance(tp, udp) or isinstance(tp, tcp):
         tp.srcport = action.tp_port
+        self._packet_modified(packet)
     return packet
   def _action_set_tp_dst (self, action, packet, in_port):
     nw = packet.payload
@@ -908,6 +1217,7 @@ class SoftwareSwitchBase (object):
       tp = nw.payload
       if isinstance(tp, udp) or isinstance(tp, tcp):
         tp.dstport = action.tp_port
+        self._packet_modified(packet)
     return packet
   def _action_enqueue (self, action, packet, in_port):
     self.log.warn("Enqueue not supported.  Performing regular output.")
@@ -34,6 +34,11 @@ from pox.lib.recoco import Timer
 from collections import defaultdict
 from pox.openflow.discovery import Discovery
 from pox.lib.util import dpid_to_str
+import pox.lib.packet as pkt
+from array import array
+from struct import pack
+from zlib import crc32
+import itertools
 import time
 
 log = core.getLogger()
@@ -47,12 +52,18 @@ switches = {}
 # ethaddr -> (switch, port)
 mac_map = {}
 
-# [sw1][sw2] -> (distance, intermediate)
-path_map = defaultdict(lambda:defaultdict(lambda:(None,None)))
-
 # Waiting path.  (dpid,xid)->WaitingPath
 waiting_paths = {}
 
+# Paths we've installed flows for.  cookie -> InstalledPath
+installed_paths = {}
+
+# Links (see _link_key()) -> set of cookies of installed paths using them
+link_paths = defaultdict(set)
+
+# Cookies for installed paths' flows
+_cookies = itertools.count(1)
+
 # Time to not flood in seconds
 FLOOD_HOLDDOWN = 5
 
@@ -63,62 +74,271 @@ FLOW_HARD_TIMEOUT = 30
 # How long is allowable to set up a path?
 PATH_SETUP_TIME = 4
 
+# Spread flows over equal-cost paths?
+ECMP = True
+
 
-def _calc_paths ():
+# Distance between unconnected switches in PathMap
+_INF = 0x7fffFFFF
+
+
+class PathMap (object):
   """
-  Essentially Floyd-Warshall algorithm
+  All-pairs shortest paths between switches, maintained incrementally
+
+  Distances and next hops are kept in dense matrices -- a row (an array)
+  per switch, indexed by the order switches were added in.  Adding a link
+  only updates the pairs whose distance it shortens.  Removing a link
+  recomputes (by BFS) only the destinations whose chosen paths crossed it.
+
+  Links are undirected, and all have a cost of one.  Since the distances
+  are exact, all of the equal-cost next hops toward a destination can be
+  found from them; the kept next hop is just one of these.
   """
+  def __init__ (self):
+    self._index = {} # node -> number
+    self._nodes = []
+    self._neighbors = [] # [number] -> set of neighboring numbers
+    self._dist = [] # [i][j] -> distance from i to j
+    self._next = [] # [i][j] -> first hop from i toward j
+
+  def __contains__ (self, node):
+    return node in self._index
+
+  def add_node (self, node):
+    if node in self._index: return
+    n = len(self._nodes)
+    self._index[node] = n
+    self._nodes.append(node)
+    self._neighbors.append(set())
+    for row in self._dist: row.append(_INF)
+    for row in self._next: row.append(-1)
+    dist = array('i', [_INF]) * (n + 1)
+    dist[n] = 0
+    self._dist.append(dist)
+    nxt = array('i', [-1]) * (n + 1)
+    nxt[n] = n
+    self._next.append(nxt)
+
+  def add_link (self, a, b):
+    self.add_node(a)
+    self.add_node(b)
+    u = self._index[a]
+    v = self._index[b]
+    if u == v or v in self._neighbors[u]: return
+    self._neighbors[u].add(v)
+    self._neighbors[v].add(u)
+
+    dist = self._dist
+    du = array('i', dist[u]) # Distances to/from u before the link
+    dv = array('i', dist[v])
+    n = len(du)
+    # A path through the new link can only be shorter if its part up to
+    # (and including) the link is.  So i->u->v->j only helps for i in
+    # closer_to_u and j in closer_to_v, and vice versa.
+    closer_to_u = [i for i in xrange(n) if du[i] + 1 < dv[i]]
+    closer_to_v = [i for i in xrange(n) if dv[i] + 1 < du[i]]
+    self._relax(u, v, du, dv, closer_to_u, closer_to_v)
+    self._relax(v, u, dv, du, closer_to_v, closer_to_u)
+
+  def _relax (self, u, v, du, dv, sources, destinations):
+    """
+    Shortens paths from sources to destinations by going over u->v
+    """
+    dist = self._dist
+    nxt = self._next
+    for i in sources:
+      row = dist[i]
+      next_row = nxt[i]
+      hop = v if i == u else next_row[u]
+      base = du[i] + 1
+      for j in destinations:
+        d = base + dv[j]
+        if d < row[j]:
+          row[j] = d
+          next_row[j] = hop
+
+  def remove_link (self, a, b):
+    u = self._index.get(a)
+    v = self._index.get(b)
+    if u is None or v is None or v not in self._neighbors[u]: return
+    self._neighbors[u].discard(v)
+    self._neighbors[v].discard(u)
+
+    next_u = self._next[u]
+    next_v = self._next[v]
+    for j in xrange(len(self._nodes)):
+      if next_u[j] == v or next_v[j] == u:
+        # Some path toward j went over the link
+        self._recompute_destination(j)
+
+  def _recompute_destination (self, j):
+    """
+    Recomputes the distances and next hops of everyone toward j
+    """
+    dist = self._dist
+    nxt = self._next
+    for i in xrange(len(self._nodes)):
+      dist[i][j] = _INF
+      nxt[i][j] = -1
+    dist[j][j] = 0
+    nxt[j][j] = j
+    neighbors = self._neighbors
+    frontier = [j]
+    d = 0
+    while frontier:
+      d += 1
+      new_frontier = []
+      for k in frontier:
+        for i in neighbors[k]:
+          if dist[i][j] != _INF: continue
+          dist[i][j] = d
+          nxt[i][j] = k
+          new_frontier.append(i)
+      frontier = new_frontier
+
+  def distance (self, a, b):
+    """
+    Returns the number of hops from a to b (or None if there's no path)
+    """
+    u = self._index.get(a)
+    v = self._index.get(b)
+    if u is None or v is None: return None
+    d = self._dist[u][v]
+    return None if d == _INF else d
 
-  def dump ():
-    for i in sws:
-      for j in sws:
-        a = path_map[i][j][0]
-        #a = adjacency[i][j]
-        if a is None: a = "*"
-        print a,
-      print
-
-  sws = switches.values()
-  path_map.clear()
-  for k in sws:
-    for j,port in adjacency[k].iteritems():
-      if port is None: continue
-      path_map[k][j] = (1,None)
-    path_map[k][k] = (0,None) # distance, intermediate
-
-  #dump()
-
-  for k in sws:
-    for i in sws:
-      for j in sws:
-        if path_map[i][k][0] is not None:
-          if path_map[k][j][0] is not None:
-            # i -> k -> j exists
-            ikj_dist = path_map[i][k][0]+path_map[k][j][0]
-            if path_map[i][j][0] is None or ikj_dist < path_map[i][j][0]:
-              # i -> k -> j is better than existing
-              path_map[i][j] = (ikj_dist, k)
-
-  #print "--------------------"
-  #dump()
-
-
-def _get_raw_path (src, dst):
+  def next_hop (self, a, b):
+    """
+    Returns the node after a on the path from a to b (or None)
+    """
+    u = self._index.get(a)
+    v = self._index.get(b)
+    if u is None or v is None: return None
+    hop = self._next[u][v]
+    return None if hop < 0 else self._nodes[hop]
+
+  def _next_hops (self, u, v):
+    """
+    Returns the numbers of all neighbors of u on shortest paths to v
+    """
+    dist = self._dist
+    d = dist[u][v] - 1
+    return sorted(k for k in self._neighbors[u] if dist[k][v] == d)
+
+  def next_hops (self, a, b):
+    """
+    Returns all nodes after a on equal-cost paths from a to b
+    """
+    u = self._index.get(a)
+    v = self._index.get(b)
+    if u is None or v is None or u == v: return []
+    if self._dist[u][v] == _INF: return []
+    nodes = self._nodes
+    return [nodes[k] for k in self._next_hops(u, v)]
+
+  def _count_paths (self, u, v, counts):
+    """
+    Returns the number of shortest paths from u to v
+
+    counts is filled in with the number for each node on those paths.
+    This doesn't recurse, so it works for paths of any length.
+    """
+    # Find the nodes on the paths...
+    hops = {}
+    stack = [u]
+    while stack:
+      k = stack.pop()
+      if k in hops: continue
+      hops[k] = [] if k == v else self._next_hops(k, v)
+      stack.extend(hops[k])
+    # ...and count from v outward, so each node's next hops are done first
+    dist = self._dist
+    for k in sorted(hops, key = lambda k: dist[k][v]):
+      counts[k] = sum(counts[h] for h in hops[k]) if k != v else 1
+    return counts[u]
+
+  def path_count (self, a, b):
+    """
+    Returns the number of equal-cost paths from a to b (zero if none)
+    """
+    u = self._index.get(a)
+    v = self._index.get(b)
+    if u is None or v is None or self._dist[u][v] == _INF: return 0
+    return self._count_paths(u, v, {})
+
+  def intermediates (self, a, b, flow_hash = None):
+    """
+    Returns the nodes strictly between a and b on the path (or None)
+
+    If flow_hash is given, it picks among the equal-cost paths: they're
+    numbered (in order of their next hops) and path flow_hash % n of the
+    n paths is taken.  So different hashes spread evenly over all of the
+    paths, and hashes which are equal modulo path_count() pick the same one.
+    """
+    u = self._index.get(a)
+    v = self._index.get(b)
+    if u is None or v is None: return None
+    nxt = self._next
+    if nxt[u][v] < 0: return None
+    nodes = self._nodes
+    path = []
+    if flow_hash is None:
+      hop = nxt[u][v]
+      while hop != v:
+        path.append(nodes[hop])
+        hop = nxt[hop][v]
+      return path
+    counts = {}
+    choice = flow_hash % self._count_paths(u, v, counts)
+    hop = u
+    while True:
+      for k in self._next_hops(hop, v):
+        if choice < counts[k]: break
+        choice -= counts[k]
+      hop = k
+      if hop == v: break
+      path.append(nodes[hop])
+    return path
+
+
+# Shortest paths between switches
+path_map = PathMap()
+
+# Cooked paths.
+# (src, dst, first_port, final_port, path number) -> path (or None)
+# Cleared whenever links change.  Don't modify the paths in it!
+path_cache = {}
+
+# Number of equal-cost paths.  (src, dst) -> count
+# Cleared along with path_cache.
+path_counts = {}
+
+# Maximum number of paths to cache
+PATH_CACHE_SIZE = 10000
+
+
+def _flow_hash (packet):
+  """
+  Hashes a packet's IP 5-tuple, for picking among equal-cost paths
+
+  Packets which aren't TCP or UDP over IP all hash to zero.
+  """
+  ip = packet.find('ipv4')
+  if ip is None: return 0
+  l4 = ip.payload
+  if not (isinstance(l4, pkt.tcp) or isinstance(l4, pkt.udp)): return 0
+  return crc32(pack('!IIBHH', ip.srcip.toUnsigned(), ip.dstip.toUnsigned(),
+                    ip.protocol, l4.srcport, l4.dstport)) & 0xffffFFFF
+
+
+def _get_raw_path (src, dst, flow_hash = None):
   """
   Get a raw path (just a list of nodes to traverse)
   """
-  if len(path_map) == 0: _calc_paths()
   if src is dst:
     # We're here!
     return []
-  if path_map[src][dst][0] is None:
-    return None
-  intermediate = path_map[src][dst][1]
-  if intermediate is None:
-    # Directly connected
-    return []
-  return _get_raw_path(src, intermediate) + [intermediate] + \
-         _get_raw_path(intermediate, dst)
+  return path_map.intermediates(src, dst, flow_hash)
 
 
 def _check_path (p):
@@ -135,15 +355,38 @@ def _check_path (p):
   return True
 
 
-def _get_path (src, dst, first_port, final_port):
+def _get_path (src, dst, first_port, final_port, flow_hash = None):
   """
   Gets a cooked path -- a list of (node,in_port,out_port)
+
+  flow_hash picks among equal-cost paths (see PathMap.intermediates()).
+  The result may be shared, so don't modify it.
   """
+  if flow_hash is not None:
+    # Only the path it picks matters, so cache by that
+    n = path_counts.get((src, dst))
+    if n is None:
+      n = path_map.path_count(src, dst)
+      path_counts[src, dst] = n
+    flow_hash = flow_hash % n if n else None
+  key = (src, dst, first_port, final_port, flow_hash)
+  try:
+    return path_cache[key]
+  except KeyError:
+    pass
+  if len(path_cache) >= PATH_CACHE_SIZE:
+    path_cache.clear()
+  r = _cook_path(src, dst, first_port, final_port, flow_hash)
+  path_cache[key] = r
+  return r
+
+
+def _cook_path (src, dst, first_port, final_port, flow_hash = None):
   # Start with a raw path...
   if src == dst:
     path = [src]
   else:
-    path = _get_raw_path(src, dst)
+    path = _get_raw_path(src, dst, flow_hash)
     if path is None: return None
     path = [src] + path + [dst]
 
@@ -161,6 +404,83 @@ def _get_path (src, dst, first_port, final_port):
   return r
 
 
+def _link_key (sw1, sw2):
+  """
+  Returns the key for the link between two switches in link_paths
+  """
+  if sw1.dpid > sw2.dpid: return (sw2, sw1)
+  return (sw1, sw2)
+
+
+class InstalledPath (object):
+  """
+  A path we've installed flows for
+
+  Its flows are tagged with its cookie, and it's indexed in link_paths by
+  the links it uses, so that just the affected paths can be removed when
+  a link changes.
+  """
+  def __init__ (self, path, match):
+    self.cookie = next(_cookies)
+    self.path = path
+    self.match = match.clone()
+    self.expires_at = time.time() + FLOW_HARD_TIMEOUT
+    self.links = set(_link_key(a[0], b[0])
+                     for a,b in zip(path[:-1], path[1:]))
+
+    installed_paths[self.cookie] = self
+    for link in self.links:
+      link_paths[link].add(self.cookie)
+
+  def _forget (self):
+    installed_paths.pop(self.cookie, None)
+    for link in self.links:
+      cookies = link_paths.get(link)
+      if cookies is None: continue
+      cookies.discard(self.cookie)
+      if not cookies: del link_paths[link]
+
+  def remove (self):
+    """
+    Removes this path's flows from the switches
+    """
+    self._forget()
+    for sw,in_port,out_port in self.path:
+      if sw.connection is None: continue
+      msg = of.ofp_flow_mod(command=of.OFPFC_DELETE_STRICT,
+                            cookie=self.cookie)
+      msg.match = self.match.clone()
+      msg.match.in_port = in_port
+      sw.connection.send(msg)
+
+  @property
+  def is_expired (self):
+    return time.time() >= self.expires_at
+
+  @property
+  def length (self):
+    return len(self.path) - 1
+
+  @staticmethod
+  def expire_installed_paths ():
+    """
+    Forgets paths whose flows will have timed out by now
+    """
+    for p in [p for p in installed_paths.itervalues() if p.is_expired]:
+      p._forget()
+
+
+def _remove_paths_over_link (sw1, sw2):
+  """
+  Removes the installed paths using the link between two switches
+  """
+  cookies = link_paths.get(_link_key(sw1, sw2))
+  if not cookies: return
+  log.debug("Removing %i paths over %s-%s", len(cookies), sw1, sw2)
+  for cookie in list(cookies):
+    installed_paths[cookie].remove()
+
+
 class WaitingPath (object):
   """
   A path which is waiting for its path to be established
@@ -237,8 +557,10 @@ class Switch (EventMixin):
   def __repr__ (self):
     return dpid_to_str(self.dpid)
 
-  def _install (self, switch, in_port, out_port, match, buf = None):
+  def _install (self, switch, in_port, out_port, match, buf = None,
+                cookie = 0):
     msg = of.ofp_flow_mod()
+    msg.cookie = cookie
     msg.match = match
     msg.match.in_port = in_port
     msg.idle_timeout = FLOW_IDLE_TIMEOUT
@@ -249,8 +571,9 @@ class Switch (EventMixin):
 
   def _install_path (self, p, match, packet_in=None):
     wp = WaitingPath(p, packet_in)
+    ip = InstalledPath(p, match)
     for sw,in_port,out_port in p:
-      self._install(sw, in_port, out_port, match)
+      self._install(sw, in_port, out_port, match, cookie=ip.cookie)
       msg = of.ofp_barrier_request()
       sw.connection.send(msg)
       wp.add_xid(sw.dpid,msg.xid)
@@ -259,12 +582,11 @@ class Switch (EventMixin):
     """
     Attempts to install a path between this switch and some destination
     """
-    p = _get_path(self, dst_sw, event.port, last_port)
+    flow_hash = _flow_hash(event.parsed) if ECMP else None
+    p = _get_path(self, dst_sw, event.port, last_port, flow_hash)
     if p is None:
       log.warning("Can't get from %s to %s", match.dl_src, match.dl_dst)
 
-      import pox.lib.packet as pkt
-
       if (match.dl_type == pkt.ethernet.IP_TYPE and
           event.parsed.find('ipv4')):
         # It's IP -- let's send a destination unreachable
@@ -431,17 +753,10 @@ class l2_multi (EventMixin):
     sw1 = switches[l.dpid1]
     sw2 = switches[l.dpid2]
 
-    # Invalidate all flows and path info.
-    # For link adds, this makes sure that if a new link leads to an
-    # improved path, we use it.
-    # For link removals, this makes sure that we don't use a
-    # path that may have been broken.
-    #NOTE: This could be radically improved! (e.g., not *ALL* paths break)
-    clear = of.ofp_flow_mod(command=of.OFPFC_DELETE)
-    for sw in switches.itervalues():
-      if sw.connection is None: continue
-      sw.connection.send(clear)
-    path_map.clear()
+    was_connected = adjacency[sw1][sw2] is not None
+    old_ports = (adjacency[sw1][sw2], adjacency[sw2][sw1])
+    path_cache.clear()
+    path_counts.clear()
 
     if event.removed:
       # This link no longer okay
@@ -449,14 +764,16 @@ class l2_multi (EventMixin):
       if sw1 in adjacency[sw2]: del adjacency[sw2][sw1]
 
       # But maybe there's another way to connect these...
-      for ll in core.openflow_discovery.adjacency:
-        if ll.dpid1 == l.dpid1 and ll.dpid2 == l.dpid2:
-          if flip(ll) in core.openflow_discovery.adjacency:
-            # Yup, link goes both ways
-            adjacency[sw1][sw2] = ll.port1
-            adjacency[sw2][sw1] = ll.port2
-            # Fixed -- new link chosen to connect these
-            break
+      # (The removed link is still there while its event is raised.)
+      links = core.openflow_discovery.adjacency
+      for ll in links.links_between(l.dpid1, l.dpid2):
+        if ll == l: continue
+        if flip(ll) in links:
+          # Yup, link goes both ways
+          adjacency[sw1][sw2] = ll.port1
+          adjacency[sw2][sw1] = ll.port2
+          # Fixed -- new link chosen to connect these
+          break
     else:
       # If we already consider these nodes connected, we can
       # ignore this link up.
@@ -479,12 +796,39 @@ class l2_multi (EventMixin):
         log.debug("Unlearned %s", mac)
         del mac_map[mac]
 
+    # Update path info if these switches' connectedness changed
+    is_connected = adjacency[sw1][sw2] is not None
+    if is_connected and not was_connected:
+      path_map.add_link(sw1, sw2)
+    elif was_connected and not is_connected:
+      path_map.remove_link(sw1, sw2)
+
+    # Remove the installed paths this affects.
+    # For link removals, this makes sure that we don't use a path that
+    # has been broken (or now goes out different ports).
+    # For link adds, this makes sure that if a new link leads to an
+    # improved path, we use it, and that paths don't end at a port we
+    # now know to be connected to another switch.
+    new_ports = (adjacency[sw1][sw2], adjacency[sw2][sw1])
+    if was_connected and new_ports != old_ports:
+      _remove_paths_over_link(sw1, sw2)
+    if not event.removed:
+      edges = set([(sw1, l.port1), (sw2, l.port2)])
+      for p in installed_paths.values():
+        first = p.path[0]
+        last = p.path[-1]
+        if ((first[0], first[1]) in edges or (last[0], last[2]) in edges or
+            (is_connected and not was_connected and
+             path_map.distance(first[0], last[0]) < p.length)):
+          p.remove()
+
   def _handle_openflow_ConnectionUp (self, event):
     sw = switches.get(event.dpid)
     if sw is None:
       # New switch
       sw = Switch()
       switches[event.dpid] = sw
+      path_map.add_node(sw)
       sw.connect(event.connection)
     else:
       sw.connect(event.connection)
@@ -498,8 +842,14 @@ class l2_multi (EventMixin):
     wp.notify(event)
 
 
-def launch ():
+def launch (no_ecmp = False):
+  global ECMP
+  if no_ecmp:
+    ECMP = False
+
   core.registerNew(l2_multi)
 
   timeout = min(max(PATH_SETUP_TIME, 5) * 2, 15)
   Timer(timeout, WaitingPath.expire_waiting_paths, recurring=True)
+  Timer(FLOW_HARD_TIMEOUT, InstalledPath.expire_installed_paths,
+        recurring=True)
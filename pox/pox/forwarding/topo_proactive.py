@@ -50,91 +50,45 @@ adjacency = defaultdict(lambda:defaultdict(lambda:None))
 switches_by_dpid = {}
 switches_by_id = {}
 
-# [sw1][sw2] -> (distance, intermediate)
-path_map = defaultdict(lambda:defaultdict(lambda:(None,None)))
+# [src][dst] -> port on src leading toward dst
+# Cleared whenever links change, and recalculated when next needed.
+next_hops = {}
 
 
 def dpid_to_mac (dpid):
   return EthAddr("%012x" % (dpid & 0xffFFffFFffFF,))
 
 
-def _calc_paths ():
-  """
-  Essentially Floyd-Warshall algorithm
+def _calc_next_hops ():
   """
+  Calculates every switch's next hop toward every other switch
 
-  def dump ():
-    for i in sws:
-      for j in sws:
-        a = path_map[i][j][0]
-        #a = adjacency[i][j]
-        if a is None: a = "*"
-        print a,
-      print
-
-  sws = switches_by_dpid.values()
-  path_map.clear()
-  for k in sws:
-    for j,port in adjacency[k].iteritems():
-      if port is None: continue
-      path_map[k][j] = (1,None)
-    path_map[k][k] = (0,None) # distance, intermediate
-
-  #dump()
-
-  for k in sws:
-    for i in sws:
-      for j in sws:
-        if path_map[i][k][0] is not None:
-          if path_map[k][j][0] is not None:
-            # i -> k -> j exists
-            ikj_dist = path_map[i][k][0]+path_map[k][j][0]
-            if path_map[i][j][0] is None or ikj_dist < path_map[i][j][0]:
-              # i -> k -> j is better than existing
-              path_map[i][j] = (ikj_dist, k)
-
-  #print "--------------------"
-  #dump()
-
-
-def _get_raw_path (src, dst):
-  """
-  Get a raw path (just a list of nodes to traverse)
+  Does a BFS outward from each destination, so all of the switches' rules
+  can be generated from the result in one pass.
   """
-  if len(path_map) == 0: _calc_paths()
-  if src is dst:
-    # We're here!
-    return []
-  if path_map[src][dst][0] is None:
-    return None
-  intermediate = path_map[src][dst][1]
-  if intermediate is None:
-    # Directly connected
-    return []
-  return _get_raw_path(src, intermediate) + [intermediate] + \
-         _get_raw_path(intermediate, dst)
-
-
-def _get_path (src, dst):
+  next_hops.clear()
+  for dst in switches_by_dpid.itervalues():
+    seen = set([dst])
+    frontier = [dst]
+    while frontier:
+      new_frontier = []
+      for k in frontier:
+        for i in adjacency[k].keys():
+          if i in seen: continue
+          out_port = adjacency[i].get(k)
+          if out_port is None or adjacency[k][i] is None: continue
+          seen.add(i)
+          next_hops.setdefault(i, {})[dst] = out_port
+          new_frontier.append(i)
+      frontier = new_frontier
+
+
+def _get_next_hops (src):
   """
-  Gets a cooked path -- a list of (node,out_port)
+  Gets the ports on src leading toward other switches.  dst -> port
   """
-  # Start with a raw path...
-  if src == dst:
-    path = [src]
-  else:
-    path = _get_raw_path(src, dst)
-    if path is None: return None
-    path = [src] + path + [dst]
-
-  # Now add the ports
-  r = []
-  for s1,s2 in zip(path[:-1],path[1:]):
-    out_port = adjacency[s1][s2]
-    r.append((s1,out_port))
-    in_port = adjacency[s2][s1]
-
-  return r
+  if len(next_hops) == 0: _calc_next_hops()
+  return next_hops.get(src, {})
 
 
 def ipinfo (ip):
@@ -172,6 +126,9 @@ class TopoSwitch (DHCPD):
 
     self.ip_to_mac = {}
 
+    # The rules we've installed.  (priority, match) -> actions
+    self._table = {}
+
     # Listen to our own event... :)
     self.addListenerByName("DHCPLease", self._on_lease)
 
@@ -184,58 +141,51 @@ class TopoSwitch (DHCPD):
 
 
   def send_table (self):
+    """
+    Brings the switch's flow table up to date
+
+    Works out the whole table, and then sends just the rules which have
+    been added, changed, or removed since we last sent it.
+    """
     if self.connection is None:
       self.log.debug("Can't send table: disconnected")
       return
 
-    clear = of.ofp_flow_mod(command=of.OFPFC_DELETE)
-    self.connection.send(clear)
-    self.connection.send(of.ofp_barrier_request())
+    self._send_rules(self._rules(), remove = True)
+
+
+  def _rules (self):
+    """
+    Returns the rules the switch should have.  (priority, match) -> actions
+    """
+    rules = {}
+    def add (actions, priority = of.OFP_DEFAULT_PRIORITY, **kw):
+      match = of.ofp_match(dl_type = pkt.ethernet.IP_TYPE, **kw)
+      rules[priority,match] = actions
 
     # From DHCPD
-    msg = of.ofp_flow_mod()
-    msg.match = of.ofp_match()
-    msg.match.dl_type = pkt.ethernet.IP_TYPE
-    msg.match.nw_proto = pkt.ipv4.UDP_PROTOCOL
-    #msg.match.nw_dst = IP_BROADCAST
-    msg.match.tp_src = pkt.dhcp.CLIENT_PORT
-    msg.match.tp_dst = pkt.dhcp.SERVER_PORT
-    msg.actions.append(of.ofp_action_output(port = of.OFPP_CONTROLLER))
-    #msg.actions.append(of.ofp_action_output(port = of.OFPP_FLOOD))
-    self.connection.send(msg)
-
-    core.openflow_discovery.install_flow(self.connection)
-
-    src = self
-    for dst in switches_by_dpid.itervalues():
-      if dst is src: continue
-      p = _get_path(src, dst)
-      if p is None: continue
-
-      msg = of.ofp_flow_mod()
-      msg.match = of.ofp_match()
-      msg.match.dl_type = pkt.ethernet.IP_TYPE
-      #msg.match.nw_dst = "%s/%s" % (dst.network, dst.subnet)
-      msg.match.nw_dst = "%s/%s" % (dst.network, "255.255.0.0")
-
-      msg.actions.append(of.ofp_action_output(port=p[0][1]))
-      self.connection.send(msg)
+    add([of.ofp_action_output(port = of.OFPP_CONTROLLER)],
+        nw_proto = pkt.ipv4.UDP_PROTOCOL,
+        #nw_dst = IP_BROADCAST,
+        tp_src = pkt.dhcp.CLIENT_PORT,
+        tp_dst = pkt.dhcp.SERVER_PORT)
+
+    for dst,port in _get_next_hops(self).iteritems():
+      #nw_dst = "%s/%s" % (dst.network, dst.subnet)
+      add([of.ofp_action_output(port=port)],
+          nw_dst = "%s/%s" % (dst.network, "255.255.0.0"))
 
     """
     # Can just do this instead of MAC learning if you run arp_responder...
     for port in self.ports:
       p = port.port_no
       if p < 0 or p >= of.OFPP_MAX: continue
-      msg = of.ofp_flow_mod()
-      msg.match = of.ofp_match()
-      msg.match.dl_type = pkt.ethernet.IP_TYPE
-      msg.match.nw_dst = "10.%s.%s.0/255.255.255.0" % (self._id,p)
-      msg.actions.append(of.ofp_action_output(port=p))
-      self.connection.send(msg)
+      add([of.ofp_action_output(port=p)],
+          nw_dst = "10.%s.%s.0/255.255.255.0" % (self._id,p))
     """
 
     for ip,mac in self.ip_to_mac.iteritems():
-      self._send_rewrite_rule(ip, mac)
+      rules.update(self._rewrite_rule(ip, mac))
 
     flood_ports = []
     for port in self.ports:
@@ -245,35 +195,49 @@ class TopoSwitch (DHCPD):
       if core.openflow_discovery.is_edge_port(self.dpid, p):
         flood_ports.append(p)
 
-      msg = of.ofp_flow_mod()
-      msg.priority -= 1
-      msg.match = of.ofp_match()
-      msg.match.dl_type = pkt.ethernet.IP_TYPE
-      msg.match.nw_dst = "10.%s.%s.0/255.255.255.0" % (self._id,p)
-      msg.actions.append(of.ofp_action_output(port=of.OFPP_CONTROLLER))
-      self.connection.send(msg)
-
-    msg = of.ofp_flow_mod()
-    msg.priority -= 1
-    msg.match = of.ofp_match()
-    msg.match.dl_type = pkt.ethernet.IP_TYPE
-    msg.match.nw_dst = "255.255.255.255"
-    for p in flood_ports:
-      msg.actions.append(of.ofp_action_output(port=p))
-    self.connection.send(msg)
-
-
-  def _send_rewrite_rule (self, ip, mac):
+      add([of.ofp_action_output(port=of.OFPP_CONTROLLER)],
+          priority = of.OFP_DEFAULT_PRIORITY - 1,
+          nw_dst = "10.%s.%s.0/255.255.255.0" % (self._id,p))
+
+    add([of.ofp_action_output(port=p) for p in flood_ports],
+        priority = of.OFP_DEFAULT_PRIORITY - 1,
+        nw_dst = "255.255.255.255")
+
+    return rules
+
+
+  def _rewrite_rule (self, ip, mac):
     p = ipinfo(ip)[1]
 
-    msg = of.ofp_flow_mod()
-    msg.match = of.ofp_match()
-    msg.match.dl_type = pkt.ethernet.IP_TYPE
-    msg.match.nw_dst = ip
-    msg.actions.append(of.ofp_action_dl_addr.set_src(self.mac))
-    msg.actions.append(of.ofp_action_dl_addr.set_dst(mac))
-    msg.actions.append(of.ofp_action_output(port=p))
-    self.connection.send(msg)
+    match = of.ofp_match(dl_type = pkt.ethernet.IP_TYPE, nw_dst = ip)
+    actions = [of.ofp_action_dl_addr.set_src(self.mac),
+               of.ofp_action_dl_addr.set_dst(mac),
+               of.ofp_action_output(port=p)]
+    return {(of.OFP_DEFAULT_PRIORITY,match):actions}
+
+
+  def _send_rules (self, rules, remove = False):
+    """
+    Installs rules which differ from what we've installed
+
+    If remove is True, rules is the whole table, and installed rules which
+    aren't in it are removed.  The flow-mods are all sent in one write.
+    """
+    msgs = []
+    if remove:
+      for (priority,match) in self._table.keys():
+        if (priority,match) in rules: continue
+        del self._table[priority,match]
+        msgs.append(of.ofp_flow_mod(command=of.OFPFC_DELETE_STRICT,
+                                    priority=priority, match=match))
+    for (priority,match),actions in rules.iteritems():
+      if self._table.get((priority,match)) == actions: continue
+      self._table[priority,match] = actions
+      msgs.append(of.ofp_flow_mod(priority=priority, match=match,
+                                  actions=actions))
+    if not msgs: return
+    self.log.debug("Sending %i flow-mods", len(msgs))
+    self.connection.send(b''.join(m.pack() for m in msgs))
 
 
   def disconnect (self):
@@ -326,6 +290,12 @@ class TopoSwitch (DHCPD):
     con.send(of.ofp_barrier_request())
     con.send(of.ofp_features_request())
 
+    # Start with an empty table
+    con.send(of.ofp_flow_mod(command=of.OFPFC_DELETE))
+    con.send(of.ofp_barrier_request())
+    self._table.clear()
+    core.openflow_discovery.install_flow(con)
+
     # Some of this is copied from DHCPD's __init__().
     self.send_table()
 
@@ -368,7 +338,8 @@ class TopoSwitch (DHCPD):
     if ip.inNetwork(self.network,"255.255.0.0"):
       if self.ip_to_mac.get(ip) != mac:
         self.ip_to_mac[ip] = mac
-        self._send_rewrite_rule(ip, mac)
+        if self.connection is not None:
+          self._send_rules(self._rewrite_rule(ip, mac))
         return True
     return False
 
@@ -416,17 +387,10 @@ class topo_addressing (object):
     sw1 = switches_by_dpid[l.dpid1]
     sw2 = switches_by_dpid[l.dpid2]
 
-    # Invalidate all flows and path info.
-    # For link adds, this makes sure that if a new link leads to an
-    # improved path, we use it.
-    # For link removals, this makes sure that we don't use a
-    # path that may have been broken.
-    #NOTE: This could be radically improved! (e.g., not *ALL* paths break)
-    clear = of.ofp_flow_mod(command=of.OFPFC_DELETE)
-    for sw in switches_by_dpid.itervalues():
-      if sw.connection is None: continue
-      sw.connection.send(clear)
-    path_map.clear()
+    # Invalidate path info.  Sending the tables below then updates just
+    # the rules this changes (e.g., to use an improved path for link adds,
+    # or to not use a broken one for link removals).
+    next_hops.clear()
 
     if event.removed:
       # This link no longer okay
@@ -434,14 +398,16 @@ class topo_addressing (object):
       if sw1 in adjacency[sw2]: del adjacency[sw2][sw1]
 
       # But maybe there's another way to connect these...
-      for ll in core.openflow_discovery.adjacency:
-        if ll.dpid1 == l.dpid1 and ll.dpid2 == l.dpid2:
-          if flip(ll) in core.openflow_discovery.adjacency:
-            # Yup, link goes both ways
-            adjacency[sw1][sw2] = ll.port1
-            adjacency[sw2][sw1] = ll.port2
-            # Fixed -- new link chosen to connect these
-            break
+      # (The removed link is still there while its event is raised.)
+      links = core.openflow_discovery.adjacency
+      for ll in links.links_between(l.dpid1, l.dpid2):
+        if ll == l: continue
+        if flip(ll) in links:
+          # Yup, link goes both ways
+          adjacency[sw1][sw2] = ll.port1
+          adjacency[sw2][sw1] = ll.port2
+          # Fixed -- new link chosen to connect these
+          break
     else:
       # If we already consider these nodes connected, we can
       # ignore this link up.
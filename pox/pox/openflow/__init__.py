@@ -29,6 +29,9 @@ difficult, really, but that hasn't stopped it from beind handled wrong
 wrong more than once).  In POX, the raw events are available, but you will
 generally just want to listen to the aggregate stats events which take
 care of this for you and are only fired when all data is available.
+If you'd rather not have large replies (e.g., flow stats for big tables)
+buffered, set stream_stats on the nexus; the multipart stats events are then
+fired once per part as it arrives, with .is_last set on the final one.
 
 NOTE: This module is usually automatically loaded by pox.py
 """
@@ -136,11 +139,14 @@ class RawStatsReply (Event):
 class StatsReply (Event):
   """
   Abstract superclass for all stats replies
+
+  is_last (bool) - False if this is a streamed chunk and more will follow
   """
-  def __init__ (self, connection, ofp, stats):
+  def __init__ (self, connection, ofp, stats, is_last=True):
     self.connection = connection
     self.ofp = ofp     # Raw ofp message(s)
     self.stats = stats # Processed
+    self.is_last = is_last
 
   @property
   def dpid (self):
@@ -359,6 +365,9 @@ class OpenFlowNexus (EventMixin):
   # Enable/Disable clearing of flows on switch connect
   clear_flows_on_connect = True
 
+  # Raise multipart stats events per part instead of buffering whole replies
+  stream_stats = False
+
   def __init__ (self):
     self._connections = ConnectionDict() # DPID -> Connection
 
@@ -32,7 +32,9 @@ import pox.lib.packet as pkt
 
 import struct
 import time
-from collections import namedtuple
+import heapq
+import itertools
+from collections import namedtuple, defaultdict
 from random import shuffle, random
 
 
@@ -42,41 +44,55 @@ log = core.getLogger()
 class LLDPSender (object):
   """
   Sends out discovery packets
+
+  Each port's packet is scheduled on a heap by when it's next due.  A
+  port starts out (and goes back to) being probed quickly when it's new,
+  when its status changes, or when a link on it comes or goes.  Each
+  time it's sent, its interval doubles, up to send_cycle_time, so stable
+  ports settle down to being probed once per cycle.  Packets that come
+  due together are sent to each switch in a single write.
   """
 
-  SendItem = namedtuple("LLDPSenderItem", ('dpid','port_num','packet'))
+  class SendItem (object):
+    __slots__ = ('dpid','port_num','packet','interval','seq')
 
-  #NOTE: This class keeps the packets to send in a flat list, which makes
-  #      adding/removing them on switch join/leave or (especially) port
-  #      status changes relatively expensive. Could easily be improved.
+    def __init__ (self, dpid, port_num, packet, interval):
+      self.dpid = dpid
+      self.port_num = port_num
+      self.packet = packet
+      self.interval = interval
+      self.seq = None # Of its live heap entry
 
   # Maximum times to run the timer per second
   _sends_per_sec = 15
 
+  # A port being probed quickly is sent every send_cycle_time / 2**this
+  _backoff_steps = 3
+
   def __init__ (self, send_cycle_time, ttl = 120):
     """
     Initialize an LLDP packet sender
 
     send_cycle_time is the time (in seconds) that this sender will take to
-      send every discovery packet.  Thus, it should be the link timeout
-      interval at most.
+      send every discovery packet once things are stable.  Thus, it should
+      be the link timeout interval at most.
 
     ttl is the time (in seconds) for which a receiving LLDP agent should
       consider the rest of the data to be valid.  We don't use this, but
       other LLDP agents might.  Can't be 0 (this means revoke).
     """
-    # Packets remaining to be sent in this cycle
-    self._this_cycle = []
+    # (dpid,port_num) -> SendItem
+    self._items = {}
 
-    # Packets we've already sent in this cycle
-    self._next_cycle = []
-
-    # Packets to send in a batch
-    self._send_chunk_size = 1
+    # (due time, seq, (dpid,port_num)), possibly stale
+    self._heap = []
+    self._seq = itertools.count()
 
     self._timer = None
+    self._timer_due = None
     self._ttl = ttl
     self._send_cycle_time = send_cycle_time
+    self._fast_interval = send_cycle_time / float(2 ** self._backoff_steps)
     core.listen_to_dependencies(self)
 
   def _handle_openflow_PortStatus (self, event):
@@ -87,6 +103,8 @@ class LLDPSender (object):
       self.add_port(event.dpid, event.port, event.ofp.desc.hw_addr)
     elif event.deleted:
       self.del_port(event.dpid, event.port)
+    else:
+      self.reset_port(event.dpid, event.port)
 
   def _handle_openflow_ConnectionUp (self, event):
     self.del_switch(event.dpid, set_timer = False)
@@ -102,63 +120,94 @@ class LLDPSender (object):
     self.del_switch(event.dpid)
 
   def del_switch (self, dpid, set_timer = True):
-    self._this_cycle = [p for p in self._this_cycle if p.dpid != dpid]
-    self._next_cycle = [p for p in self._next_cycle if p.dpid != dpid]
+    for key in [k for k in self._items if k[0] == dpid]:
+      del self._items[key]
     if set_timer: self._set_timer()
 
   def del_port (self, dpid, port_num, set_timer = True):
     if port_num > of.OFPP_MAX: return
-    self._this_cycle = [p for p in self._this_cycle
-                        if p.dpid != dpid or p.port_num != port_num]
-    self._next_cycle = [p for p in self._next_cycle
-                        if p.dpid != dpid or p.port_num != port_num]
+    self._items.pop((dpid,port_num), None)
     if set_timer: self._set_timer()
 
   def add_port (self, dpid, port_num, port_addr, set_timer = True):
     if port_num > of.OFPP_MAX: return
-    self.del_port(dpid, port_num, set_timer = False)
-    self._next_cycle.append(LLDPSender.SendItem(dpid, port_num,
-          self.create_packet_out(dpid, port_num, port_addr)))
+    item = LLDPSender.SendItem(dpid, port_num,
+          self.create_packet_out(dpid, port_num, port_addr),
+          self._fast_interval)
+    self._items[dpid,port_num] = item
+    # Spread new ports over the fast interval so that a switch connecting
+    # doesn't send everything at once.
+    self._schedule(item, time.time() + random() * self._fast_interval)
     if set_timer: self._set_timer()
 
-  def _set_timer (self):
-    if self._timer: self._timer.cancel()
-    self._timer = None
-    num_packets = len(self._this_cycle) + len(self._next_cycle)
+  def reset_port (self, dpid, port_num, set_timer = True):
+    """
+    Starts probing a port quickly again (e.g., because it changed)
+    """
+    item = self._items.get((dpid,port_num))
+    if item is None: return
+    if item.interval == self._fast_interval: return # Already fast
+    item.interval = self._fast_interval
+    self._schedule(item, time.time() + random() * self._fast_interval)
+    if set_timer: self._set_timer()
 
-    if num_packets == 0: return
+  def _schedule (self, item, due):
+    item.seq = next(self._seq)
+    heapq.heappush(self._heap, (due, item.seq, (item.dpid,item.port_num)))
 
-    self._send_chunk_size = 1 # One at a time
-    interval = self._send_cycle_time / float(num_packets)
-    if interval < 1.0 / self._sends_per_sec:
-      # Would require too many sends per sec -- send more than one at once
-      interval = 1.0 / self._sends_per_sec
-      chunk = float(num_packets) / self._send_cycle_time / self._sends_per_sec
-      self._send_chunk_size = chunk
+  def _next_due (self):
+    """
+    Returns when the next packet is due (or None), dropping stale entries
+    """
+    heap = self._heap
+    while heap:
+      due,seq,key = heap[0]
+      item = self._items.get(key)
+      if item is not None and item.seq == seq: return due
+      heapq.heappop(heap)
+    return None
 
-    self._timer = Timer(interval,
-                        self._timer_handler, recurring=True)
+  def _set_timer (self):
+    """
+    Makes sure the timer goes off when the next packet is due
+    """
+    due = self._next_due()
+    if due is None:
+      if self._timer: self._timer.cancel()
+      self._timer = None
+      self._timer_due = None
+      return
+
+    # Don't run more than _sends_per_sec times per second
+    due = max(due, time.time() + 1.0 / self._sends_per_sec)
+    if self._timer and self._timer_due <= due: return
+    if self._timer: self._timer.cancel()
+    self._timer_due = due
+    self._timer = Timer(due - time.time(), self._timer_handler)
 
   def _timer_handler (self):
     """
     Called by a timer to actually send packets.
 
-    Picks the first packet off this cycle's list, sends it, and then puts
-    it on the next-cycle list.  When this cycle's list is empty, starts
-    the next cycle.
+    Sends every packet which is due, batched per switch, and reschedules
+    each one with its (backed off) interval.
     """
-    num = int(self._send_chunk_size)
-    fpart = self._send_chunk_size - num
-    if random() < fpart: num += 1
+    self._timer = None
+    self._timer_due = None
+    now = time.time()
+    batches = defaultdict(list)
+    while True:
+      due = self._next_due()
+      if due is None or due > now: break
+      item = self._items[heapq.heappop(self._heap)[2]]
+      batches[item.dpid].append(item.packet)
+      item.interval = min(item.interval * 2, self._send_cycle_time)
+      self._schedule(item, now + item.interval)
+
+    for dpid,packets in batches.iteritems():
+      core.openflow.sendToDPID(dpid, b''.join(packets))
 
-    for _ in range(num):
-      if len(self._this_cycle) == 0:
-        self._this_cycle = self._next_cycle
-        self._next_cycle = []
-        #shuffle(self._this_cycle)
-      item = self._this_cycle.pop(0)
-      self._next_cycle.append(item)
-      core.openflow.sendToDPID(item.dpid, item.packet)
+    self._set_timer()
 
   def create_packet_out (self, dpid, port_num, port_addr):
     """
@@ -201,6 +250,50 @@ class LLDPSender (object):
     return eth
 
 
+_LLDP_DST = pkt.ETHERNET.NDP_MULTICAST.toRaw()
+_LLDP_TYPE = struct.pack("!H", pkt.ethernet.LLDP_TYPE)
+
+def _parse_discovery_frame (data):
+  """
+  Quickly gets the originating (dpid, port) from one of our LLDP frames
+
+  This only understands frames laid out exactly like the ones
+  LLDPSender._create_discovery_packet() builds: untagged, with a local
+  chassis ID of "dpid:<hex>", a decimal port ID, a TTL, and a system
+  description repeating the chassis ID.  Anything else (including
+  foreign or truncated LLDP) returns None, and should go through the
+  full parser.
+  """
+  try:
+    if data[0:6] != _LLDP_DST or data[12:14] != _LLDP_TYPE: return None
+
+    h,subtype = struct.unpack_from("!HB", data, 14)
+    if h >> 9 != pkt.lldp.CHASSIS_ID_TLV: return None
+    if subtype != pkt.chassis_id.SUB_LOCAL: return None
+    offset = 16 + (h & 0x1ff)
+    chassis = data[17:offset]
+    if not chassis.startswith('dpid:'): return None
+
+    h,subtype = struct.unpack_from("!HB", data, offset)
+    if h >> 9 != pkt.lldp.PORT_ID_TLV: return None
+    if subtype != pkt.port_id.SUB_PORT: return None
+    port = data[offset+3:offset+2+(h & 0x1ff)]
+    if not port.isdigit(): return None
+    offset += 2 + (h & 0x1ff)
+
+    h, = struct.unpack_from("!H", data, offset)
+    if h != (pkt.lldp.TTL_TLV << 9) | 2: return None
+    offset += 4
+
+    h, = struct.unpack_from("!H", data, offset)
+    if h >> 9 != pkt.lldp.SYSTEM_DESC_TLV: return None
+    if data[offset+2:offset+2+(h & 0x1ff)] != chassis: return None
+
+    return int(chassis[5:], 16), int(port)
+  except (struct.error, ValueError, TypeError):
+    return None
+
+
 class LinkEvent (Event):
   """
   Link up/down event
@@ -244,6 +337,163 @@ class Link (namedtuple("LinkBase",("dpid1","port1","dpid2","port2"))):
         self.port1, self.dpid2, self.port2)
 
 
+class LinkState (object):
+  """
+  The discovered links, with the time each was last seen
+
+  This acts like a dict from Link to timestamp (which is what it replaced),
+  but also keeps the links indexed by switch, by port, and by (directed)
+  switch pair, and keeps a heap for finding expired links.
+
+  generation is incremented whenever a link is added or removed (but not
+  when one is just seen again), so consumers can tell if they need to
+  recompute anything derived from the links.
+  """
+  def __init__ (self):
+    self.generation = 0
+    self._stamps = {} # Link -> timestamp
+    self._by_dpid = defaultdict(set) # dpid -> links to/from it
+    self._by_port = defaultdict(set) # (dpid,port) -> links to/from it
+    self._by_pair = defaultdict(set) # (dpid1,dpid2) -> links from 1 to 2
+    self._heap = [] # (timestamp,seq,link), possibly stale
+    self._heap_seq = {} # Link -> seq of its live heap entry
+    self._seq = itertools.count()
+    self._switch_adjacency = None
+    self._switch_adjacency_generation = None
+
+  def __len__ (self):
+    return len(self._stamps)
+
+  def __iter__ (self):
+    return iter(self._stamps)
+
+  def __contains__ (self, link):
+    return link in self._stamps
+
+  def __getitem__ (self, link):
+    return self._stamps[link]
+
+  def get (self, link, default = None):
+    return self._stamps.get(link, default)
+
+  def iteritems (self):
+    return self._stamps.iteritems()
+
+  def items (self):
+    return self._stamps.items()
+
+  def __setitem__ (self, link, timestamp):
+    """
+    Adds a link or updates when it was last seen
+    """
+    new = link not in self._stamps
+    self._stamps[link] = timestamp
+    if not new: return
+    self.generation += 1
+    self._by_dpid[link.dpid1].add(link)
+    self._by_dpid[link.dpid2].add(link)
+    self._by_port[link.end[0]].add(link)
+    self._by_port[link.end[1]].add(link)
+    self._by_pair[link.dpid1,link.dpid2].add(link)
+    self._push(link, timestamp)
+
+  def _push (self, link, timestamp):
+    seq = next(self._seq)
+    self._heap_seq[link] = seq
+    heapq.heappush(self._heap, (timestamp, seq, link))
+
+  @staticmethod
+  def _unindex (index, key, link):
+    links = index.get(key)
+    if links is None: return
+    links.discard(link)
+    if not links: del index[key]
+
+  def pop (self, link, *default):
+    if link not in self._stamps:
+      if default: return default[0]
+      raise KeyError(link)
+    self.generation += 1
+    self._unindex(self._by_dpid, link.dpid1, link)
+    self._unindex(self._by_dpid, link.dpid2, link)
+    self._unindex(self._by_port, link.end[0], link)
+    self._unindex(self._by_port, link.end[1], link)
+    self._unindex(self._by_pair, (link.dpid1,link.dpid2), link)
+    self._heap_seq.pop(link, None)
+    return self._stamps.pop(link)
+
+  def __delitem__ (self, link):
+    self.pop(link)
+
+  def expire (self, older_than):
+    """
+    Returns links last seen before older_than
+
+    These are no longer tracked for expiration, so the caller should
+    remove them.  Only links which have expired (or whose heap entries
+    are out of date) are looked at.
+    """
+    heap = self._heap
+    expired = []
+    while heap and heap[0][0] < older_than:
+      timestamp,seq,link = heapq.heappop(heap)
+      if self._heap_seq.get(link) != seq: continue # Stale
+      timestamp = self._stamps[link]
+      if timestamp < older_than:
+        del self._heap_seq[link]
+        expired.append(link)
+      else:
+        # Seen since its entry was pushed
+        self._push(link, timestamp)
+    return expired
+
+  def links_for_dpid (self, dpid):
+    """
+    Returns the links to or from a switch
+    """
+    return list(self._by_dpid.get(dpid, ()))
+
+  def links_for_port (self, dpid, port):
+    """
+    Returns the links to or from a switch port
+    """
+    return list(self._by_port.get((dpid,port), ()))
+
+  def links_between (self, dpid1, dpid2):
+    """
+    Returns the links from dpid1 to dpid2
+    """
+    return list(self._by_pair.get((dpid1,dpid2), ()))
+
+  def is_edge_port (self, dpid, port):
+    return (dpid,port) not in self._by_port
+
+  def switch_adjacency (self):
+    """
+    Returns the switches connected by links in both directions
+
+    The result is a dict of dicts where [dpid1][dpid2] is the port on
+    dpid1 leading to dpid2.  When several links connect a pair of
+    switches, the lowest one is used.  The result is shared and kept
+    until the links change, so don't modify it.
+    """
+    if self._switch_adjacency_generation == self.generation:
+      return self._switch_adjacency
+    adj = defaultdict(dict)
+    for (dpid1,dpid2),links in self._by_pair.iteritems():
+      if dpid1 >= dpid2: continue
+      back = self._by_pair.get((dpid2,dpid1))
+      if not back: continue
+      for l in sorted(links):
+        if (l.dpid2,l.port2,l.dpid1,l.port1) in back:
+          adj[dpid1][dpid2] = l.port1
+          adj[dpid2][dpid1] = l.port2
+          break
+    self._switch_adjacency = dict(adj)
+    self._switch_adjacency_generation = self.generation
+    return self._switch_adjacency
+
+
 class Discovery (EventMixin):
   """
   Component that attempts to discover network toplogy.
@@ -270,7 +520,7 @@ class Discovery (EventMixin):
     self._install_flow = install_flow
     if link_timeout: self._link_timeout = link_timeout
 
-    self.adjacency = {} # From Link to time.time() stamp
+    self.adjacency = LinkState() # From Link to time.time() stamp
     self._sender = LLDPSender(self.send_cycle_time)
 
     # Listen with a high priority (mostly so we get PacketIns early)
@@ -311,9 +561,7 @@ class Discovery (EventMixin):
 
   def _handle_openflow_ConnectionDown (self, event):
     # Delete all links on this switch
-    self._delete_links([link for link in self.adjacency
-                        if link.dpid1 == event.dpid
-                        or link.dpid2 == event.dpid])
+    self._delete_links(self.adjacency.links_for_dpid(event.dpid))
 
   def _expire_links (self):
     """
@@ -321,8 +569,7 @@ class Discovery (EventMixin):
     """
     now = time.time()
 
-    expired = [link for link,timestamp in self.adjacency.iteritems()
-               if timestamp + self._link_timeout < now]
+    expired = self.adjacency.expire(now - self._link_timeout)
     if expired:
       for link in expired:
         log.info('link timeout: %s', link)
@@ -334,16 +581,20 @@ class Discovery (EventMixin):
     Receive and process LLDP packets
     """
 
-    packet = event.parsed
+    # Our own discovery packets can be picked apart without parsing
+    fast = _parse_discovery_frame(event.data)
 
-    if (packet.effective_ethertype != pkt.ethernet.LLDP_TYPE
-        or packet.dst != pkt.ETHERNET.NDP_MULTICAST):
-      if not self._eat_early_packets: return
-      if not event.connection.connect_time: return
-      enable_time = time.time() - self.send_cycle_time - 1
-      if event.connection.connect_time > enable_time:
-        return EventHalt
-      return
+    if fast is None:
+      packet = event.parsed
+
+      if (packet.effective_ethertype != pkt.ethernet.LLDP_TYPE
+          or packet.dst != pkt.ETHERNET.NDP_MULTICAST):
+        if not self._eat_early_packets: return
+        if not event.connection.connect_time: return
+        enable_time = time.time() - self.send_cycle_time - 1
+        if event.connection.connect_time > enable_time:
+          return EventHalt
+        return
 
     if self._explicit_drop:
       if event.ofp.buffer_id is not None:
@@ -353,22 +604,55 @@ class Discovery (EventMixin):
         msg.in_port = event.port
         event.connection.send(msg)
 
+    if fast is not None:
+      originatorDPID, originatorPort = fast
+    else:
+      r = self._parse_lldp(packet)
+      if r is None: return EventHalt
+      originatorDPID, originatorPort = r
+
+    if originatorDPID not in core.openflow.connections:
+      log.info('Received LLDP packet from unknown switch')
+      return EventHalt
+
+    if (event.dpid, event.port) == (originatorDPID, originatorPort):
+      log.warning("Port received its own LLDP packet; ignoring")
+      return EventHalt
+
+    link = Discovery.Link(originatorDPID, originatorPort, event.dpid,
+                          event.port)
+
+    if link not in self.adjacency:
+      self.adjacency[link] = time.time()
+      log.info('link detected: %s', link)
+      self._reset_link_ports(link)
+      self.raiseEventNoErrors(LinkEvent, True, link, event)
+    else:
+      # Just update timestamp
+      self.adjacency[link] = time.time()
+
+    return EventHalt # Probably nobody else needs this event
+
+  def _parse_lldp (self, packet):
+    """
+    Gets the originating (dpid, port) from any LLDP packet (or None)
+    """
     lldph = packet.find(pkt.lldp)
     if lldph is None or not lldph.parsed:
       log.error("LLDP packet could not be parsed")
-      return EventHalt
+      return None
     if len(lldph.tlvs) < 3:
       log.error("LLDP packet without required three TLVs")
-      return EventHalt
+      return None
     if lldph.tlvs[0].tlv_type != pkt.lldp.CHASSIS_ID_TLV:
       log.error("LLDP packet TLV 1 not CHASSIS_ID")
-      return EventHalt
+      return None
     if lldph.tlvs[1].tlv_type != pkt.lldp.PORT_ID_TLV:
       log.error("LLDP packet TLV 2 not PORT_ID")
-      return EventHalt
+      return None
     if lldph.tlvs[2].tlv_type != pkt.lldp.TTL_TLV:
       log.error("LLDP packet TLV 3 not TTL")
-      return EventHalt
+      return None
 
     def lookInSysDesc ():
       r = None
@@ -414,16 +698,12 @@ class Discovery (EventMixin):
 
     if originatorDPID == None:
       log.warning("Couldn't find a DPID in the LLDP packet")
-      return EventHalt
-
-    if originatorDPID not in core.openflow.connections:
-      log.info('Received LLDP packet from unknown switch')
-      return EventHalt
+      return None
 
     # Get port number from port TLV
     if lldph.tlvs[1].subtype != pkt.port_id.SUB_PORT:
       log.warning("Thought we found a DPID, but packet didn't have a port")
-      return EventHalt
+      return None
     originatorPort = None
     if lldph.tlvs[1].id.isdigit():
       # We expect it to be a decimal value
@@ -437,41 +717,29 @@ class Discovery (EventMixin):
     if originatorPort is None:
       log.warning("Thought we found a DPID, but port number didn't " +
                   "make sense")
-      return EventHalt
-
-    if (event.dpid, event.port) == (originatorDPID, originatorPort):
-      log.warning("Port received its own LLDP packet; ignoring")
-      return EventHalt
+      return None
 
-    link = Discovery.Link(originatorDPID, originatorPort, event.dpid,
-                          event.port)
-
-    if link not in self.adjacency:
-      self.adjacency[link] = time.time()
-      log.info('link detected: %s', link)
-      self.raiseEventNoErrors(LinkEvent, True, link, event)
-    else:
-      # Just update timestamp
-      self.adjacency[link] = time.time()
-
-    return EventHalt # Probably nobody else needs this event
+    return originatorDPID, originatorPort
 
   def _delete_links (self, links):
     for link in links:
       self.raiseEventNoErrors(LinkEvent, False, link)
     for link in links:
       self.adjacency.pop(link, None)
+      self._reset_link_ports(link)
+
+  def _reset_link_ports (self, link):
+    """
+    Probes the ends of a changed link quickly until things settle down
+    """
+    for dpid,port in link.end:
+      self._sender.reset_port(dpid, port)
 
   def is_edge_port (self, dpid, port):
     """
     Return True if given port does not connect to another switch
     """
-    for link in self.adjacency:
-      if link.dpid1 == dpid and link.port1 == port:
-        return False
-      if link.dpid2 == dpid and link.port2 == port:
-        return False
-    return True
+    return self.adjacency.is_edge_port(dpid, port)
 
 
 def launch (no_flow = False, explicit_drop = True, link_timeout = None,
@@ -21,6 +21,9 @@ from pox.lib.revent import *
 
 import time
 import math
+import bisect
+import heapq
+from operator import itemgetter
 
 # FlowTable Entries:
 #   match - ofp_match (13-tuple)
@@ -99,16 +102,17 @@ class TableEntry (object):
     else:
       return port_matches and match.matches_with_wildcards(self.match)
 
-  def touch_packet (self, byte_count, now=None):
+  def touch_packet (self, byte_count, now=None, packet_count=1):
     """
     Updates information of this entry based on encountering a packet.
 
     Updates both the cumulative given byte counts of packets encountered and
-    the expiration timer.
+    the expiration timer.  If several packets are being accounted for at
+    once, byte_count is their total and packet_count is how many there were.
     """
     if now is None: now = time.time()
     self.byte_count += byte_count
-    self.packet_count += 1
+    self.packet_count += packet_count
     self.last_touched = now
 
   def is_idle_timed_out (self, now=None):
@@ -125,6 +129,21 @@ class TableEntry (object):
         return True
     return False
 
+  @property
+  def expiration_time (self):
+    """
+    The time after which this entry is expired unless it's touched again
+
+    None if the entry has no timeouts.
+    """
+    t = None
+    if self.idle_timeout > 0:
+      t = self.last_touched + self.idle_timeout
+    if self.hard_timeout > 0:
+      hard = self.created + self.hard_timeout
+      if t is None or hard < t: t = hard
+    return t
+
   def is_expired (self, now=None):
     """
     Tests whether this flow entry is expired due to its idle or hard timeout
@@ -192,12 +211,146 @@ class FlowTableModification (Event):
     self.reason = reason
 
 
+# Fields in the order they appear in ofp_match.key (after the wildcards)
+_KEY_FIELDS = ('in_port', 'dl_src', 'dl_dst', 'dl_vlan', 'dl_vlan_pcp',
+               'dl_type', 'nw_tos', 'nw_proto', 'nw_src', 'nw_dst',
+               'tp_src', 'tp_dst')
+_NW_SRC = 9 # Index of nw_src in ofp_match.key
+_NW_DST = 10
+
+def _ip_to_int (addr):
+  if addr is None: return None
+  if isinstance(addr, (int,long)): return addr & 0xffFFffFF
+  return addr.toUnsigned()
+
+def _prefix_mask (wildcard_bits):
+  """
+  Returns the netmask for a nw_src/nw_dst wildcard count (None if all)
+  """
+  if wildcard_bits >= 32: return None
+  return (0xffFFffFF << wildcard_bits) & 0xffFFffFF
+
+
+class _SubTable (object):
+  """
+  One hash table of FlowTable's tuple space search classifier
+
+  Holds all the entries which have the same wildcards.  They're hashed on
+  the values of the fields they don't wildcard (with nw_src and nw_dst
+  masked to their prefix lengths), so the entry matching a packet is
+  found with one lookup.  Each bucket is a list of
+  (-effective_priority, -sequence_number, entry) kept sorted, so its
+  first item is the one that wins.
+  """
+  def __init__ (self, wildcards):
+    self.wildcards = wildcards
+    self.buckets = {}
+    self.priorities = {} # effective_priority -> number of entries
+    self.max_priority = -1
+
+    idx = [i + 1 for i,f in enumerate(_KEY_FIELDS)
+           if f not in ('nw_src', 'nw_dst')
+           and not (wildcards & ofp_match_data[f][1])]
+    if idx:
+      self._get_fields = itemgetter(*idx)
+    else:
+      self._get_fields = lambda key: None
+    self._src_mask = _prefix_mask(
+        (wildcards & OFPFW_NW_SRC_MASK) >> OFPFW_NW_SRC_SHIFT)
+    self._dst_mask = _prefix_mask(
+        (wildcards & OFPFW_NW_DST_MASK) >> OFPFW_NW_DST_SHIFT)
+
+  def lookup_key (self, key, nw_src, nw_dst):
+    """
+    Returns the bucket key for an ofp_match.key
+
+    nw_src and nw_dst are the match's addresses as ints (or None).
+    """
+    src_mask = self._src_mask
+    dst_mask = self._dst_mask
+    return (self._get_fields(key),
+            None if src_mask is None or nw_src is None else nw_src & src_mask,
+            None if dst_mask is None or nw_dst is None else nw_dst & dst_mask)
+
+  def entry_key (self, match):
+    """
+    Returns the bucket key for an entry's (or a query's) match
+    """
+    key = match.key
+    if ((key[2] is not None and type(key[2]) is not EthAddr) or
+        (key[3] is not None and type(key[3]) is not EthAddr)):
+      # Normalize so that they hash the same as packets' addresses
+      key = list(key)
+      for i in (2, 3):
+        if key[i] is not None: key[i] = EthAddr(key[i])
+      key = tuple(key)
+    return self.lookup_key(key, _ip_to_int(key[_NW_SRC]),
+                           _ip_to_int(key[_NW_DST]))
+
+  def is_covered_by (self, match):
+    """
+    Could entries here be matched (non-strictly) by the given match?
+
+    This is the part of ofp_match.matches_with_wildcards() which only
+    depends on the wildcards: our entries must wildcard no more fields
+    than the match does, and have prefixes at least as long as its.
+    """
+    nw_bits = OFPFW_NW_SRC_MASK | OFPFW_NW_DST_MASK
+    other = match.wildcards
+    if self.wildcards & ~other & ~nw_bits: return False
+    for mask,shift in ((OFPFW_NW_SRC_MASK, OFPFW_NW_SRC_SHIFT),
+                       (OFPFW_NW_DST_MASK, OFPFW_NW_DST_SHIFT)):
+      other_bits = (other & mask) >> shift
+      if other_bits < 32 and other_bits < (self.wildcards & mask) >> shift:
+        return False
+    return True
+
+  def add (self, bucket_key, item):
+    """
+    Adds an item, returning True if max_priority changed
+    """
+    bucket = self.buckets.get(bucket_key)
+    if bucket is None:
+      self.buckets[bucket_key] = [item]
+    else:
+      bisect.insort(bucket, item)
+    priority = -item[0]
+    self.priorities[priority] = self.priorities.get(priority, 0) + 1
+    if priority > self.max_priority:
+      self.max_priority = priority
+      return True
+    return False
+
+  def remove (self, bucket_key, item):
+    """
+    Removes an item, returning True if max_priority changed
+    """
+    bucket = self.buckets[bucket_key]
+    bucket.remove(item)
+    if not bucket: del self.buckets[bucket_key]
+    priority = -item[0]
+    count = self.priorities[priority] - 1
+    if count:
+      self.priorities[priority] = count
+      return False
+    del self.priorities[priority]
+    if priority != self.max_priority: return False
+    self.max_priority = max(self.priorities) if self.priorities else -1
+    return True
+
+
 class FlowTable (EventMixin):
   """
   General model of a flow table.
 
   Maintains an ordered list of flow entries, and finds matching entries for
   packets and other entries. Supports expiration of flows.
+
+  Entries are additionally indexed by a tuple space search classifier: a
+  hash table per distinct set of wildcards (see _SubTable).  Finding the
+  entry for a packet is a lookup in each of those (in order of their
+  highest priority, stopping once no remaining one could do better)
+  rather than a scan of the whole table.
   """
   _eventMixin_events = set([FlowTableModification])
 
@@ -207,6 +360,22 @@ class FlowTable (EventMixin):
     # Table is a list of TableEntry sorted by descending effective_priority.
     self._table = []
 
+    # Classifier.  Wildcards -> _SubTable
+    self._subtables = {}
+    # The _SubTables sorted by descending max_priority (None if stale)
+    self._subtable_order = None
+    # TableEntry -> (_SubTable, bucket key, bucket item)
+    self._entry_info = {}
+    # Increases with each added entry, to break priority ties
+    self._next_seq = 0
+
+    # Heap of (expiration_time, tag, entry) for entries with timeouts.
+    # expiration_time may be stale (too early) if the entry has been
+    # touched since; it's fixed up when it comes off the heap.  tag is the
+    # entry's (negated) sequence number, so items for entries which have
+    # since been removed can be told apart and skipped.
+    self._expirations = []
+
   def _dirty (self):
     """
     Call when table changes
@@ -220,6 +389,100 @@ class FlowTable (EventMixin):
   def __len__ (self):
     return len(self._table)
 
+  def _index_entry (self, entry):
+    """
+    Adds a newly inserted entry to the classifier
+    """
+    wildcards = entry.match.wildcards & OFPFW_ALL
+    subtable = self._subtables.get(wildcards)
+    if subtable is None:
+      subtable = _SubTable(wildcards)
+      self._subtables[wildcards] = subtable
+      self._subtable_order = None
+    # Newer entries win priority ties, so they get lower (negated) numbers
+    self._next_seq += 1
+    item = (-entry.effective_priority, -self._next_seq, entry)
+    bucket_key = subtable.entry_key(entry.match)
+    if subtable.add(bucket_key, item):
+      self._subtable_order = None
+    self._entry_info[entry] = (subtable, bucket_key, item)
+
+    when = entry.expiration_time
+    if when is not None:
+      heapq.heappush(self._expirations, (when, item[1], entry))
+
+  def _unindex_entry (self, entry):
+    """
+    Removes an entry from the classifier
+    """
+    subtable, bucket_key, item = self._entry_info.pop(entry)
+    if subtable.remove(bucket_key, item):
+      self._subtable_order = None
+    if not subtable.buckets:
+      del self._subtables[subtable.wildcards]
+      self._subtable_order = None
+
+    if len(self._expirations) > 2 * len(self._entry_info) + 64:
+      # Mostly items for removed entries; clear them out
+      self._expirations = [x for x in self._expirations
+                           if self._is_scheduled(x)]
+      heapq.heapify(self._expirations)
+
+  def _is_scheduled (self, expiration):
+    """
+    Is the given _expirations item for an entry which is still in the table?
+    """
+    info = self._entry_info.get(expiration[2])
+    return info is not None and info[2][1] == expiration[1]
+
+  def _first_index_of_priority (self, priority):
+    """
+    Binary search for the first entry with the given effective_priority
+    """
+    table = self._table
+    low = 0
+    high = len(table)
+    while low < high:
+      middle = (low + high) // 2
+      if table[middle].effective_priority > priority:
+        low = middle + 1
+        continue
+      high = middle
+    return low
+
+  def _index_of (self, entry):
+    """
+    Binary search for an entry's position in the table
+
+    The table is in the order of the entries' classifier items (descending
+    effective_priority, then newest first), so the entry's item locates it
+    exactly -- even among the many entries sharing a priority (e.g., all
+    exact matches).
+    """
+    info = self._entry_info.get(entry)
+    if info is None: raise ValueError("entry not in table")
+    key = info[2][:2]
+    entry_info = self._entry_info
+    table = self._table
+    low = 0
+    high = len(table)
+    while low < high:
+      middle = (low + high) // 2
+      if entry_info[table[middle]][2][:2] < key:
+        low = middle + 1
+        continue
+      high = middle
+    if low == len(table) or table[low] is not entry:
+      raise ValueError("entry not in table")
+    return low
+
+  def _ordered_subtables (self):
+    if self._subtable_order is None:
+      self._subtable_order = sorted(self._subtables.itervalues(),
+                                    key=lambda st: st.max_priority,
+                                    reverse=True)
+    return self._subtable_order
+
   def add_entry (self, entry):
     assert isinstance(entry, TableEntry)
 
@@ -240,6 +503,7 @@ class FlowTable (EventMixin):
           continue
         low = middle + 1
     table.insert(low, entry)
+    self._index_entry(entry)
 
     self._dirty()
 
@@ -247,13 +511,37 @@ class FlowTable (EventMixin):
 
   def remove_entry (self, entry, reason=None):
     assert isinstance(entry, TableEntry)
-    self._table.remove(entry)
+    del self._table[self._index_of(entry)]
+    self._unindex_entry(entry)
     self._dirty()
     self.raiseEvent(FlowTableModification(removed=[entry], reason=reason))
 
   def matching_entries (self, match, priority=0, strict=False, out_port=None):
+    """
+    Returns the entries matched by the given match, in table order
+    """
     entry_match = lambda e: e.is_matched_by(match, priority, strict, out_port)
-    return [ entry for entry in self._table if entry_match(entry) ]
+    wildcards = match.wildcards & OFPFW_ALL
+
+    if strict:
+      # Only entries with exactly this match qualify
+      subtable = self._subtables.get(wildcards)
+      if subtable is None: return []
+      bucket = subtable.buckets.get(subtable.entry_key(match), ())
+      return [ item[2] for item in bucket if entry_match(item[2]) ]
+
+    items = []
+    for subtable in self._subtables.itervalues():
+      if not subtable.is_covered_by(match): continue
+      if subtable.wildcards == wildcards:
+        # Same fields as the match, so only one bucket can match
+        buckets = [subtable.buckets.get(subtable.entry_key(match), ())]
+      else:
+        buckets = subtable.buckets.itervalues()
+      for bucket in buckets:
+        items.extend(item for item in bucket if entry_match(item[2]))
+    items.sort()
+    return [ item[2] for item in items ]
 
   def flow_stats (self, match, out_port=None, now=None):
     mc_es = self.matching_entries(match=match, strict=False, out_port=out_port)
@@ -273,33 +561,47 @@ class FlowTable (EventMixin):
                                flow_count=flow_count)
 
   def _remove_specific_entries (self, flows, reason=None):
-    #for entry in flows:
-    #  self._table.remove(entry)
-    #self._table = [entry for entry in self._table if entry not in flows]
     if not flows: return
     self._dirty()
-    remove_flows = set(flows)
-    i = 0
-    while i < len(self._table):
-      entry = self._table[i]
-      if entry in remove_flows:
-        del self._table[i]
-        remove_flows.remove(entry)
-        if not remove_flows: break
-      else:
-        i += 1
-    assert len(remove_flows) == 0
+    table = self._table
+    if len(flows) * 16 < len(table):
+      # Few enough that finding each one beats a pass over the table
+      for entry in flows:
+        del table[self._index_of(entry)]
+    else:
+      remove_flows = set(flows)
+      old_len = len(table)
+      table[:] = [entry for entry in table if entry not in remove_flows]
+      assert old_len - len(table) == len(remove_flows)
+    for entry in flows:
+      self._unindex_entry(entry)
     self.raiseEvent(FlowTableModification(removed=flows, reason=reason))
 
   def remove_expired_entries (self, now=None):
+    """
+    Removes entries whose idle or hard timeouts have passed
+
+    Only entries whose (possibly stale) expiration time has passed are
+    looked at.  Ones which turn out to have been touched in the meantime
+    are rescheduled.
+    """
     idle = []
     hard = []
+    touched = []
     if now is None: now = time.time()
-    for entry in self._table:
+    heap = self._expirations
+    while heap and heap[0][0] < now:
+      expiration = heapq.heappop(heap)
+      if not self._is_scheduled(expiration): continue
+      entry = expiration[2]
       if entry.is_idle_timed_out(now):
         idle.append(entry)
       elif entry.is_hard_timed_out(now):
         hard.append(entry)
+      else:
+        touched.append(expiration)
+    for when,tag,entry in touched:
+      heapq.heappush(heap, (entry.expiration_time, tag, entry))
     self._remove_specific_entries(idle, OFPRR_IDLE_TIMEOUT)
     self._remove_specific_entries(hard, OFPRR_HARD_TIMEOUT)
 
@@ -317,13 +619,68 @@ class FlowTable (EventMixin):
     on the given in_port, or None if no matching entry is found.
     """
     packet_match = ofp_match.from_packet(packet, in_port, spec_frags = True)
+    return self.entry_for_match(packet_match)
+
+  def entry_for_match (self, packet_match):
+    """
+    Finds the flow table entry for a packet, given the packet's exact match
 
-    for entry in self._table:
-      if entry.match.matches_with_wildcards(packet_match,
-                                            consider_other_wildcards=False):
-        return entry
+    This is like entry_for_packet(), but for when the caller already has
+    the result of ofp_match.from_packet().
+    """
+    key = packet_match.key
+    nw_src = _ip_to_int(key[_NW_SRC])
+    nw_dst = _ip_to_int(key[_NW_DST])
+
+    best = None
+    for subtable in self._ordered_subtables():
+      # Stop once no remaining subtable can beat (or tie) what we have
+      if best is not None and -best[0] > subtable.max_priority: break
+      bucket = subtable.buckets.get(subtable.lookup_key(key, nw_src, nw_dst))
+      if bucket is not None:
+        item = bucket[0]
+        if best is None or item < best:
+          best = item
+
+    return None if best is None else best[2]
+
+  def entry_and_wildcards_for_match (self, packet_match):
+    """
+    Like entry_for_match(), but also says which fields the result depends on
 
-    return None
+    Returns (entry, wildcards), where wildcards has the OFPFW_xxx bits set
+    for the fields which weren't looked at (and nw_src/nw_dst wildcard
+    counts for the address bits which weren't).  Any packet which agrees
+    with this one on the remaining fields gets the same entry, until the
+    table is next modified.
+    """
+    key = packet_match.key
+    nw_src = _ip_to_int(key[_NW_SRC])
+    nw_dst = _ip_to_int(key[_NW_DST])
+
+    nw_bits = OFPFW_NW_SRC_MASK | OFPFW_NW_DST_MASK
+    wildcards = OFPFW_ALL & ~nw_bits
+    src_bits = OFPFW_NW_SRC_ALL >> OFPFW_NW_SRC_SHIFT
+    dst_bits = OFPFW_NW_DST_ALL >> OFPFW_NW_DST_SHIFT
+
+    best = None
+    for subtable in self._ordered_subtables():
+      if best is not None and -best[0] > subtable.max_priority: break
+      sub_wildcards = subtable.wildcards
+      wildcards &= sub_wildcards | nw_bits
+      src_bits = min(src_bits,
+          (sub_wildcards & OFPFW_NW_SRC_MASK) >> OFPFW_NW_SRC_SHIFT)
+      dst_bits = min(dst_bits,
+          (sub_wildcards & OFPFW_NW_DST_MASK) >> OFPFW_NW_DST_SHIFT)
+      bucket = subtable.buckets.get(subtable.lookup_key(key, nw_src, nw_dst))
+      if bucket is not None:
+        item = bucket[0]
+        if best is None or item < best:
+          best = item
+
+    wildcards |= src_bits << OFPFW_NW_SRC_SHIFT
+    wildcards |= dst_bits << OFPFW_NW_DST_SHIFT
+    return (None if best is None else best[2]), wildcards
 
   def check_for_overlapping_entry (self, in_entry):
     """
@@ -336,18 +693,100 @@ class FlowTable (EventMixin):
     #NOTE: Ambiguous whether matching should be based on effective_priority
     #      or the regular priority.  Doing it based on effective_priority
     #      since that's what actually affects packet matching.
-    #NOTE: We could improve performance by doing a binary search to find the
-    #      right priority entries.
 
     priority = in_entry.effective_priority
+    table = self._table
 
-    for e in self._table:
-      if e.effective_priority < priority:
+    for i in xrange(self._first_index_of_priority(priority), len(table)):
+      e = table[i]
+      if e.effective_priority != priority:
         break
-      elif e.effective_priority > priority:
-        continue
-      else:
-        if e.is_matched_by(in_entry.match) or in_entry.is_matched_by(e.match):
-          return True
+      if e.is_matched_by(in_entry.match) or in_entry.is_matched_by(e.match):
+        return True
 
     return False
+
+
+_MISSING = object()
+
+class FlowCache (object):
+  """
+  A two-level cache of FlowTable lookups, like Open vSwitch's datapath
+
+  The microflow level is an exact-match cache keyed on the packet's
+  ofp_match key.  The megaflow level caches each lookup result for all the
+  packets which agree on the fields the lookup actually examined (see
+  FlowTable.entry_and_wildcards_for_match()), so that, e.g., new flows
+  hitting a wildcarded entry usually don't need a full lookup either.
+
+  Results (including misses) are cached as table entries rather than
+  actions, so modifying an entry's actions or updating its counters works
+  as usual.  Both levels are flushed whenever the table raises a
+  FlowTableModification, and each is flushed when it gets full.
+  """
+  def __init__ (self, max_microflows=4096, max_megaflows=1024):
+    self.max_microflows = max_microflows
+    self.max_megaflows = max_megaflows
+    self._table = None
+    self._listener = None
+    self._microflows = {} # match key -> entry
+    self._megaflows = {} # wildcards -> (_SubTable, {bucket key -> entry})
+    self._megaflow_count = 0
+
+    self.hits = 0
+    self.megaflow_hits = 0
+    self.misses = 0
+
+  def flush (self):
+    self._microflows.clear()
+    self._megaflows.clear()
+    self._megaflow_count = 0
+
+  def _handle_FlowTableModification (self, event):
+    self.flush()
+
+  def _set_table (self, table):
+    if self._table is not None:
+      self._table.removeListener(self._listener)
+    self.flush()
+    self._table = table
+    self._listener = table.addListener(FlowTableModification,
+                                       self._handle_FlowTableModification,
+                                       weak=True)
+
+  def entry_for_match (self, table, packet_match):
+    """
+    Returns table.entry_for_match(packet_match), using the cache if possible
+    """
+    if table is not self._table: self._set_table(table)
+
+    key = packet_match.key
+    entry = self._microflows.get(key, _MISSING)
+    if entry is not _MISSING:
+      self.hits += 1
+      return entry
+
+    nw_src = _ip_to_int(key[_NW_SRC])
+    nw_dst = _ip_to_int(key[_NW_DST])
+    for masker,flows in self._megaflows.itervalues():
+      entry = flows.get(masker.lookup_key(key, nw_src, nw_dst), _MISSING)
+      if entry is not _MISSING:
+        self.megaflow_hits += 1
+        break
+    else:
+      self.misses += 1
+      entry,wildcards = table.entry_and_wildcards_for_match(packet_match)
+      if self._megaflow_count >= self.max_megaflows:
+        self._megaflows.clear()
+        self._megaflow_count = 0
+      megaflow = self._megaflows.get(wildcards)
+      if megaflow is None:
+        # We only use the _SubTable for its lookup_key()
+        megaflow = self._megaflows[wildcards] = (_SubTable(wildcards), {})
+      megaflow[1][megaflow[0].lookup_key(key, nw_src, nw_dst)] = entry
+      self._megaflow_count += 1
+
+    if len(self._microflows) >= self.max_microflows:
+      self._microflows.clear()
+    self._microflows[key] = entry
+    return entry
@@ -1105,6 +1105,9 @@ class ofp_match (ofp_base):
     if self._locked:
       raise AttributeError('match object is locked')
 
+    # Any change to a field or to the wildcards invalidates the cached key
+    self.__dict__['_key'] = None
+
     if name not in ofp_match_data:
       self.__dict__[name] = value
       return
@@ -1352,6 +1355,25 @@ class ofp_match (ofp_base):
   def __len__ ():
     return 40
 
+  @property
+  def key (self):
+    """
+    A canonical, immutable key for this match
+
+    This is a tuple of the wildcards followed by the (effective) value of
+    every field, with wildcarded fields as None.  Two matches are equal
+    exactly when their keys are equal, so the key can be used in place of
+    the match itself for dict lookups and comparisons.  It's computed on
+    demand and cached until the match is next modified.
+    """
+    k = self.__dict__.get('_key')
+    if k is None:
+      k = (self.wildcards, self.in_port, self.dl_src, self.dl_dst,
+           self.dl_vlan, self.dl_vlan_pcp, self.dl_type, self.nw_tos,
+           self.nw_proto, self.nw_src, self.nw_dst, self.tp_src, self.tp_dst)
+      self.__dict__['_key'] = k
+    return k
+
   def hash_code (self):
     """
     generate a hash value for this match
@@ -1359,22 +1381,12 @@ class ofp_match (ofp_base):
     This generates a hash code which might be useful, but without locking
     the match object.
     """
-
-    h = self.wildcards
-    for f in ofp_match_data:
-      v = getattr(self, f)
-      if type(v) is int:
-        h ^= v
-      elif type(v) is long:
-        h ^= v
-      else:
-        h ^= hash(v)
-
-    return int(h & 0x7fFFffFF)
+    return hash(self.key) & 0x7fFFffFF
 
   def __hash__ (self):
-    self._locked = True
-    return self.hash_code()
+    if not self._locked:
+      self._locked = True
+    return hash(self.key)
 
   def matches_with_wildcards (self, other, consider_other_wildcards=True):
     """
@@ -1436,20 +1448,7 @@ class ofp_match (ofp_base):
 
   def __eq__ (self, other):
     if type(self) != type(other): return False
-    if self.wildcards != other.wildcards: return False
-    if self.in_port != other.in_port: return False
-    if self.dl_src != other.dl_src: return False
-    if self.dl_dst != other.dl_dst: return False
-    if self.dl_vlan != other.dl_vlan: return False
-    if self.dl_vlan_pcp != other.dl_vlan_pcp: return False
-    if self.dl_type != other.dl_type: return False
-    if self.nw_tos != other.nw_tos: return False
-    if self.nw_proto != other.nw_proto: return False
-    if self.nw_src != other.nw_src: return False
-    if self.nw_dst != other.nw_dst: return False
-    if self.tp_src != other.tp_src: return False
-    if self.tp_dst != other.tp_dst: return False
-    return True
+    return self.key == other.key
 
   def __str__ (self):
     return self.__class__.__name__ + "\n  " + self.show('  ').strip()
@@ -58,57 +58,82 @@ import pox.openflow.libopenflow_01 as of
 import threading
 import os
 import sys
+from collections import defaultdict
 from errno import EAGAIN, ECONNRESET, EADDRINUSE, EADDRNOTAVAIL, EMFILE
 
 
 import traceback
 
 
+def _has_listeners (source, eventType):
+  """
+  Checks whether anything is listening for eventType on source
+
+  This peeks at revent's handler table.  Something that has never had a
+  listener added doesn't have one at all.
+  """
+  handlers = getattr(source, '_eventMixin_handlers', None)
+  return bool(handlers and handlers.get(eventType))
+
+def _raise_event (con, eventType, *args):
+  """
+  Raises an event on the nexus and then, unless halted, on the connection
+
+  This is the fast path for high-rate events.  If nobody is listening on
+  either, the event isn't even created.  Otherwise it's created just once
+  and the same instance is raised on both (which also means, e.g., that a
+  PacketIn is only parsed once).  Its source and halt are reset before it's
+  raised on the connection, so listeners there see them as they would for
+  a fresh event -- but anything else the nexus's listeners set on it is
+  still there.
+  """
+  nexus = con.ofnexus
+  to_nexus = _has_listeners(nexus, eventType)
+  to_con = _has_listeners(con, eventType)
+  if not (to_nexus or to_con): return None
+  e = eventType(*args)
+  if to_nexus:
+    nexus.raiseEventNoErrors(e)
+    if e.halt == True: return e
+    e.source = None
+    e.halt = False
+  if to_con:
+    con.raiseEventNoErrors(e)
+  return e
+
+
 # handlers for stats replies
 def handle_OFPST_DESC (con, parts):
   msg = parts[0].body
-  e = con.ofnexus.raiseEventNoErrors(SwitchDescReceived,con,parts[0],msg)
-  if e is None or e.halt != True:
-    con.raiseEventNoErrors(SwitchDescReceived, con, parts[0], msg)
+  _raise_event(con, SwitchDescReceived, con, parts[0], msg)
 
-def handle_OFPST_FLOW (con, parts):
+def handle_OFPST_FLOW (con, parts, is_last=True):
   msg = []
   for part in parts:
     msg.extend(part.body)
-  e = con.ofnexus.raiseEventNoErrors(FlowStatsReceived, con, parts, msg)
-  if e is None or e.halt != True:
-    con.raiseEventNoErrors(FlowStatsReceived, con, parts, msg)
+  _raise_event(con, FlowStatsReceived, con, parts, msg, is_last)
 
 def handle_OFPST_AGGREGATE (con, parts):
   msg = parts[0].body
-  e = con.ofnexus.raiseEventNoErrors(AggregateFlowStatsReceived, con,
-                                     parts[0], msg)
-  if e is None or e.halt != True:
-    con.raiseEventNoErrors(AggregateFlowStatsReceived, con, parts[0], msg)
+  _raise_event(con, AggregateFlowStatsReceived, con, parts[0], msg)
 
-def handle_OFPST_TABLE (con, parts):
+def handle_OFPST_TABLE (con, parts, is_last=True):
   msg = []
   for part in parts:
     msg.extend(part.body)
-  e = con.ofnexus.raiseEventNoErrors(TableStatsReceived, con, parts, msg)
-  if e is None or e.halt != True:
-    con.raiseEventNoErrors(TableStatsReceived, con, parts, msg)
+  _raise_event(con, TableStatsReceived, con, parts, msg, is_last)
 
-def handle_OFPST_PORT (con, parts):
+def handle_OFPST_PORT (con, parts, is_last=True):
   msg = []
   for part in parts:
     msg.extend(part.body)
-  e = con.ofnexus.raiseEventNoErrors(PortStatsReceived, con, parts, msg)
-  if e is None or e.halt != True:
-    con.raiseEventNoErrors(PortStatsReceived, con, parts, msg)
+  _raise_event(con, PortStatsReceived, con, parts, msg, is_last)
 
-def handle_OFPST_QUEUE (con, parts):
+def handle_OFPST_QUEUE (con, parts, is_last=True):
   msg = []
   for part in parts:
     msg.extend(part.body)
-  e = con.ofnexus.raiseEventNoErrors(QueueStatsReceived, con, parts, msg)
-  if e is None or e.halt != True:
-    con.raiseEventNoErrors(QueueStatsReceived, con, parts, msg)
+  _raise_event(con, QueueStatsReceived, con, parts, msg, is_last)
 
 
 class OpenFlowHandlers (object):
@@ -174,9 +199,7 @@ class DefaultOpenFlowHandlers (OpenFlowHandlers):
   """
   @staticmethod
   def handle_STATS_REPLY (con, msg):
-    e = con.ofnexus.raiseEventNoErrors(RawStatsReply, con, msg)
-    if e is None or e.halt != True:
-      con.raiseEventNoErrors(RawStatsReply, con, msg)
+    _raise_event(con, RawStatsReply, con, msg)
     con._incoming_stats_reply(msg)
 
   @staticmethod
@@ -185,15 +208,11 @@ class DefaultOpenFlowHandlers (OpenFlowHandlers):
       con.ports._forget(msg.desc)
     else:
       con.ports._update(msg.desc)
-    e = con.ofnexus.raiseEventNoErrors(PortStatus, con, msg)
-    if e is None or e.halt != True:
-      con.raiseEventNoErrors(PortStatus, con, msg)
+    _raise_event(con, PortStatus, con, msg)
 
   @staticmethod
   def handle_PACKET_IN (con, msg): #A
-    e = con.ofnexus.raiseEventNoErrors(PacketIn, con, msg)
-    if e is None or e.halt != True:
-      con.raiseEventNoErrors(PacketIn, con, msg)
+    _raise_event(con, PacketIn, con, msg)
 
   @staticmethod
   def handle_ERROR (con, msg): #A
@@ -207,9 +226,7 @@ class DefaultOpenFlowHandlers (OpenFlowHandlers):
 
   @staticmethod
   def handle_BARRIER_REPLY (con, msg):
-    e = con.ofnexus.raiseEventNoErrors(BarrierIn, con, msg)
-    if e is None or e.halt != True:
-      con.raiseEventNoErrors(BarrierIn, con, msg)
+    _raise_event(con, BarrierIn, con, msg)
 
   @staticmethod
   def handle_VENDOR (con, msg):
@@ -237,9 +254,7 @@ class DefaultOpenFlowHandlers (OpenFlowHandlers):
 
   @staticmethod
   def handle_FLOW_REMOVED (con, msg): #A
-    e = con.ofnexus.raiseEventNoErrors(FlowRemoved, con, msg)
-    if e is None or e.halt != True:
-      con.raiseEventNoErrors(FlowRemoved, con, msg)
+    _raise_event(con, FlowRemoved, con, msg)
 
   @staticmethod
   def handle_FEATURES_REPLY (con, msg):
@@ -249,15 +264,11 @@ class DefaultOpenFlowHandlers (OpenFlowHandlers):
     con.dpid = msg.datapath_id # Check this
 
     con.ofnexus._connect(con) #FIXME: Should this be here?
-    e = con.ofnexus.raiseEventNoErrors(FeaturesReceived, con, msg)
-    if e is None or e.halt != True:
-      con.raiseEventNoErrors(FeaturesReceived, con, msg)
+    _raise_event(con, FeaturesReceived, con, msg)
 
   @staticmethod
   def handle_GET_CONFIG_REPLY (con, msg):
-    e = con.ofnexus.raiseEventNoErrors(ConfigurationReceived, con, msg)
-    if e is None or e.halt != True:
-      con.raiseEventNoErrors(ConfigurationReceived, con, msg)
+    _raise_event(con, ConfigurationReceived, con, msg)
 
   @staticmethod
   def handle_QUEUE_GET_CONFIG_REPLY (con, msg):
@@ -380,6 +391,14 @@ statsHandlerMap = {
   of.OFPST_QUEUE : handle_OFPST_QUEUE,
 }
 
+# Stats types which may be split across multiple replies
+multipartStatsTypes = set([
+  of.OFPST_FLOW,
+  of.OFPST_TABLE,
+  of.OFPST_PORT,
+  of.OFPST_QUEUE,
+])
+
 
 # Deferred sending should be unusual, so don't worry too much about
 # efficiency
@@ -488,6 +507,121 @@ class DeferredSender (threading.Thread):
             except:
               pass
 
+  def queued_bytes (self, con = None):
+    """
+    Returns number of bytes waiting to be sent (for one or all connections)
+    """
+    with self._lock:
+      if con is not None:
+        return sum(len(d) for d in self._dataForConnection.get(con, ()))
+      return sum(len(d) for v in self._dataForConnection.itervalues()
+                 for d in v)
+
+
+class OpenFlowIOStats (object):
+  """
+  Counters for OpenFlow I/O
+
+  Each Connection has one of these (as .io_stats), and there is a global
+  one (ioStats, registered on core as OpenFlowIOStats) which all the
+  connections also count into.  Message and byte counts are kept per OFPT
+  in each direction, along with the time spent in handlers for each OFPT,
+  the sizes of socket reads, and (globally) the time spent in each
+  iteration of the OpenFlow I/O loop.  Times are in seconds.
+  """
+  def __init__ (self, parent = None):
+    self.parent = parent
+    self.reset()
+
+  def reset (self):
+    self.start_time = time.time()
+    self.msgs_in = defaultdict(int)   # OFPT -> count
+    self.bytes_in = defaultdict(int)  # OFPT -> bytes
+    self.msgs_out = defaultdict(int)
+    self.bytes_out = defaultdict(int)
+    self.handler_time = defaultdict(float)     # OFPT -> total time
+    self.handler_time_max = defaultdict(float) # OFPT -> worst time
+    self.reads = 0
+    self.read_bytes = 0
+    self.read_msgs_max = 0
+    self.loop_iterations = 0
+    self.loop_time = 0.0
+    self.loop_time_max = 0.0
+
+  def _handled (self, ofp_type, length, elapsed):
+    self.msgs_in[ofp_type] += 1
+    self.bytes_in[ofp_type] += length
+    self.handler_time[ofp_type] += elapsed
+    if elapsed > self.handler_time_max[ofp_type]:
+      self.handler_time_max[ofp_type] = elapsed
+    if self.parent: self.parent._handled(ofp_type, length, elapsed)
+
+  def _read (self, length, msgs):
+    self.reads += 1
+    self.read_bytes += length
+    if msgs > self.read_msgs_max: self.read_msgs_max = msgs
+    if self.parent: self.parent._read(length, msgs)
+
+  def _sent (self, data):
+    # data may hold several messages, so walk the headers
+    offset = 0
+    l = len(data)
+    while l - offset >= 4:
+      ofp_type = ord(data[offset+1])
+      length = ord(data[offset+2]) << 8 | ord(data[offset+3])
+      if length < 4: break # Not well-formed; don't spin
+      self._sent_msg(ofp_type, length)
+      offset += length
+
+  def _sent_msg (self, ofp_type, length):
+    self.msgs_out[ofp_type] += 1
+    self.bytes_out[ofp_type] += length
+    if self.parent: self.parent._sent_msg(ofp_type, length)
+
+  def _loop (self, elapsed):
+    self.loop_iterations += 1
+    self.loop_time += elapsed
+    if elapsed > self.loop_time_max: self.loop_time_max = elapsed
+
+  def as_dict (self):
+    """
+    Returns the counters as a JSON-friendly dict
+    """
+    def by_type (d):
+      return dict((of.ofp_type_map.get(k, str(k)), v)
+                  for k,v in dict(d).iteritems())
+    handler_time = dict(self.handler_time)
+    msgs_in = dict(self.msgs_in)
+    handler_avg = dict((k, v / msgs_in[k]) for k,v in handler_time.iteritems()
+                       if msgs_in.get(k))
+    r = {
+      'elapsed' : time.time() - self.start_time,
+      'msgs_in' : by_type(msgs_in),
+      'bytes_in' : by_type(self.bytes_in),
+      'msgs_out' : by_type(self.msgs_out),
+      'bytes_out' : by_type(self.bytes_out),
+      'handler_time' : by_type(handler_time),
+      'handler_time_avg' : by_type(handler_avg),
+      'handler_time_max' : by_type(self.handler_time_max),
+      'reads' : self.reads,
+      'read_bytes' : self.read_bytes,
+      'read_bytes_avg' : float(self.read_bytes) / self.reads
+                         if self.reads else 0.0,
+      'read_msgs_max' : self.read_msgs_max,
+    }
+    if self.parent is None:
+      r['loop_iterations'] = self.loop_iterations
+      r['loop_time_avg'] = (self.loop_time / self.loop_iterations
+                            if self.loop_iterations else 0.0)
+      r['loop_time_max'] = self.loop_time_max
+    if deferredSender is not None:
+      r['deferred_bytes'] = deferredSender.queued_bytes()
+    return r
+
+# Global I/O stats for all connections
+ioStats = OpenFlowIOStats()
+
+
 class DummyOFNexus (object):
   def raiseEventNoErrors (self, event, *args, **kw):
     log.warning("%s raised on dummy OpenFlow nexus" % event)
@@ -688,6 +822,21 @@ class PortCollection (object):
     r._ports = set(self.values())
 
 
+class _ConnectionIOStats (OpenFlowIOStats):
+  """
+  Per-Connection I/O stats, which also count into the global ioStats
+  """
+  def __init__ (self, con):
+    self._con = con
+    super(_ConnectionIOStats,self).__init__(parent = ioStats)
+
+  def as_dict (self):
+    r = super(_ConnectionIOStats,self).as_dict()
+    if deferredSender is not None:
+      r['deferred_bytes'] = deferredSender.queued_bytes(self._con)
+    return r
+
+
 class Connection (EventMixin):
   """
   A Connection object represents a single TCP session with an
@@ -730,10 +879,11 @@ class Connection (EventMixin):
     log.info(str(self) + " " + str(m))
 
   def __init__ (self, sock):
-    self._previous_stats = []
+    self._previous_stats = {} # xid -> stats reply parts received so far
 
     self.ofnexus = _dummyOFNexus
     self.sock = sock
+    self.io_stats = _ConnectionIOStats(self)
     self.buf = b''
     Connection.ID += 1
     self.ID = Connection.ID
@@ -807,6 +957,8 @@ class Connection (EventMixin):
     else:
       self.info(msg)
     self.disconnected = True
+    # Replies still being collected will never be completed
+    self._previous_stats.clear()
     try:
       self.ofnexus._disconnect(self.dpid)
     except:
@@ -847,6 +999,8 @@ class Connection (EventMixin):
       assert isinstance(data, of.ofp_header)
       data = data.pack()
 
+    self.io_stats._sent(data)
+
     if deferredSender.sending:
       log.debug("deferred sender is sending!")
       deferredSender.send(self, data)
@@ -879,11 +1033,25 @@ class Connection (EventMixin):
       return False
     if len(d) == 0:
       return False
+    return self.data_received(d)
+
+  def data_received (self, d):
+    """
+    Process bytes received from the switch
+
+    Buffers d, then unpacks and handles every complete message.  Returns
+    False if the connection should be thrown away.
+
+    read() calls this after pulling data off the socket, but it doesn't
+    touch the socket itself, so a transport driven by some other I/O loop
+    can feed data in directly.
+    """
     self.buf += d
     buf_len = len(self.buf)
 
-
     offset = 0
+    msgs = 0
+    stats = self.io_stats
     while buf_len - offset >= 8: # 8 bytes is minimum OF message size
       # We pull the first four bytes of the OpenFlow header off by hand
       # (using ord) to find the version/length/type so that we can
@@ -907,7 +1075,9 @@ class Connection (EventMixin):
       new_offset,msg = self.unpackers[ofp_type](self.buf, offset)
       assert new_offset - offset == msg_length
       offset = new_offset
+      msgs += 1
 
+      start = time.time()
       try:
         h = self.handlers[ofp_type]
         h(self, msg)
@@ -915,7 +1085,9 @@ class Connection (EventMixin):
         log.exception("%s: Exception while handling OpenFlow message:\n" +
                       "%s %s", self,self,
                       ("\n" + str(self) + " ").join(str(msg).split('\n')))
-        continue
+      stats._handled(ofp_type, msg_length, time.time() - start)
+
+    stats._read(len(d), msgs)
 
     if offset != 0:
       self.buf = self.buf[offset:]
@@ -923,39 +1095,43 @@ class Connection (EventMixin):
     return True
 
   def _incoming_stats_reply (self, ofp):
-    # This assumes that you don't receive multiple stats replies
-    # to different requests out of order/interspersed.
-    if not ofp.is_last_reply:
-      if ofp.type not in [of.OFPST_FLOW, of.OFPST_TABLE,
-                                of.OFPST_PORT, of.OFPST_QUEUE]:
-        log.error("Don't know how to aggregate stats message of type " +
-                  str(ofp.type))
-        self._previous_stats = []
-        return
-
-    if len(self._previous_stats) != 0:
-      if ((ofp.xid == self._previous_stats[0].xid) and
-          (ofp.type == self._previous_stats[0].type)):
-        self._previous_stats.append(ofp)
-      else:
-        log.error("Was expecting continued stats of type %i with xid %i, " +
-                  "but got type %i with xid %i" %
-                  (self._previous_stats_reply.xid,
-                    self._previous_stats_reply.type,
-                    ofp.xid, ofp.type))
-        self._previous_stats = [ofp]
+    # Parts are collected per xid, so replies to several outstanding
+    # requests may arrive interleaved.
+    more = not ofp.is_last_reply
+    if more and ofp.type not in multipartStatsTypes:
+      log.error("Don't know how to aggregate stats message of type " +
+                str(ofp.type))
+      self._previous_stats.pop(ofp.xid, None)
+      return
+
+    handler = statsHandlerMap.get(ofp.type, None)
+
+    if (ofp.type in multipartStatsTypes
+        and getattr(self.ofnexus, 'stream_stats', False)):
+      # Hand each part off as it arrives instead of buffering the lot
+      if handler is not None:
+        handler(self, [ofp], is_last = not more)
+      return
+
+    parts = self._previous_stats.get(ofp.xid)
+    if parts is None:
+      parts = [ofp]
+      if more: self._previous_stats[ofp.xid] = parts
+    elif parts[0].type != ofp.type:
+      log.error("Was expecting continued stats of type %i with xid %i, "
+                "but got type %i", parts[0].type, ofp.xid, ofp.type)
+      parts = [ofp]
+      self._previous_stats[ofp.xid] = parts
     else:
-      self._previous_stats = [ofp]
-
-    if ofp.is_last_reply:
-      handler = statsHandlerMap.get(self._previous_stats[0].type, None)
-      s = self._previous_stats
-      self._previous_stats = []
-      if handler is None:
-        log.warn("No handler for stats of type " +
-                 str(self._previous_stats[0].type))
-        return
-      handler(self, s)
+      parts.append(ofp)
+
+    if more: return
+
+    self._previous_stats.pop(ofp.xid, None)
+    if handler is None:
+      log.warn("No handler for stats of type " + str(ofp.type))
+      return
+    handler(self, parts)
 
   def __str__ (self):
     #return "[Con " + str(self.ID) + "/" + str(self.dpid) + "]"
@@ -1055,6 +1231,7 @@ class OpenFlow_01_Task (Task):
         while True:
           con = None
           rlist, wlist, elist = yield Select(sockets, [], sockets, 5)
+          timestamp = time.time()
           if len(rlist) == 0 and len(wlist) == 0 and len(elist) == 0:
             if not core.running: break
 
@@ -1071,7 +1248,6 @@ class OpenFlow_01_Task (Task):
               except:
                 pass
 
-          timestamp = time.time()
           for con in rlist:
             if con is listener:
               new_sock = listener.accept()[0]
@@ -1113,6 +1289,8 @@ class OpenFlow_01_Task (Task):
               if con.read() is False:
                 con.close()
                 sockets.remove(con)
+
+          ioStats._loop(time.time() - timestamp)
       except KeyboardInterrupt:
         break
       except:
@@ -1194,6 +1372,9 @@ def launch (port=6633, address="0.0.0.0", name=None,
   if not deferredSender:
     deferredSender = DeferredSender()
 
+  if not core.hasComponent("OpenFlowIOStats"):
+    core.register("OpenFlowIOStats", ioStats)
+
   if of._logger is None:
     of._logger = core.getLogger('libopenflow_01')
 
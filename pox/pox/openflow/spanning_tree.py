@@ -44,76 +44,161 @@ log = core.getLogger()
 # Might be nice if we made this accessible on core...
 #_adj = defaultdict(lambda:defaultdict(lambda:[]))
 
+# The spanning tree.  [dpid1][dpid2] -> port on dpid1 leading to dpid2
+_tree = defaultdict(dict)
+
+# Switch pairs (lower dpid first) whose links have changed since the tree
+# was last updated
+_changed_pairs = set()
+
+# The discovery link generation the tree was last updated for
+_tree_generation = None
+
+# True once we're listening to LinkEvents (and so filling _changed_pairs)
+_listening = False
+
+# Ports whose flood state may need updating.  dpid -> set of port numbers
+_dirty_ports = defaultdict(set)
+
+
+def _add_tree_edge (s1, s2, p1, p2):
+  _tree[s1][s2] = p1
+  _tree[s2][s1] = p2
+  _dirty_ports[s1].add(p1)
+  _dirty_ports[s2].add(p2)
+
+
+def _remove_tree_edge (s1, s2):
+  for a,b in ((s1,s2),(s2,s1)):
+    _dirty_ports[a].add(_tree[a].pop(b))
+    if not _tree[a]: del _tree[a]
+
+
+def _tree_component (sw):
+  """
+  Returns the set of switches connected to sw by the tree
+  """
+  component = set([sw])
+  frontier = [sw]
+  while frontier:
+    for n in _tree.get(frontier.pop(), ()):
+      if n in component: continue
+      component.add(n)
+      frontier.append(n)
+  return component
+
+
+def _grow_tree (sw, adj):
+  """
+  Connects sw's part of the tree to every switch reachable from it
+  """
+  component = _tree_component(sw)
+  queue = sorted(component)
+  while queue:
+    n = queue.pop()
+    for nbr in sorted(adj.get(n, ())):
+      if nbr in component: continue
+      joined = _tree_component(nbr)
+      _add_tree_edge(n, nbr, adj[n][nbr], adj[nbr][n])
+      component.update(joined)
+      queue.extend(joined)
+
+
+def _rebuild_tree (adj):
+  """
+  Builds the spanning tree from scratch
+  """
+  for s1 in list(_tree):
+    for s2 in list(_tree.get(s1, ())):
+      _remove_tree_edge(s1, s2)
+  covered = set()
+  for sw in sorted(adj):
+    if sw in covered: continue
+    _grow_tree(sw, adj)
+    covered.update(_tree_component(sw))
+
+
+def _update_tree_links ():
+  """
+  Brings the spanning tree up to date with the discovered links
+
+  If we've been told which switch pairs' links changed, the tree is just
+  repaired there: a tree edge whose ports changed is updated, when one
+  goes away the two halves of the tree are each grown back out over
+  whatever links remain, and a new link is added to the tree only if it
+  connects two parts of the tree which were separate.  Otherwise (e.g.,
+  when we're not listening to LinkEvents ourselves), if the links have
+  changed at all, the tree is rebuilt.
+  """
+  global _tree_generation
+  links = core.openflow_discovery.adjacency
+  generation = _tree_generation
+  _tree_generation = links.generation
+  adj = links.switch_adjacency()
+
+  if not _listening or not _changed_pairs:
+    _changed_pairs.clear()
+    if generation != links.generation:
+      _rebuild_tree(adj)
+    return
+
+  broken = []
+  added = []
+  for s1,s2 in sorted(_changed_pairs):
+    if s2 in adj.get(s1, ()):
+      new_ports = (adj[s1][s2], adj[s2][s1])
+    else:
+      new_ports = None
+    if s2 in _tree.get(s1, ()):
+      if new_ports == (_tree[s1][s2], _tree[s2][s1]): continue
+      _remove_tree_edge(s1, s2)
+      if new_ports is not None:
+        # Still connected, just by different ports
+        _add_tree_edge(s1, s2, *new_ports)
+      else:
+        broken.extend((s1, s2))
+    elif new_ports is not None:
+      added.append((s1, s2))
+  _changed_pairs.clear()
+
+  for sw in broken:
+    _grow_tree(sw, adj)
+
+  if not added: return
+
+  # Label the parts of the tree, and join them with the new links
+  label = {}
+  for sw in _tree:
+    if sw in label: continue
+    for n in _tree_component(sw):
+      label[n] = sw
+  joined = {}
+  def find (sw):
+    l = label.get(sw, sw)
+    while l in joined:
+      l = joined[l]
+    return l
+  for s1,s2 in added:
+    l1 = find(s1)
+    l2 = find(s2)
+    if l1 == l2: continue
+    joined[l2] = l1
+    _add_tree_edge(s1, s2, adj[s1][s2], adj[s2][s1])
+
+
 def _calc_spanning_tree ():
   """
-  Calculates the actual spanning tree
+  Brings the spanning tree up to date and returns it
 
   Returns it as dictionary where the keys are DPID1, and the
   values are tuples of (DPID2, port-num), where port-num
   is the port on DPID1 connecting to DPID2.
   """
-  def flip (link):
-    return Discovery.Link(link[2],link[3], link[0],link[1])
-
-  adj = defaultdict(lambda:defaultdict(lambda:[]))
-  switches = set()
-  # Add all links and switches
-  for l in core.openflow_discovery.adjacency:
-    adj[l.dpid1][l.dpid2].append(l)
-    switches.add(l.dpid1)
-    switches.add(l.dpid2)
-
-  # Cull links -- we want a single symmetric link connecting nodes
-  for s1 in switches:
-    for s2 in switches:
-      if s2 not in adj[s1]:
-        continue
-      if not isinstance(adj[s1][s2], list):
-        continue
-      assert s1 is not s2
-      good = False
-      for l in adj[s1][s2]:
-        if flip(l) in core.openflow_discovery.adjacency:
-          # This is a good one
-          adj[s1][s2] = l.port1
-          adj[s2][s1] = l.port2
-          good = True
-          break
-      if not good:
-        del adj[s1][s2]
-        if s1 in adj[s2]:
-          # Delete the other way too
-          del adj[s2][s1]
-
-  q = []
-  more = set(switches)
-
-  done = set()
+  _update_tree_links()
 
   tree = defaultdict(set)
-
-  while True:
-    q = sorted(list(more)) + q
-    more.clear()
-    if len(q) == 0: break
-    v = q.pop(False)
-    if v in done: continue
-    done.add(v)
-    for w,p in adj[v].iteritems():
-      if w in tree: continue
-      more.add(w)
-      tree[v].add((w,p))
-      tree[w].add((v,adj[w][v]))
-
-  if False:
-    log.debug("*** SPANNING TREE ***")
-    for sw,ports in tree.iteritems():
-      #print " ", dpidToStr(sw), ":", sorted(list(ports))
-      #print " ", sw, ":", [l[0] for l in sorted(list(ports))]
-      log.debug((" %i : " % sw) + " ".join([str(l[0]) for l in
-                                           sorted(list(ports))]))
-    log.debug("*********************")
-
+  for sw,nbrs in _tree.iteritems():
+    tree[sw].update(nbrs.iteritems())
   return tree
 
 
@@ -134,6 +219,8 @@ _hold_down = False
 def _handle_ConnectionUp (event):
   # When a switch connects, forget about previous port states
   _prev[event.dpid].clear()
+  _dirty_ports[event.dpid].update(p.port_no
+                                  for p in event.connection.ports.itervalues())
 
   if _noflood_by_default:
     con = event.connection
@@ -157,13 +244,16 @@ def _handle_LinkEvent (event):
   # When links change, update spanning tree
 
   (dp1,p1),(dp2,p2) = event.link.end
-  if _prev[dp1][p1] is False:
-    if _prev[dp2][p2] is False:
-      # We're disabling this link; who cares if it's up or down?
-      #log.debug("Ignoring link status for %s", event.link)
-      return
+  _changed_pairs.add((min(dp1,dp2), max(dp1,dp2)))
+  # Whether these are edge ports may have changed
+  _dirty_ports[dp1].add(p1)
+  _dirty_ports[dp2].add(p2)
 
-  _update_tree()
+  if event.removed:
+    # The link is only actually removed after this event, so wait for it
+    core.callLater(_update_tree)
+  else:
+    _update_tree()
 
 
 def _update_tree (force_dpid = None):
@@ -172,10 +262,14 @@ def _update_tree (force_dpid = None):
 
   force_dpid specifies a switch we want to update even if we are supposed
   to be holding down changes.
+
+  Only the ports whose flood state may have changed (because they're on
+  changed links or tree edges, or their switch just connected) are
+  looked at, and only those whose flood state did change get port-mods.
   """
 
-  # Get a spanning tree
-  tree = _calc_spanning_tree()
+  # Bring the spanning tree up to date
+  _update_tree_links()
   log.debug("Spanning tree updated")
 
   # Connections born before this time are old enough that a complete
@@ -186,9 +280,12 @@ def _update_tree (force_dpid = None):
   # Now modify ports as needed
   try:
     change_count = 0
-    for sw, ports in tree.iteritems():
+    for sw in list(_dirty_ports):
       con = core.openflow.getConnection(sw)
-      if con is None: continue # Must have disconnected
+      if con is None:
+        # Must have disconnected (it'll be dirty again if it reconnects)
+        del _dirty_ports[sw]
+        continue
       if con.connect_time is None: continue # Not fully connected
 
       if _hold_down:
@@ -200,9 +297,10 @@ def _update_tree (force_dpid = None):
           else:
             continue
 
-      tree_ports = [p[1] for p in ports]
+      dirty = _dirty_ports.pop(sw)
+      tree_ports = set(_tree.get(sw, {}).itervalues())
       for p in con.ports.itervalues():
-        if p.port_no < of.OFPP_MAX:
+        if p.port_no < of.OFPP_MAX and p.port_no in dirty:
           flood = p.port_no in tree_ports
           if not flood:
             if core.openflow_discovery.is_edge_port(sw, p.port_no):
@@ -226,6 +324,8 @@ def _update_tree (force_dpid = None):
       log.info("%i ports changed", change_count)
   except:
     _prev.clear()
+    for con in core.openflow.connections:
+      _dirty_ports[con.dpid].update(p.port_no for p in con.ports.itervalues())
     log.exception("Couldn't push spanning tree")
 
 
@@ -272,7 +372,9 @@ def launch (no_flood = False, hold_down = False):
     _hold_down = True
 
   def start_spanning_tree ():
+    global _listening
     core.openflow.addListenerByName("ConnectionUp", _handle_ConnectionUp)
     core.openflow_discovery.addListenerByName("LinkEvent", _handle_LinkEvent)
+    _listening = True
     log.debug("Spanning tree component ready")
   core.call_when_ready(start_spanning_tree, "openflow_discovery")
@@ -172,6 +172,7 @@ class OpenFlowSwitch (EventMixin, Switch):
     FlowRemoved,
     PacketIn,
     BarrierIn,
+    FlowStatsReceived,
   ])
 
   def __init__ (self, dpid):
@@ -254,6 +255,10 @@ class OpenFlowSwitch (EventMixin, Switch):
     self.raiseEvent(event)
     event.halt = False
 
+  def _handle_con_FlowStatsReceived (self, event):
+    self.raiseEvent(event)
+    event.halt = False
+
   def _handle_con_FlowRemoved (self, event):
     self.raiseEvent(event)
     self.flowTable.removeFlow(event)
@@ -292,8 +297,27 @@ class OpenFlowSwitch (EventMixin, Switch):
     return repr(self)
 
 
+class FlowTableVerified (Event):
+  """
+  Event raised by an OFSyncFlowTable when a verify() has completed
+
+  missing are the entries which the switch should have had but didn't (or
+  had with different actions), and extra are the flows (ofp_flow_stats)
+  it had which it shouldn't have.  The missing entries have been queued for
+  repair, as have the extra flows if verify() was asked to remove them.
+  """
+  def __init__ (self, missing, extra):
+    Event.__init__(self)
+    self.missing = missing
+    self.extra = extra
+
+  @property
+  def ok (self):
+    return not self.missing and not self.extra
+
+
 class OFSyncFlowTable (EventMixin):
-  _eventMixin_events = set([FlowTableModification])
+  _eventMixin_events = set([FlowTableModification, FlowTableVerified])
   """
   A flow table that keeps in sync with a switch
   """
@@ -301,6 +325,7 @@ class OFSyncFlowTable (EventMixin):
   REMOVE = of.OFPFC_DELETE
   REMOVE_STRICT = of.OFPFC_DELETE_STRICT
   TIME_OUT = 2
+  BATCH_SIZE = 256 # Max flow-mods sent per barrier
 
   def __init__ (self, switch=None, **kw):
     EventMixin.__init__(self)
@@ -315,6 +340,11 @@ class OFSyncFlowTable (EventMixin):
     # a map of pending barriers per request entry -> (barrier_xid, time)
     self._pending_op_to_barrier = {}
 
+    # xid of our outstanding flow stats request and the stats so far
+    self._verify_xid = None
+    self._verify_stats = []
+    self._verify_remove = False
+
     self.listenTo(switch)
 
   def install (self, entries=[]):
@@ -344,6 +374,92 @@ class OFSyncFlowTable (EventMixin):
     """
     self._mod(entries, OFSyncFlowTable.REMOVE_STRICT)
 
+  def reconcile (self, entries=[]):
+    """
+    asynchronously make the flow table hold exactly the given entries
+
+    only the differences from what is installed (or pending) are sent:
+    entries which are already there with the same actions, cookie, timeouts
+    and flags are left alone, others are added (replacing any with the same
+    match and priority), and entries not among the given ones are removed
+    strictly. returns the number of flow-mods queued.
+
+    will raise FlowTableModification events as the changes are processed by
+    the switch
+    """
+    shadow = self._shadow()
+    desired = {}
+    for entry in entries:
+      desired[entry.priority,entry.match.key] = entry
+
+    ops = [(OFSyncFlowTable.REMOVE_STRICT, entry)
+           for key,entry in shadow.iteritems() if key not in desired]
+    for key,entry in desired.iteritems():
+      current = shadow.get(key)
+      if current is not None and self._same_entry(current, entry): continue
+      ops.append((OFSyncFlowTable.ADD, entry))
+
+    if ops:
+      self._pending.extend(ops)
+      self._sync_pending()
+    return len(ops)
+
+  def verify (self, remove_unknown=False):
+    """
+    asynchronously check the switch's flows against the flow table
+
+    requests the switch's flow stats, and compares them with the entries
+    which aren't in flight. entries which are missing are reinstalled
+    (unless they have timeouts, since they may just have expired).
+    unknown flows are only reported, since other components (e.g.,
+    discovery) install flows of their own; pass remove_unknown=True to
+    remove them as well. raises FlowTableVerified when done.
+    """
+    if not self.switch.connected:
+      return False
+    self._verify_xid = self.switch._xid_generator()
+    self._verify_stats = []
+    self._verify_remove = remove_unknown
+    self.switch.send(of.ofp_stats_request(xid=self._verify_xid,
+                                          body=of.ofp_flow_stats_request()))
+    return True
+
+  @staticmethod
+  def _wire_key (priority, match):
+    """
+    returns a key for comparing our entries with flows read from the switch
+
+    flow stats come back with the switch's (wire) wildcards, which differ
+    from ours for fields the match can't look at, so compare what's sent.
+    """
+    return (priority, match.pack(flow_mod=True))
+
+  @staticmethod
+  def _same_entry (a, b):
+    return (a.actions == b.actions and a.cookie == b.cookie
+            and a.idle_timeout == b.idle_timeout
+            and a.hard_timeout == b.hard_timeout and a.flags == b.flags)
+
+  def _shadow (self):
+    """
+    returns what the table will hold once the pending ops are processed
+
+    (priority, match key) -> entry
+    """
+    shadow = dict(((e.priority,e.match.key), e)
+                  for e in self.flow_table.entries)
+    for command,entry in self._pending:
+      key = (entry.priority,entry.match.key)
+      if command == OFSyncFlowTable.ADD:
+        shadow[key] = entry
+      elif command == OFSyncFlowTable.REMOVE_STRICT:
+        shadow.pop(key, None)
+      else:
+        for k,e in shadow.items():
+          if e.is_matched_by(entry.match):
+            del shadow[k]
+    return shadow
+
   @property
   def entries (self):
     return self.flow_table.entries
@@ -396,19 +512,24 @@ class OFSyncFlowTable (EventMixin):
               or (self._pending_op_to_barrier[op][1]
                   + OFSyncFlowTable.TIME_OUT) < time.time() ]
 
-    for op in todo:
-      fmod_xid = self.switch._xid_generator()
-      flow_mod = op[1].to_flow_mod(xid=fmod_xid, command=op[0],
+    # send the flow-mods in batches, each followed by a barrier, so that
+    # large changes get confirmed (and applied to our table) progressively
+    batches = [todo[i:i+OFSyncFlowTable.BATCH_SIZE]
+               for i in range(0, len(todo), OFSyncFlowTable.BATCH_SIZE)]
+    for batch in batches or [[]]:
+      for op in batch:
+        fmod_xid = self.switch._xid_generator()
+        flow_mod = op[1].to_flow_mod(xid=fmod_xid, command=op[0],
                                    flags=op[1].flags | of.OFPFF_SEND_FLOW_REM)
-      self.switch.send(flow_mod)
+        self.switch.send(flow_mod)
 
-    barrier_xid = self.switch._xid_generator()
-    self.switch.send(of.ofp_barrier_request(xid=barrier_xid))
-    now = time.time()
-    self._pending_barrier_to_ops[barrier_xid] = todo
+      barrier_xid = self.switch._xid_generator()
+      self.switch.send(of.ofp_barrier_request(xid=barrier_xid))
+      now = time.time()
+      self._pending_barrier_to_ops[barrier_xid] = batch
 
-    for op in todo:
-      self._pending_op_to_barrier[op] = (barrier_xid, now)
+      for op in batch:
+        self._pending_op_to_barrier[op] = (barrier_xid, now)
 
   def _handle_SwitchConnectionUp (self, event):
     # sync all_flows
@@ -418,6 +539,7 @@ class OFSyncFlowTable (EventMixin):
     # connection down. too bad for our unconfirmed entries
     self._pending_barrier_to_ops = {}
     self._pending_op_to_barrier = {}
+    self._verify_xid = None
 
   def _handle_BarrierIn (self, barrier):
     # yeah. barrier in. time to sync some of these flows
@@ -429,6 +551,9 @@ class OFSyncFlowTable (EventMixin):
       for op in self._pending_barrier_to_ops[barrier.xid]:
         (command, entry) = op
         if(command == OFSyncFlowTable.ADD):
+          # an add replaces an entry with the same match and priority
+          removed.extend(self.flow_table.remove_matching_entries(entry.match,
+              entry.priority, strict=True))
           self.flow_table.add_entry(entry)
           added.append(entry)
         else:
@@ -443,6 +568,49 @@ class OFSyncFlowTable (EventMixin):
     else:
       return EventContinue
 
+  def _handle_FlowStatsReceived (self, event):
+    if self._verify_xid is None or event.ofp[0].xid != self._verify_xid:
+      return EventContinue
+    self._verify_stats.extend(event.stats)
+    if not event.is_last:
+      return EventHalt
+    self._verify_xid = None
+    stats = self._verify_stats
+    self._verify_stats = []
+
+    # only look at what isn't in flight
+    wire_key = self._wire_key
+    in_flight = set(wire_key(entry.priority, entry.match)
+                    for command,entry in self._pending)
+    expected = dict((wire_key(e.priority, e.match), e)
+                    for e in self.flow_table.entries)
+    extra = []
+    for flow in stats:
+      key = wire_key(flow.priority, flow.match)
+      if key in in_flight: continue
+      entry = expected.get(key)
+      if entry is None:
+        extra.append(flow)
+      elif entry.actions == flow.actions:
+        del expected[key]
+    missing = [e for k,e in expected.iteritems() if k not in in_flight
+               and not e.idle_timeout and not e.hard_timeout]
+
+    if missing or extra:
+      log.warn("%s: flow table out of sync (%i missing, %i extra)",
+               self.switch, len(missing), len(extra))
+      for entry in missing:
+        self._pending.append((OFSyncFlowTable.ADD, entry))
+      if self._verify_remove:
+        for flow in extra:
+          self._pending.append((OFSyncFlowTable.REMOVE_STRICT,
+                                TableEntry(priority=flow.priority,
+                                           match=flow.match)))
+      if missing or self._verify_remove:
+        self._sync_pending()
+    self.raiseEvent(FlowTableVerified(missing, extra))
+    return EventHalt
+
   def _handle_FlowRemoved (self, event):
     """
     process a flow removed event -- remove the matching flow from the table.
@@ -36,6 +36,10 @@ Current commands include:
     out_port - filter by out port (defaults to all)
   get_switches
     Get list of switches and their basic info.
+  get_io_stats
+    Get OpenFlow I/O counters (message/byte counts, handler times, etc.).
+    dpid - a string dpid (optional, defaults to global counters plus
+           those of every connected switch)
 
 Example - Make a hub:
 curl -i -X POST -d '{"method":"set_table","params":{"dpid":
@@ -209,6 +213,20 @@ class OFRequestHandler (JSONRPCHandler):
   def _exec_get_switches (self):
     return {'result':list_switches()}
 
+  def _exec_get_io_stats (self, dpid = None):
+    if dpid is not None:
+      con = core.openflow.getConnection(strToDPID(dpid))
+      if con is None:
+        return make_error("No such switch")
+      return {'result':con.io_stats.as_dict()}
+
+    if not core.hasComponent("OpenFlowIOStats"):
+      return make_error("No OpenFlow I/O stats available")
+    r = core.OpenFlowIOStats.as_dict()
+    r['switches'] = dict((dpidToStr(con.dpid), con.io_stats.as_dict())
+                         for con in core.openflow.connections.values())
+    return {'result':r}
+
 
 
 def launch (username='', password=''):
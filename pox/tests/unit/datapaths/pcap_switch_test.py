@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import sys
+import os
+import os.path
+from Queue import Queue
+
+sys.path.append(os.path.dirname(__file__) + "/../../..")
+from pox.openflow.libopenflow_01 import *
+from pox.openflow.flow_table import TableEntry
+from pox.datapaths.switch import SoftwareSwitchBase
+from pox.datapaths.pcap_switch import FrameRing, PCapSwitch, _PCapWorkerSwitch
+
+class FrameRingTest(unittest.TestCase):
+  def test_put_get(self):
+    r = FrameRing(slots=4, slot_size=64)
+    self.assertEqual(r.get_all(), [])
+    self.assertTrue(r.put('a' * 10))
+    self.assertTrue(r.put(''))
+    self.assertTrue(r.put('b' * 64))
+    self.assertEqual(len(r), 3)
+    self.assertEqual(r.get_all(), ['a' * 10, '', 'b' * 64])
+    self.assertEqual(len(r), 0)
+    self.assertEqual(r.get_all(), [])
+
+  def test_wraparound(self):
+    r = FrameRing(slots=4, slot_size=64)
+    n = 0
+    for i in range(10):
+      # a different number of frames each time, so they straddle the end
+      frames = [str(n + j) * (j + 1) for j in range(i % 4 + 1)]
+      n += len(frames)
+      for f in frames:
+        self.assertTrue(r.put(f))
+      self.assertEqual(r.get_all(), frames)
+    self.assertEqual(r.dropped, 0)
+
+  def test_full(self):
+    r = FrameRing(slots=4, slot_size=64)
+    for i in range(4):
+      self.assertTrue(r.put(str(i)))
+    self.assertFalse(r.put('x'))
+    self.assertFalse(r.put('y'))
+    self.assertEqual(r.dropped, 2)
+    self.assertEqual(r.get_all(), ['0', '1', '2', '3'])
+    # room again
+    self.assertTrue(r.put('4'))
+    self.assertEqual(r.get_all(), ['4'])
+
+  def test_oversized(self):
+    r = FrameRing(slots=4, slot_size=64)
+    big = 'x' * 9000
+    for i in range(3):
+      # they keep their place among the others, even across wraparound
+      self.assertTrue(r.put('a'))
+      self.assertTrue(r.put(big + str(i)))
+      self.assertTrue(r.put('b'))
+      self.assertEqual(r.get_all(), ['a', big + str(i), 'b'])
+    for i in range(4):
+      self.assertTrue(r.put(big))
+    # they take up a slot like any other frame
+    self.assertFalse(r.put(big))
+    self.assertEqual(r.dropped, 1)
+    self.assertEqual(r.get_all(), [big] * 4)
+
+  def test_wakeup(self):
+    rfd,wfd = os.pipe()
+    try:
+      r = FrameRing(slots=4, slot_size=64, wakeup=wfd)
+      r.put('a')
+      r.set_waiting()
+      r.put('b')
+      r.put('c')
+      # only one wakeup for the first frame after set_waiting()
+      self.assertEqual(os.read(rfd, 100), 'x')
+      self.assertEqual(r.get_all(), ['a', 'b', 'c'])
+    finally:
+      os.close(rfd)
+      os.close(wfd)
+
+class MockPCap(object):
+  def __init__(self, port_no):
+    self.port_no = port_no
+
+class PCapRxTest(unittest.TestCase):
+  def setUp(self):
+    # Just enough of a PCapSwitch for _pcap_rx()
+    self.sw = PCapSwitch.__new__(PCapSwitch)
+    self.sw.q = Queue()
+    self.ring = FrameRing(slots=4, slot_size=64)
+    self.sw._rings = {1: self.ring}
+
+  def test_oversized_in_order(self):
+    big = 'j' * 9000
+    self.sw._pcap_rx(MockPCap(1), 'small', 0, 0, 5)
+    self.sw._pcap_rx(MockPCap(1), big, 0, 0, len(big))
+    self.sw._pcap_rx(MockPCap(1), 'later', 0, 0, 5)
+    self.assertEqual(self.ring.get_all(), ['small', big, 'later'])
+    self.assertEqual(self.ring.dropped, 0)
+    self.assertTrue(self.sw.q.empty())
+
+  def test_wakeup_only_when_waiting(self):
+    wakeup = os.pipe()
+    try:
+      self.sw._rings[1] = ring = FrameRing(slots=8, slot_size=64,
+                                           wakeup=wakeup[1])
+      big = 'j' * 9000
+      for i in range(3):
+        self.sw._pcap_rx(MockPCap(1), big, 0, 0, len(big))
+      ring.set_waiting()
+      for i in range(3):
+        self.sw._pcap_rx(MockPCap(1), big, 0, 0, len(big))
+      self.assertEqual(os.read(wakeup[0], 100), 'x')
+      self.assertEqual(len(ring.get_all()), 6)
+    finally:
+      os.close(wakeup[0])
+      os.close(wakeup[1])
+
+  def test_no_ring(self):
+    self.sw._pcap_rx(MockPCap(2), 'small', 0, 0, 5)
+    self.assertEqual(self.sw.q.get(block=False), (2, 'small'))
+
+class MockCtlQueue(object):
+  def __init__(self):
+    self.sent = []
+
+  def put(self, msg):
+    self.sent.append(msg)
+
+  def take(self):
+    """ returns (and forgets) the messages sent so far """
+    sent,self.sent = self.sent,[]
+    return sent
+
+def _entry(port, out_port, priority=10):
+  return TableEntry(priority=priority, match=ofp_match(in_port=port),
+                    actions=[ofp_action_output(port=out_port)])
+
+class WorkerSwitchTest(unittest.TestCase):
+  """
+  The worker's half of keeping its table in sync with the POX process
+  """
+  def setUp(self):
+    self.out_q = Queue()
+    self.sw = _PCapWorkerSwitch(out_q=self.out_q, dpid=1,
+                                ports=[ofp_phy_port(port_no=1),
+                                       ofp_phy_port(port_no=2)])
+
+  def _add(self, entry_id, entry):
+    self.sw._rx_ctl(('add', entry_id, entry.to_flow_mod().pack()))
+    return self.sw._entries_by_id[entry_id]
+
+  def test_add(self):
+    e = self._add(7, _entry(1, 2))
+    self.assertEqual(self.sw.table.entries, [e])
+    self.assertEqual(self.sw._entry_ids, {e: 7})
+    self.assertEqual(e.match.in_port, 1)
+    self.assertEqual([a.port for a in e.actions], [2])
+
+  def test_modify(self):
+    e = self._add(7, _entry(1, 2))
+    self.sw._rx_ctl(('modify', 7, _entry(1, 1).to_flow_mod().pack()))
+    self.assertEqual([a.port for a in e.actions], [1])
+    self.assertEqual(self.sw.table.entries, [e])
+    # Unknown (e.g., already removed) IDs are ignored
+    self.sw._rx_ctl(('modify', 8, _entry(1, 2).to_flow_mod().pack()))
+    self.assertEqual([a.port for a in e.actions], [1])
+
+  def test_remove(self):
+    e = self._add(7, _entry(1, 2))
+    e2 = self._add(8, _entry(2, 1))
+    self.sw._rx_ctl(('remove', 7))
+    self.assertEqual(self.sw.table.entries, [e2])
+    self.assertEqual(self.sw._entries_by_id, {8: e2})
+    self.assertEqual(self.sw._entry_ids, {e2: 8})
+    self.assertEqual(list(self.sw._reported), [e2])
+    # Removing it again does nothing
+    self.sw._rx_ctl(('remove', 7))
+    self.assertEqual(self.sw.table.entries, [e2])
+
+  def test_ports(self):
+    self.sw._rx_ctl(('ports', [(2, OFPPC_NO_FWD, 0), (3, OFPPC_NO_FWD, 0)]))
+    self.assertEqual(self.sw.ports[1].config, 0)
+    self.assertEqual(self.sw.ports[2].config, OFPPC_NO_FWD)
+
+  def test_report(self):
+    e = self._add(7, _entry(1, 2))
+    e2 = self._add(8, _entry(2, 1))
+    e.touch_packet(100, now=5)
+    e.touch_packet(50, now=6)
+    self.sw.port_stats[1].rx_packets += 2
+    self.sw.port_stats[1].rx_bytes += 150
+    self.sw._lookup_count += 3
+    self.sw._matched_count += 2
+    self.sw._report()
+    self.assertEqual(self.out_q.get(block=False),
+                     ('counters', [(7, 2, 150, 6)], [(1, (2, 150, 0, 0))],
+                      3, 2))
+
+    # Nothing new, so nothing to report
+    self.sw._report()
+    self.assertTrue(self.out_q.empty())
+
+    # Only what changed since the last report
+    e.touch_packet(10, now=7)
+    self.sw.port_stats[2].tx_packets += 1
+    self.sw.port_stats[2].tx_bytes += 10
+    self.sw._lookup_count += 1
+    self.sw._report()
+    self.assertEqual(self.out_q.get(block=False),
+                     ('counters', [(7, 1, 10, 7)], [(2, (0, 0, 1, 10))],
+                      1, 0))
+
+class WorkerSyncTest(unittest.TestCase):
+  """
+  The POX process's half of keeping the workers' tables in sync
+  """
+  def setUp(self):
+    # Just enough of a PCapSwitch with workers, without the processes
+    self.sw = PCapSwitch.__new__(PCapSwitch)
+    SoftwareSwitchBase.__init__(self.sw, dpid=1, ports=2)
+    self.ctl_q = MockCtlQueue()
+    self.sw._workers = [(None, self.ctl_q)]
+    self.sw._worker_q = None
+    self.sw._entry_ids = {}
+    self.sw._entries_by_id = {}
+    self.sw._entry_actions = {}
+    self.sw._next_entry_id = 1
+
+    # The other end
+    self.out_q = Queue()
+    self.worker = _PCapWorkerSwitch(out_q=self.out_q, dpid=1, ports=2)
+
+  def _sync(self):
+    """ passes what was sent to the workers on to our worker """
+    sent = self.ctl_q.take()
+    for msg in sent:
+      self.worker._rx_ctl(msg)
+    return sent
+
+  def test_add_remove(self):
+    e = _entry(1, 2)
+    e2 = _entry(2, 1)
+    self.sw.table.add_entry(e)
+    self.sw.table.add_entry(e2)
+    sent = self._sync()
+    self.assertEqual([m[:2] for m in sent], [('add', 1), ('add', 2)])
+    self.assertEqual(self.sw._entry_ids, {e: 1, e2: 2})
+    self.assertEqual(self.sw._entries_by_id, {1: e, 2: e2})
+    ports = [w.match.in_port for w in self.worker.table.entries]
+    self.assertEqual(sorted(ports), [1, 2])
+
+    self.sw.table.remove_entry(e)
+    self.assertEqual(self._sync(), [('remove', 1)])
+    self.assertEqual(self.sw._entry_ids, {e2: 2})
+    self.assertEqual(self.sw._entries_by_id, {2: e2})
+    self.assertEqual(self.sw._entry_actions, {e2: e2.actions})
+    self.assertEqual(self.worker._entries_by_id.keys(), [2])
+    self.assertEqual(len(self.worker.table.entries), 1)
+
+  def test_modify(self):
+    e = _entry(1, 2)
+    e2 = _entry(2, 1)
+    self.sw.table.add_entry(e)
+    self.sw.table.add_entry(e2)
+    self._sync()
+    fm = ofp_flow_mod(command=OFPFC_MODIFY, match=ofp_match(in_port=1),
+                      actions=[ofp_action_output(port=OFPP_FLOOD)])
+    self.sw._flow_mod_modify(fm, None, self.sw.table)
+    sent = self._sync()
+    # Only the entry whose actions changed
+    self.assertEqual([m[:2] for m in sent], [('modify', 1)])
+    self.assertTrue(self.sw._entry_actions[e] is e.actions)
+    self.assertEqual([a.port for a in self.worker._entries_by_id[1].actions],
+                     [OFPP_FLOOD])
+    self.assertEqual([a.port for a in self.worker._entries_by_id[2].actions],
+                     [1])
+    # Modifying nothing adds, and the existing entries aren't sent again
+    self.sw._flow_mod_modify(ofp_flow_mod(command=OFPFC_MODIFY,
+                                          match=ofp_match(in_port=3)),
+                             None, self.sw.table)
+    self.assertEqual([m[:2] for m in self._sync()], [('add', 3)])
+
+  def test_counters(self):
+    e = _entry(1, 2)
+    self.sw.table.add_entry(e)
+    self._sync()
+    we = self.worker._entries_by_id[1]
+    we.touch_packet(300, now=12, packet_count=3)
+    self.worker.port_stats[1].rx_packets += 3
+    self.worker.port_stats[1].rx_bytes += 300
+    self.worker.port_stats[2].tx_packets += 3
+    self.worker.port_stats[2].tx_bytes += 300
+    self.worker._lookup_count += 4
+    self.worker._matched_count += 3
+    self.worker._report()
+    self.sw.port_stats[1].rx_packets = 1
+    self.sw.port_stats[1].rx_bytes = 60
+    self.sw._rx_worker_batch([self.out_q.get(block=False)])
+
+    self.assertEqual((e.packet_count, e.byte_count, e.last_touched),
+                     (3, 300, 12))
+    s1,s2 = self.sw.port_stats[1],self.sw.port_stats[2]
+    self.assertEqual((s1.rx_packets, s1.rx_bytes, s1.tx_packets, s1.tx_bytes),
+                     (4, 360, 0, 0))
+    self.assertEqual((s2.rx_packets, s2.rx_bytes, s2.tx_packets, s2.tx_bytes),
+                     (0, 0, 3, 300))
+    self.assertEqual((self.sw._lookup_count, self.sw._matched_count), (4, 3))
+
+    # Counters for entries removed in the meantime are dropped
+    self.sw._rx_worker_batch([('counters', [(1, 1, 10, 13), (99, 1, 10, 13)],
+                               [(5, (1, 1, 1, 1))], 0, 0)])
+    self.assertEqual((e.packet_count, e.byte_count), (4, 310))
+
+
+if __name__ == '__main__':
+  unittest.main()
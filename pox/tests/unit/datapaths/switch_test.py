@@ -159,6 +159,85 @@ class SwitchImplTest (unittest.TestCase):
     self.assertEqual(event.port.port_no,3)
     self.assertEqual(event.packet, self.packet)
 
+  def test_rx_packets(self):
+    c = self.conn
+    s = self.switch
+    received = []
+    s.addListener(DpPacketOut, lambda(event): received.append(event))
+    c.to_switch(ofp_flow_mod(xid=124, priority=1,
+                             match=ofp_match(in_port=1, nw_src="1.2.3.4"),
+                             actions = [ ofp_action_output(port=3) ]
+                             ))
+    other = ethernet(
+        src=EthAddr("00:00:00:00:00:01"),
+        dst=EthAddr("00:00:00:00:00:02"),
+        payload=ipv4(srcip=IPAddr("1.2.3.6"),
+        dstip=IPAddr("1.2.3.5"),
+        payload=udp(srcport=1234, dstport=53, payload="haha")))
+
+    s.rx_packets([(self.packet, 1), (other, 1), (self.packet, 1),
+                  (self.packet, 2, self.packet.pack())])
+
+    # The two packets matching the entry go out port 3...
+    self.assertEqual([e.port.port_no for e in received], [3, 3])
+    entry = s.table.entries[0]
+    self.assertEqual(entry.packet_count, 2)
+    self.assertEqual(entry.byte_count, 2 * len(self.packet))
+
+    # ...and the others are sent to the controller
+    self.assertEqual(len(c.received), 2)
+    self.assertEqual(sorted(m.in_port for m in c.received), [1, 2])
+    self.assertEqual(s.port_stats[1].rx_packets, 3)
+    self.assertEqual(s.port_stats[2].rx_packets, 1)
+    self.assertEqual(s.port_stats[2].rx_bytes, len(self.packet.pack()))
+
+  def test_rx_packet_modified_actions(self):
+    c = self.conn
+    s = self.switch
+    received = []
+    s.addListener(DpPacketOut, lambda(event): received.append(event))
+    c.to_switch(ofp_flow_mod(xid=124, priority=1,
+                             match=ofp_match(in_port=1),
+                             actions = [ ofp_action_output(port=3) ]))
+    s.rx_packet(self.packet, in_port=1)
+    self.assertEqual([e.port.port_no for e in received], [3])
+
+    # Modifying the entry's actions takes effect for the next packet
+    c.to_switch(ofp_flow_mod(xid=125, command=OFPFC_MODIFY, priority=1,
+                             match=ofp_match(in_port=1),
+                             actions = [ ofp_action_vlan_vid(vlan_vid=7),
+                                         ofp_action_output(port=2),
+                                         ofp_action_output(port=4) ]))
+    s.rx_packet(self.packet, in_port=1)
+    self.assertEqual([e.port.port_no for e in received], [3, 2, 4])
+    self.assertEqual(received[-1].packet.payload.id, 7)
+
+  def test_rx_packet_data(self):
+    c = self.conn
+    s = self.switch
+    received = []
+    s.addListener(DpPacketOut, lambda(event): received.append(event))
+    c.to_switch(ofp_flow_mod(xid=124, priority=1,
+                             match=ofp_match(in_port=1),
+                             actions = [ ofp_action_output(port=3) ]))
+    c.to_switch(ofp_flow_mod(xid=125, priority=1,
+                             match=ofp_match(in_port=2),
+                             actions = [ ofp_action_dl_addr.set_src(EthAddr("00:00:00:00:00:03")),
+                                         ofp_action_output(port=3) ]))
+    data = self.packet.pack()
+
+    # Unmodified packets keep the data they were received with
+    s.rx_packet(ethernet(data), in_port=1, packet_data=data)
+    self.assertTrue(s._packet_data(received[-1].packet) is data)
+    self.assertEqual(s.port_stats[3].tx_bytes, len(data))
+
+    # Rewriting a header discards it
+    s.rx_packet(ethernet(data), in_port=2, packet_data=data)
+    out = received[-1].packet
+    self.assertEqual(out.src, EthAddr("00:00:00:00:00:03"))
+    self.assertEqual(s._packet_data(out), out.pack())
+    self.assertNotEqual(s._packet_data(out), data)
+
   def test_delete_port(self):
     c = self.conn
     s = self.switch
@@ -325,6 +404,60 @@ class ProcessFlowModTest(unittest.TestCase):
 
 
 
+class MockLog(object):
+  def __init__(self):
+    self.warnings = []
+
+  def warn(self, msg, *args):
+    self.warnings.append(msg % args)
+
+class PacketBufferTest (unittest.TestCase):
+  def test_allocate_release(self):
+    b = PacketBuffer(2, max_age=5)
+    id1 = b.allocate("p1", 1, now=0)
+    id2 = b.allocate("p2", 2, now=1)
+    self.assertEqual(len(b), 2)
+    self.assertEqual(b.allocate("p3", 3, now=2), None)
+    self.assertEqual(b.release(id1), ("p1", 1))
+    self.assertEqual(b.release(id1), None)
+
+    # The slot gets reused, but not the ID
+    id3 = b.allocate("p3", 3, now=3)
+    self.assertNotEqual(id3, id1)
+    self.assertEqual(b.release(id1), None)
+
+    # p2 is old enough to be evicted to make room
+    id4 = b.allocate("p4", 4, now=6)
+    self.assertEqual(b.release(id2), None)
+    self.assertEqual(b.release(id4), ("p4", 4))
+    self.assertEqual(b.release(id3), ("p3", 3))
+    stats = b.get_stats()
+    self.assertEqual((stats['allocated'], stats['released'], stats['evicted'],
+                      stats['failed'], stats['stale'], stats['in_use']),
+                     (4, 3, 1, 1, 3, 0))
+
+  def test_full_warning(self):
+    s = SoftwareSwitch(1, name="sw1", max_buffers=1)
+    s.packet_buffer.max_age = None
+    s.log = MockLog()
+    warnings = s.log.warnings
+    self.assertNotEqual(s._buffer_packet("p1", 1), None)
+    self.assertEqual(s._buffer_packet("p2", 1), None)
+    self.assertEqual(s._buffer_packet("p3", 1), None)
+    # Only once in a while, with the counters
+    self.assertEqual(len(warnings), 1)
+    self.assertTrue("allocated=1" in warnings[0])
+    self.assertTrue("failed=1" in warnings[0])
+    s._buffer_warn_time -= s.buffer_warn_period
+    self.assertEqual(s._buffer_packet("p4", 1), None)
+    self.assertEqual(len(warnings), 2)
+    self.assertTrue("failed=3" in warnings[1])
+
+    # Not when buffering is turned off
+    s = SoftwareSwitch(1, name="sw1", max_buffers=0)
+    s.log = MockLog()
+    self.assertEqual(s._buffer_packet("p1", 1), None)
+    self.assertEqual(s.log.warnings, [])
 
 if __name__ == '__main__':
   unittest.main()
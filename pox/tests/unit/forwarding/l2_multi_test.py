@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import sys
+import os.path
+import random
+
+sys.path.append(os.path.dirname(__file__) + "/../../..")
+import pox.openflow.libopenflow_01 as of
+import pox.forwarding.l2_multi as l2_multi
+from pox.forwarding.l2_multi import PathMap, InstalledPath
+
+def bfs_distances (links, a):
+  """ distances from a over the undirected links, for checking PathMap """
+  dist = {a:0}
+  frontier = [a]
+  while frontier:
+    new_frontier = []
+    for u in frontier:
+      for x,y in links:
+        for s,t in ((x,y),(y,x)):
+          if s == u and t not in dist:
+            dist[t] = dist[u] + 1
+            new_frontier.append(t)
+    frontier = new_frontier
+  return dist
+
+# 1 -> {2,3} -> 4 -> {5,6} -> 7
+TWO_STAGE = ((1,2),(1,3),(2,4),(3,4),(4,5),(4,6),(5,7),(6,7))
+
+def two_stage ():
+  pm = PathMap()
+  for a,b in TWO_STAGE:
+    pm.add_link(a, b)
+  return pm
+
+class PathMapTest(unittest.TestCase):
+  def check (self, pm, nodes, links):
+    for a in nodes:
+      dist = bfs_distances(links, a)
+      for b in nodes:
+        self.assertEqual(pm.distance(a, b), dist.get(b))
+        path = pm.intermediates(a, b)
+        if b not in dist:
+          self.assertEqual(path, None)
+          continue
+        self.assertEqual(len(path), max(dist[b] - 1, 0))
+        # Every step is over a link
+        hops = [a] + path + [b] if a != b else [a]
+        for s,t in zip(hops[:-1], hops[1:]):
+          self.assertTrue((s,t) in links or (t,s) in links)
+
+  def test_incremental (self):
+    r = random.Random(4)
+    nodes = range(1, 13)
+    pm = PathMap()
+    for n in nodes: pm.add_node(n)
+    links = set()
+    for i in range(150):
+      a,b = r.sample(nodes, 2)
+      if (a,b) in links or (b,a) in links:
+        links.discard((a,b))
+        links.discard((b,a))
+        pm.remove_link(a, b)
+      else:
+        links.add((a,b))
+        pm.add_link(a, b)
+      if i % 10 == 0:
+        self.check(pm, nodes, links)
+    self.check(pm, nodes, links)
+
+  def test_remove_partitions (self):
+    pm = PathMap()
+    pm.add_link(1, 2)
+    pm.add_link(2, 3)
+    self.assertEqual(pm.intermediates(1, 3), [2])
+    pm.remove_link(2, 3)
+    self.assertEqual(pm.distance(1, 3), None)
+    self.assertEqual(pm.intermediates(1, 3), None)
+    self.assertEqual(pm.path_count(1, 3), 0)
+    pm.add_link(1, 3)
+    self.assertEqual(pm.intermediates(1, 3), [])
+
+  def test_ecmp (self):
+    pm = two_stage()
+    self.assertEqual(pm.next_hops(1, 7), [2, 3])
+    self.assertEqual(pm.path_count(1, 7), 4)
+    paths = [pm.intermediates(1, 7, h) for h in range(4)]
+    self.assertEqual(sorted(paths), [[2,4,5], [2,4,6], [3,4,5], [3,4,6]])
+    # Only the hash modulo the number of paths matters
+    for h in (4, 9, 0xffffFFFF):
+      self.assertEqual(pm.intermediates(1, 7, h), paths[h % 4])
+
+  def test_ecmp_uneven (self):
+    # Two paths through 2 and one through 3; each path gets a third
+    pm = PathMap()
+    for a,b in ((1,2),(1,3),(2,4),(2,5),(3,6),(4,7),(5,7),(6,7)):
+      pm.add_link(a, b)
+    self.assertEqual(pm.path_count(1, 7), 3)
+    self.assertEqual(sorted(pm.intermediates(1, 7, h) for h in range(3)),
+                     [[2,4], [2,5], [3,6]])
+
+  def test_long_chain (self):
+    # Longer than recursion would allow
+    n = sys.getrecursionlimit() + 50
+    pm = PathMap()
+    for i in range(1, n):
+      pm.add_link(i, i + 1)
+    self.assertEqual(pm.distance(1, n), n - 1)
+    self.assertEqual(pm.path_count(1, n), 1)
+    self.assertEqual(pm.intermediates(1, n, 12345), range(2, n))
+
+class GetPathTest(unittest.TestCase):
+  def setUp (self):
+    self.old_path_map = l2_multi.path_map
+    l2_multi.path_map = two_stage()
+    l2_multi.adjacency.clear()
+    for a,b in TWO_STAGE:
+      l2_multi.adjacency[a][b] = 10 + b
+      l2_multi.adjacency[b][a] = 10 + a
+    l2_multi.path_cache.clear()
+    l2_multi.path_counts.clear()
+
+  def tearDown (self):
+    l2_multi.path_map = self.old_path_map
+    l2_multi.adjacency.clear()
+    l2_multi.path_cache.clear()
+    l2_multi.path_counts.clear()
+
+  def test_cache_by_path (self):
+    r = random.Random(1)
+    seen = set()
+    for i in range(100):
+      h = r.randint(0, 0xffffFFFF)
+      p = l2_multi._get_path(1, 7, 1, 2, h)
+      self.assertTrue(p is l2_multi._get_path(1, 7, 1, 2, h % 4))
+      self.assertEqual(p[0], (1, 1, 10 + p[1][0]))
+      self.assertEqual(p[-1][0], 7)
+      self.assertEqual(p[-1][2], 2)
+      seen.add(tuple(p))
+    # All paths get used, but there's a cache entry per path, not per hash
+    self.assertEqual(len(seen), 4)
+    self.assertEqual(len(l2_multi.path_cache), 4)
+
+  def test_no_path (self):
+    l2_multi.path_map.add_node(8)
+    self.assertEqual(l2_multi._get_path(1, 8, 1, 2, 12345), None)
+    self.assertEqual(l2_multi._get_path(1, 1, 1, 2, 12345), [(1, 1, 2)])
+
+class MockConnection (object):
+  def __init__ (self):
+    self.sent = []
+
+  def send (self, msg):
+    self.sent.append(msg)
+
+class MockSwitch (object):
+  def __init__ (self, dpid):
+    self.dpid = dpid
+    self.connection = MockConnection()
+
+class InstalledPathTest(unittest.TestCase):
+  def setUp (self):
+    self.sw = dict((dpid, MockSwitch(dpid)) for dpid in (1, 2, 3))
+    l2_multi.installed_paths.clear()
+    l2_multi.link_paths.clear()
+
+  def tearDown (self):
+    l2_multi.installed_paths.clear()
+    l2_multi.link_paths.clear()
+
+  def _path (self, *dpids):
+    """ a path over the given switches, with port 10+n leading to n """
+    sws = [self.sw[dpid] for dpid in dpids]
+    hops = zip([None] + sws[:-1], sws, sws[1:] + [None])
+    return [(sw, 10 + a.dpid if a else 1, 10 + b.dpid if b else 2)
+            for a,sw,b in hops]
+
+  def _key (self, a, b):
+    return l2_multi._link_key(self.sw[a], self.sw[b])
+
+  def test_remove_over_link (self):
+    p1 = InstalledPath(self._path(1, 2, 3), of.ofp_match(dl_type=1))
+    p2 = InstalledPath(self._path(1, 2), of.ofp_match(dl_type=2))
+    self.assertNotEqual(p1.cookie, p2.cookie)
+    self.assertEqual(l2_multi.installed_paths, {p1.cookie:p1, p2.cookie:p2})
+    self.assertEqual(dict(l2_multi.link_paths),
+                     {self._key(1, 2):set([p1.cookie, p2.cookie]),
+                      self._key(2, 3):set([p1.cookie])})
+
+    # Either way around is the same link
+    l2_multi._remove_paths_over_link(self.sw[3], self.sw[2])
+
+    # Only the path over it has its flows deleted, all along the path
+    for sw,in_port,out_port in p1.path:
+      self.assertEqual(len(sw.connection.sent), 1)
+      msg = sw.connection.sent[0]
+      self.assertEqual(msg.command, of.OFPFC_DELETE_STRICT)
+      self.assertEqual(msg.cookie, p1.cookie)
+      self.assertEqual(msg.match.dl_type, 1)
+      self.assertEqual(msg.match.in_port, in_port)
+    self.assertEqual(l2_multi.installed_paths, {p2.cookie:p2})
+    self.assertEqual(dict(l2_multi.link_paths),
+                     {self._key(1, 2):set([p2.cookie])})
+
+    # Nothing left over the link to remove
+    l2_multi._remove_paths_over_link(self.sw[2], self.sw[3])
+    self.assertEqual(len(self.sw[3].connection.sent), 1)
+
+  def test_expire (self):
+    p1 = InstalledPath(self._path(1, 2, 3), of.ofp_match(dl_type=1))
+    p2 = InstalledPath(self._path(2, 3), of.ofp_match(dl_type=2))
+    p1.expires_at = 0
+    InstalledPath.expire_installed_paths()
+    # Forgotten, but its flows are left to time out on their own
+    self.assertEqual(l2_multi.installed_paths, {p2.cookie:p2})
+    self.assertEqual(dict(l2_multi.link_paths),
+                     {self._key(2, 3):set([p2.cookie])})
+    self.assertEqual([sw.connection.sent for sw in self.sw.values()],
+                     [[], [], []])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import sys
+import os.path
+import logging
+
+sys.path.append(os.path.dirname(__file__) + "/../../..")
+from pox.openflow.libopenflow_01 import *
+from pox.lib.addresses import IPAddr
+import pox.forwarding.topo_proactive as topo_proactive
+from pox.forwarding.topo_proactive import TopoSwitch, dpid_to_mac
+
+class MockARPHelper(object):
+  def addListeners(self, sink):
+    pass
+
+class MockDiscovery(object):
+  def is_edge_port(self, dpid, port):
+    return False
+
+class MockCore(object):
+  def __init__(self):
+    self.ARPHelper = MockARPHelper()
+    self.openflow_discovery = MockDiscovery()
+
+class MockConnection(object):
+  def __init__(self, dpid):
+    self.dpid = dpid
+    self.sent = []
+
+  def send(self, data):
+    self.sent.append(data)
+
+  def flow_mods(self):
+    """ unpacks (and forgets) the flow-mods sent so far """
+    mods = []
+    for data in self.sent:
+      offset = 0
+      while offset < len(data):
+        fm = ofp_flow_mod()
+        offset,length = fm.unpack(data, offset)
+        mods.append(fm)
+    self.sent = []
+    return mods
+
+class TopoProactiveTest(unittest.TestCase):
+  def setUp(self):
+    self.old_core = topo_proactive.core
+    topo_proactive.core = MockCore()
+    self._clear()
+    # 1 - 2 - 3, with port 10+n on each switch leading to switch n
+    self.sw = {}
+    for dpid in (1, 2, 3):
+      self.sw[dpid] = self._switch(dpid, [10 + n for n in (1, 2, 3)
+                                          if n != dpid])
+    self._link(1, 2)
+    self._link(2, 3)
+
+  def tearDown(self):
+    topo_proactive.core = self.old_core
+    self._clear()
+
+  def _clear(self):
+    topo_proactive.adjacency.clear()
+    topo_proactive.switches_by_dpid.clear()
+    topo_proactive.switches_by_id.clear()
+    topo_proactive.next_hops.clear()
+
+  def _switch(self, dpid, ports):
+    sw = TopoSwitch()
+    sw.log = logging.getLogger("topo_proactive_test")
+    sw.connection = MockConnection(dpid)
+    sw.dpid = dpid
+    sw._id = 100 + dpid
+    sw.network = IPAddr("10.%s.0.0" % (sw._id,))
+    sw.mac = dpid_to_mac(dpid)
+    sw.ports = [ofp_phy_port(port_no=p) for p in ports]
+    topo_proactive.switches_by_dpid[dpid] = sw
+    topo_proactive.switches_by_id[sw._id] = sw
+    return sw
+
+  def _link(self, a, b):
+    sa,sb = self.sw[a],self.sw[b]
+    topo_proactive.adjacency[sa][sb] = 10 + b
+    topo_proactive.adjacency[sb][sa] = 10 + a
+    topo_proactive.next_hops.clear()
+
+  def _unlink(self, a, b):
+    sa,sb = self.sw[a],self.sw[b]
+    del topo_proactive.adjacency[sa][sb]
+    del topo_proactive.adjacency[sb][sa]
+    topo_proactive.next_hops.clear()
+
+  def _route(self, fm):
+    """ (command, destination switch id, output port) for a route rule """
+    dst = fm.match.nw_dst
+    ports = [a.port for a in fm.actions if isinstance(a, ofp_action_output)]
+    return (fm.command, int(str(dst).split('.')[1]), ports)
+
+  def test_first_send(self):
+    sw = self.sw[1]
+    sw.send_table()
+    # sent in a single write
+    self.assertEqual(len(sw.connection.sent), 1)
+    mods = sw.connection.flow_mods()
+    self.assertEqual(len(mods), len(sw._rules()))
+    self.assertTrue(all(fm.command == OFPFC_ADD for fm in mods))
+    # nothing has changed since
+    sw.send_table()
+    self.assertEqual(sw.connection.flow_mods(), [])
+
+  def test_link_change(self):
+    sw = self.sw[1]
+    sw.send_table()
+    sw.connection.flow_mods()
+    table = dict(sw._table)
+
+    # A direct link to 3 only changes the route to 3
+    self._link(1, 3)
+    sw.send_table()
+    mods = sw.connection.flow_mods()
+    self.assertEqual([self._route(fm) for fm in mods],
+                     [(OFPFC_ADD, 103, [13])])
+    self.assertEqual(len(sw._table), len(table))
+
+    # Losing the link to 2 reroutes 2 through 3
+    self._unlink(1, 2)
+    sw.send_table()
+    mods = sw.connection.flow_mods()
+    self.assertEqual([self._route(fm) for fm in mods],
+                     [(OFPFC_ADD, 102, [13])])
+
+  def test_stale_rules_removed(self):
+    sw = self.sw[1]
+    sw.send_table()
+    sw.connection.flow_mods()
+
+    # 3 goes away entirely, so there's no longer a route to it
+    self._unlink(2, 3)
+    del topo_proactive.switches_by_dpid[3]
+    sw.send_table()
+    mods = sw.connection.flow_mods()
+    self.assertEqual([self._route(fm) for fm in mods],
+                     [(OFPFC_DELETE_STRICT, 103, [])])
+    self.assertEqual(mods[0].priority, OFP_DEFAULT_PRIORITY)
+    self.assertFalse(any(key[1].nw_dst == IPAddr("10.103.0.0")
+                         for key in sw._table))
+
+  def test_rewrite_rule(self):
+    sw = self.sw[1]
+    sw.send_table()
+    sw.connection.flow_mods()
+    ip = IPAddr("10.101.11.5")
+    mac = dpid_to_mac(0x55)
+    self.assertTrue(sw._mac_learn(mac, ip))
+    mods = sw.connection.flow_mods()
+    self.assertEqual(len(mods), 1)
+    self.assertEqual(mods[0].match.nw_dst, ip)
+    self.assertEqual(mods[0].actions[-1].port, 11)
+    # Learning it again sends nothing, and it stays in the full table
+    self.assertFalse(sw._mac_learn(mac, ip))
+    sw.send_table()
+    self.assertEqual(sw.connection.flow_mods(), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
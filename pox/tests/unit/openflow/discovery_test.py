@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import sys
+import os.path
+
+sys.path.append(os.path.dirname(__file__) + "/../../..")
+import pox.openflow.discovery as discovery
+from pox.openflow.discovery import *
+from pox.openflow.discovery import _parse_discovery_frame
+from pox.lib.addresses import EthAddr
+
+class LinkStateTest(unittest.TestCase):
+  def _links (self):
+    links = LinkState()
+    links[Link(1,1, 2,1)] = 0
+    links[Link(2,1, 1,1)] = 0
+    links[Link(2,2, 3,1)] = 0
+    return links
+
+  def test_indexes (self):
+    links = self._links()
+    self.assertEqual(len(links), 3)
+    self.assertEqual(sorted(links.links_for_dpid(2)),
+                     [Link(1,1, 2,1), Link(2,1, 1,1), Link(2,2, 3,1)])
+    self.assertEqual(links.links_between(2, 3), [Link(2,2, 3,1)])
+    self.assertEqual(links.links_between(3, 2), [])
+    self.assertFalse(links.is_edge_port(3, 1))
+    self.assertTrue(links.is_edge_port(3, 2))
+
+    links.pop(Link(2,2, 3,1))
+    self.assertTrue(links.is_edge_port(3, 1))
+    self.assertEqual(links.links_for_dpid(3), [])
+    self.assertEqual(links.pop(Link(2,2, 3,1), None), None)
+
+  def test_generation (self):
+    links = self._links()
+    g = links.generation
+    links[Link(2,2, 3,1)] = 5 # Just seen again
+    self.assertEqual(links.generation, g)
+    links[Link(3,1, 2,2)] = 5
+    self.assertEqual(links.generation, g + 1)
+    del links[Link(3,1, 2,2)]
+    self.assertEqual(links.generation, g + 2)
+
+  def test_switch_adjacency (self):
+    links = self._links()
+    # The 2->3 link only goes one way
+    self.assertEqual(links.switch_adjacency(), {1:{2:1}, 2:{1:1}})
+    self.assertTrue(links.switch_adjacency() is links.switch_adjacency())
+    links[Link(3,1, 2,2)] = 0
+    self.assertEqual(links.switch_adjacency(),
+                     {1:{2:1}, 2:{1:1, 3:2}, 3:{2:1}})
+
+  def test_expire (self):
+    links = self._links()
+    links[Link(2,1, 1,1)] = 10
+    self.assertEqual(links.expire(0), [])
+    self.assertEqual(sorted(links.expire(8)), [Link(1,1, 2,1), Link(2,2, 3,1)])
+    # Expired links are only reported once
+    self.assertEqual(links.expire(8), [])
+    self.assertEqual(links.expire(11), [Link(2,1, 1,1)])
+
+class DiscoveryFrameTest(unittest.TestCase):
+  def test_parse_discovery_frame (self):
+    eth = LLDPSender._create_discovery_packet(0x1234abcd, 7,
+        EthAddr("00:00:00:00:00:01"), 120)
+    data = eth.pack()
+    self.assertEqual(_parse_discovery_frame(data), (0x1234abcd, 7))
+
+    # Truncated or not ours
+    self.assertEqual(_parse_discovery_frame(data[:30]), None)
+    eth.payload.tlvs[3].payload = 'dpid:1'
+    self.assertEqual(_parse_discovery_frame(eth.pack()), None)
+    self.assertEqual(_parse_discovery_frame(data[:12] + '\x08\x00' +
+                                            data[14:]), None)
+
+class FakeClock (object):
+  """ stands in for the time module, and for Timer """
+  def __init__ (self):
+    self.now = 0.0
+
+  def time (self):
+    return self.now
+
+  def Timer (self, delay, callback):
+    return FakeTimer(self.now + delay, callback)
+
+class FakeTimer (object):
+  def __init__ (self, due, callback):
+    self.due = due
+    self.callback = callback
+    self.cancelled = False
+
+  def cancel (self):
+    self.cancelled = True
+
+class MockCore (object):
+  def __init__ (self, clock):
+    self.openflow = self
+    self.clock = clock
+    self.sent = [] # (time, dpid, data)
+
+  def listen_to_dependencies (self, sink):
+    pass
+
+  def sendToDPID (self, dpid, data):
+    self.sent.append((self.clock.now, dpid, data))
+
+class MockLLDPSender (LLDPSender):
+  def create_packet_out (self, dpid, port_num, port_addr):
+    # Easier to pick out of a batch than a real packet_out
+    return "%s.%s;" % (dpid, port_num)
+
+class LLDPSenderTest (unittest.TestCase):
+  def setUp (self):
+    self.clock = FakeClock()
+    self.core = MockCore(self.clock)
+    self.old = (discovery.time, discovery.Timer, discovery.random,
+                discovery.core)
+    discovery.time = self.clock
+    discovery.Timer = self.clock.Timer
+    discovery.random = lambda: 0.5
+    discovery.core = self.core
+    # Probed quickly every 1s, backing off to every 8s
+    self.sender = MockLLDPSender(8)
+
+  def tearDown (self):
+    (discovery.time, discovery.Timer, discovery.random,
+     discovery.core) = self.old
+
+  def _run (self, until):
+    """ fires the sender's timer until the given time """
+    while self.sender._timer and self.sender._timer.due <= until:
+      timer = self.sender._timer
+      self.assertFalse(timer.cancelled)
+      self.clock.now = timer.due
+      timer.callback()
+    self.clock.now = until
+
+  def _sends (self, port, since = 0):
+    """ times the given port's packet was sent at """
+    return [t for t,dpid,data in self.core.sent
+            if t >= since and port in data.split(';')]
+
+  def _gaps (self, times):
+    return [round(b - a, 6) for a,b in zip(times[:-1], times[1:])]
+
+  def test_backoff (self):
+    self.sender.add_port(1, 1, None)
+    self._run(40)
+    times = self._sends("1.1")
+    # Sent half way through the fast interval, then backing off
+    self.assertEqual(times[0], 0.5)
+    self.assertEqual(self._gaps(times), [2, 4, 8, 8, 8, 8])
+    self.assertEqual(self.sender._items[1,1].interval, 8)
+
+  def test_batched (self):
+    for port in (1, 2, 3):
+      self.sender.add_port(1, port, None)
+    self.sender.add_port(2, 1, None)
+    self._run(1)
+    self.assertEqual(sorted(self.core.sent),
+                     [(0.5, 1, "1.1;1.2;1.3;"), (0.5, 2, "2.1;")])
+
+  def test_reset (self):
+    self.sender.add_port(1, 1, None)
+    self.sender.add_port(1, 2, None)
+    self._run(30)
+    self.assertEqual(self.sender._items[1,2].interval, 8)
+
+    # Its status changed, so it's probed quickly again
+    self.sender.reset_port(1, 2)
+    self.assertEqual(self.sender._items[1,2].interval, 1)
+    self._run(60)
+    times = self._sends("1.2", since = 30)
+    self.assertEqual(times[0], 30.5)
+    self.assertEqual(self._gaps(times), [2, 4, 8, 8])
+    # Its old heap entry was stale, so it's not sent any extra times
+    self.assertEqual(len(self._sends("1.1", since = 30)), 4)
+
+    # Resetting it again while it's being probed quickly does nothing
+    self.sender.reset_port(1, 2)
+    heap_len = len(self.sender._heap)
+    self.sender.reset_port(1, 2)
+    self.assertEqual(len(self.sender._heap), heap_len)
+
+  def test_removed (self):
+    self.sender.add_port(1, 1, None)
+    self.sender.add_port(1, 2, None)
+    self.sender.add_port(2, 1, None)
+    self._run(10)
+    self.sender.del_port(1, 1)
+    self.sender.del_switch(2)
+    self._run(100)
+    self.assertEqual(self._sends("1.1", since = 10), [])
+    self.assertEqual(self._sends("2.1", since = 10), [])
+    self.assertNotEqual(self._sends("1.2", since = 10), [])
+    # Their stale heap entries are dropped as they come up
+    self.assertEqual(set(key for due,seq,key in self.sender._heap),
+                     set([(1,2)]))
+
+    # Nothing left to send, so no timer
+    self.sender.del_port(1, 2)
+    self.assertEqual(self.sender._timer, None)
+    self.assertEqual(self.sender._heap, [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -111,8 +111,140 @@ class FlowTableTest(unittest.TestCase):
       t.remove_expired_entries(now=time)
       self.assertEqual(sorted([e.cookie for e in t.entries]), remaining)
 
+  def test_remove_expired_entries_removed_early(self):
+    """ test that entries removed before expiring don't come back to haunt """
+    t = FlowTable()
+    e1 = TableEntry(now=0, cookie=1, idle_timeout=5)
+    t.add_entry(e1)
+    t.add_entry(TableEntry(now=0, cookie=2, hard_timeout=10))
+    t.remove_entry(e1)
+    t.add_entry(e1)
+    removed = []
+    t.addListener(FlowTableModification, lambda ev: removed.extend(ev.removed))
+    t.remove_expired_entries(now=6)
+    self.assertEqual([e.cookie for e in removed], [1])
+    self.assertEqual([e.cookie for e in t.entries], [2])
+    t.remove_expired_entries(now=11)
+    self.assertEqual([e.cookie for e in removed], [1, 2])
+    self.assertEqual(len(t), 0)
+
+  def test_remove_entry_same_priority(self):
+    """ test removing single entries from among many of the same priority """
+    t = FlowTable()
+    t.add_entry(TableEntry(priority=7, cookie=0, match=ofp_match(), actions=[]))
+    entries = []
+    for i in range(1, 101):
+      # all exact matches, so all of them have the same effective priority
+      m = ofp_match(in_port=1, dl_src=EthAddr("00:00:00:00:00:01"),
+                    dl_dst=EthAddr("00:00:00:00:00:%02x" % i), dl_vlan=1,
+                    dl_vlan_pcp=0, dl_type=0x0800, nw_tos=0, nw_proto=6,
+                    nw_src="1.2.3.4", nw_dst="1.2.3.5", tp_src=1, tp_dst=i)
+      self.assertTrue(m.is_exact)
+      entries.append(TableEntry(priority=i, cookie=i, match=m, actions=[]))
+      t.add_entry(entries[-1])
+    # newest first among equal priorities
+    self.assertEqual([e.cookie for e in t.entries], range(100, -1, -1))
+
+    for i in (50, 1, 100, 2, 99):
+      t.remove_entry(entries[i - 1])
+    remaining = [i for i in range(100, -1, -1) if i not in (50, 1, 100, 2, 99)]
+    self.assertEqual([e.cookie for e in t.entries], remaining)
+    self.assertRaises(ValueError, t.remove_entry, entries[49])
+
+    # removing a few through a strict match
+    t.remove_matching_entries(entries[9].match, priority=10, strict=True)
+    remaining.remove(10)
+    self.assertEqual([e.cookie for e in t.entries], remaining)
+
+  def test_entry_for_packet(self):
+    """ test that exact and wildcarded entries are found for packets """
+    packet = ethernet(
+        src=EthAddr("00:00:00:00:00:01"),
+        dst=EthAddr("00:00:00:00:00:02"),
+        payload=ipv4(srcip=IPAddr("1.2.3.4"),
+        dstip=IPAddr("1.2.3.5"),
+        payload=udp(srcport=1234, dstport=53, payload="haha")))
+    exact = ofp_match.from_packet(packet, in_port=1)
+
+    t = FlowTable()
+    t.add_entry(TableEntry(priority=5, cookie=0x1, match=ofp_match(nw_src="1.2.3.0/24")))
+    t.add_entry(TableEntry(priority=9, cookie=0x2, match=ofp_match(in_port=2)))
+    self.assertEqual(t.entry_for_packet(packet, 1).cookie, 0x1)
+
+    # Exact entries win regardless of priority; the newest one is used
+    t.add_entry(TableEntry(priority=1, cookie=0x3, match=exact))
+    t.add_entry(TableEntry(priority=1, cookie=0x4, match=exact.clone()))
+    self.assertEqual(t.entry_for_packet(packet, 1).cookie, 0x4)
+    self.assertEqual(t.entry_for_packet(packet, 2).cookie, 0x2)
+
+    t.remove_matching_entries(exact, priority=1, strict=True)
+    self.assertEqual([e.cookie for e in t.entries], [2, 1])
+    self.assertEqual(t.entry_for_packet(packet, 1).cookie, 0x1)
+    self.assertEqual(t.entry_for_packet(packet, 3).cookie, 0x1)
+
+  def test_entry_for_packet_wildcards(self):
+    """ test priorities across different wildcard combinations """
+    packet = ethernet(
+        src=EthAddr("00:00:00:00:00:01"),
+        dst=EthAddr("00:00:00:00:00:02"),
+        payload=ipv4(srcip=IPAddr("10.1.2.3"),
+        dstip=IPAddr("10.4.5.6"),
+        payload=udp(srcport=1234, dstport=53, payload="haha")))
+
+    t = FlowTable()
+    t.add_entry(TableEntry(priority=5, cookie=0x1, match=ofp_match(nw_src="10.0.0.0/8")))
+    t.add_entry(TableEntry(priority=5, cookie=0x2, match=ofp_match(nw_dst="10.4.0.0/16")))
+    t.add_entry(TableEntry(priority=7, cookie=0x3, match=ofp_match(nw_src="10.2.0.0/16")))
+    t.add_entry(TableEntry(priority=3, cookie=0x4, match=ofp_match(tp_dst=53)))
+    # Equal priorities: the most recently added entry wins
+    self.assertEqual(t.entry_for_packet(packet, 1).cookie, 0x2)
+
+    t.add_entry(TableEntry(priority=6, cookie=0x5, match=ofp_match(nw_src="10.1.2.0/24", tp_dst=53)))
+    self.assertEqual(t.entry_for_packet(packet, 1).cookie, 0x5)
+
+    t.remove_matching_entries(ofp_match(tp_dst=53))
+    self.assertEqual([e.cookie for e in t.entries], [3, 2, 1])
+    self.assertEqual(t.entry_for_packet(packet, 1).cookie, 0x2)
+    t.remove_matching_entries(ofp_match(nw_dst="10.4.0.0/16"), priority=5, strict=True)
+    self.assertEqual(t.entry_for_packet(packet, 1).cookie, 0x1)
+    t.remove_matching_entries(ofp_match(nw_src="10.0.0.0/8"))
+    self.assertEqual(t.entry_for_packet(packet, 1), None)
+    self.assertEqual(len(t), 0)
+
   # def test_check_for_overlap_entries(self):
 
+class FlowCacheTest(unittest.TestCase):
+  def _match(self, srcip, srcport):
+    packet = ethernet(
+        src=EthAddr("00:00:00:00:00:01"),
+        dst=EthAddr("00:00:00:00:00:02"),
+        payload=ipv4(srcip=IPAddr(srcip),
+        dstip=IPAddr("10.4.5.6"),
+        payload=udp(srcport=srcport, dstport=53, payload="haha")))
+    return ofp_match.from_packet(packet, 1, spec_frags=True)
+
+  def test_entry_for_match(self):
+    t = FlowTable()
+    t.add_entry(TableEntry(priority=5, cookie=0x1, match=ofp_match(nw_src="10.0.0.0/8")))
+    cache = FlowCache()
+
+    self.assertEqual(cache.entry_for_match(t, self._match("10.1.2.3", 1)).cookie, 0x1)
+    self.assertEqual(cache.entry_for_match(t, self._match("10.1.2.3", 1)).cookie, 0x1)
+    # Only the first 8 bits of nw_src mattered, so this is a megaflow hit
+    self.assertEqual(cache.entry_for_match(t, self._match("10.9.9.9", 2)).cookie, 0x1)
+    self.assertEqual(cache.entry_for_match(t, self._match("11.1.2.3", 1)), None)
+    self.assertEqual((cache.hits, cache.megaflow_hits, cache.misses), (1, 1, 2))
+
+    # Modifying the table flushes the cache
+    t.add_entry(TableEntry(priority=7, cookie=0x2, match=ofp_match(tp_src=2)))
+    self.assertEqual(cache.entry_for_match(t, self._match("10.9.9.9", 2)).cookie, 0x2)
+    self.assertEqual(cache.entry_for_match(t, self._match("10.1.2.3", 1)).cookie, 0x1)
+    self.assertEqual(cache.entry_for_match(t, self._match("11.1.2.3", 2)).cookie, 0x2)
+    self.assertEqual((cache.megaflow_hits, cache.misses), (2, 4))
+
+    # So does switching tables
+    self.assertEqual(cache.entry_for_match(FlowTable(), self._match("10.1.2.3", 1)), None)
+
 
 
 
@@ -135,6 +135,30 @@ class ofp_match_test(unittest.TestCase):
     assertMatch(create(nw_src="10.0.0.0/25"), create(nw_src="10.0.0.127"))
     assertNoMatch(create(nw_src="10.0.0.0/25"), create(nw_src="10.0.0.128"))
 
+  def test_key(self):
+    """ ofp_match: the canonical key tracks changes and drives eq/hash """
+    m = ofp_match(in_port=1, dl_type=0x800, nw_src="10.0.0.0/24", tp_dst=80)
+    k = m.key
+    self.assertTrue(m.key is k, "key should be cached")
+    self.assertEqual(k, m.clone().key)
+    self.assertEqual(m, m.clone())
+    self.assertEqual(hash(m.clone()), hash(m.clone()))
+
+    m2 = m.clone()
+    m2.tp_dst = 22
+    self.assertNotEqual(k, m2.key)
+    self.assertNotEqual(m, m2)
+    m2.tp_dst = 80
+    self.assertEqual(k, m2.key)
+
+    # Prefix length is part of the key via the wildcards
+    m2.nw_src = "10.0.0.0/25"
+    self.assertNotEqual(k, m2.key)
+
+    d = { m : 1 }
+    self.assertEqual(d.get(m.clone()), 1)
+    self.assertRaises(AttributeError, setattr, m, "in_port", 2)
+
 class ofp_command_test(unittest.TestCase):
   # custom map of POX class to header type, for validation
   ofp_type = {
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import sys
+import os.path
+
+sys.path.append(os.path.dirname(__file__) + "/../../..")
+from pox.lib.revent import *
+from pox.openflow.libopenflow_01 import *
+from pox.openflow import *
+import pox.openflow.of_01 as of_01
+from pox.openflow.of_01 import Connection, _raise_event
+import pox.openflow.webservice as webservice
+
+class MockSocket(object):
+  def send(self, data):
+    return len(data)
+  def shutdown(self, how):
+    pass
+  def close(self):
+    pass
+
+class MockDeferredSender(object):
+  """ stands in for the one launch() sets up, since Connection sends """
+  sending = False
+  def send(self, con, data):
+    pass
+  def queued_bytes(self, con=None):
+    return 0
+
+class MockNexus(EventMixin):
+  _eventMixin_events = set([ConnectionDown, FlowStatsReceived, PortStatus])
+  stream_stats = False
+  def __init__(self):
+    EventMixin.__init__(self)
+
+  def _disconnect(self, dpid):
+    pass
+
+class StatsReplyTest(unittest.TestCase):
+  def setUp(self):
+    self.old_sender = of_01.deferredSender
+    of_01.deferredSender = MockDeferredSender()
+    self.nexus = MockNexus()
+    self.con = Connection(MockSocket())
+    self.con.ofnexus = self.nexus
+    self.con.dpid = 1
+    self.events = []
+    self.nexus.addListener(FlowStatsReceived, self.events.append)
+
+  def tearDown(self):
+    of_01.deferredSender = self.old_sender
+
+  def _part(self, xid, more, port):
+    reply = ofp_stats_reply(xid=xid, type=OFPST_FLOW,
+                            body=[ofp_flow_stats(match=ofp_match(in_port=port))])
+    reply.is_last_reply = not more
+    return reply
+
+  def test_buffered(self):
+    self.con._incoming_stats_reply(self._part(5, True, 1))
+    self.assertEqual(self.events, [])
+    self.con._incoming_stats_reply(self._part(5, False, 2))
+    self.assertEqual(len(self.events), 1)
+    self.assertTrue(self.events[0].is_last)
+    self.assertEqual([f.match.in_port for f in self.events[0].stats], [1, 2])
+    self.assertEqual(self.con._previous_stats, {})
+
+  def test_streamed(self):
+    self.nexus.stream_stats = True
+    self.con._incoming_stats_reply(self._part(5, True, 1))
+    self.con._incoming_stats_reply(self._part(5, False, 2))
+    self.assertEqual(len(self.events), 2)
+    self.assertEqual([e.is_last for e in self.events], [False, True])
+    self.assertEqual([[f.match.in_port for f in e.stats] for e in self.events],
+                     [[1], [2]])
+    self.assertEqual(self.con._previous_stats, {})
+
+  def test_disconnect_drops_partial(self):
+    self.con._incoming_stats_reply(self._part(5, True, 1))
+    self.con._incoming_stats_reply(self._part(6, True, 1))
+    self.assertEqual(len(self.con._previous_stats), 2)
+    self.con.close()
+    self.assertEqual(self.con._previous_stats, {})
+    self.assertEqual(self.events, [])
+
+class RaiseEventTest(unittest.TestCase):
+  def setUp(self):
+    self.old_sender = of_01.deferredSender
+    of_01.deferredSender = MockDeferredSender()
+    self.nexus = MockNexus()
+    self.con = Connection(MockSocket())
+    self.con.ofnexus = self.nexus
+    self.con.dpid = 1
+    self.seen = []
+
+  def tearDown(self):
+    of_01.deferredSender = self.old_sender
+
+  def _raise(self):
+    return _raise_event(self.con, PortStatus, self.con, ofp_port_status())
+
+  def _listen(self, source, name, result=None):
+    def handler(event):
+      self.seen.append((name, event, event.source, event.halt))
+      return result
+    source.addListener(PortStatus, handler)
+
+  def test_no_listeners(self):
+    self.assertEqual(self._raise(), None)
+
+  def test_both(self):
+    """ the same event is raised on both, but as if fresh each time """
+    self._listen(self.nexus, "nexus")
+    self._listen(self.con, "con")
+    e = self._raise()
+    self.assertEqual([(n, s, h) for n,ev,s,h in self.seen],
+                     [("nexus", self.nexus, False), ("con", self.con, False)])
+    self.assertTrue(self.seen[0][1] is e and self.seen[1][1] is e)
+
+  def test_halt(self):
+    self._listen(self.nexus, "nexus", EventHalt)
+    self._listen(self.con, "con")
+    e = self._raise()
+    self.assertTrue(e.halt)
+    self.assertEqual([n for n,ev,s,h in self.seen], ["nexus"])
+
+  def test_connection_only(self):
+    self._listen(self.con, "con")
+    self._raise()
+    self.assertEqual([(n, s) for n,ev,s,h in self.seen], [("con", self.con)])
+
+class MockOpenFlow(object):
+  def __init__(self, *cons):
+    self.connections = dict((con.dpid, con) for con in cons)
+
+  def getConnection(self, dpid):
+    return self.connections.get(dpid)
+
+class MockCore(object):
+  def __init__(self, *cons):
+    self.openflow = MockOpenFlow(*cons)
+    self.OpenFlowIOStats = of_01.ioStats
+
+  def hasComponent(self, name):
+    return hasattr(self, name)
+
+class IOStatsTest(unittest.TestCase):
+  def setUp(self):
+    self.old_sender = of_01.deferredSender
+    of_01.deferredSender = MockDeferredSender()
+    of_01.ioStats.reset()
+    self.con = Connection(MockSocket())
+    self.con.dpid = 1
+    # What the handshake sends back for a HELLO
+    self.fr_len = len(ofp_features_request().pack())
+    self.ss_len = len(ofp_stats_request(body=ofp_desc_stats_request()).pack())
+
+  def tearDown(self):
+    of_01.deferredSender = self.old_sender
+    of_01.ioStats.reset()
+
+  def _receive(self):
+    hello = ofp_hello().pack()
+    echo = ofp_echo_request(body='ping').pack()
+    # The echo request is split across two reads
+    self.assertTrue(self.con.data_received(hello + echo[:5]))
+    self.assertTrue(self.con.data_received(echo[5:]))
+    return len(hello),len(echo)
+
+  def test_counts(self):
+    hello_len,echo_len = self._receive()
+    self.con.send(ofp_barrier_request())
+
+    for stats in (self.con.io_stats, of_01.ioStats):
+      self.assertEqual(dict(stats.msgs_in),
+                       {OFPT_HELLO:1, OFPT_ECHO_REQUEST:1})
+      self.assertEqual(dict(stats.bytes_in),
+                       {OFPT_HELLO:hello_len, OFPT_ECHO_REQUEST:echo_len})
+      self.assertEqual((stats.reads, stats.read_bytes, stats.read_msgs_max),
+                       (2, hello_len + echo_len, 1))
+      # The features and desc requests go out in a single send()
+      self.assertEqual(dict(stats.msgs_out),
+                       {OFPT_HELLO:1, OFPT_FEATURES_REQUEST:1,
+                        OFPT_STATS_REQUEST:1, OFPT_ECHO_REPLY:1,
+                        OFPT_BARRIER_REQUEST:1})
+      self.assertEqual(dict(stats.bytes_out),
+                       {OFPT_HELLO:8, OFPT_FEATURES_REQUEST:self.fr_len,
+                        OFPT_STATS_REQUEST:self.ss_len,
+                        OFPT_ECHO_REPLY:echo_len, OFPT_BARRIER_REQUEST:8})
+      self.assertEqual(sorted(stats.handler_time),
+                       [OFPT_HELLO, OFPT_ECHO_REQUEST])
+
+  def test_as_dict(self):
+    hello_len,echo_len = self._receive()
+    d = self.con.io_stats.as_dict()
+    self.assertEqual(d['msgs_in'], {'OFPT_HELLO':1, 'OFPT_ECHO_REQUEST':1})
+    self.assertEqual(d['bytes_out']['OFPT_ECHO_REPLY'], echo_len)
+    self.assertEqual(d['read_bytes_avg'], (hello_len + echo_len) / 2.0)
+    self.assertEqual(d['deferred_bytes'], 0)
+    # Only the global one has the I/O loop's counters
+    self.assertFalse('loop_iterations' in d)
+    of_01.ioStats._loop(0.5)
+    d = of_01.ioStats.as_dict()
+    self.assertEqual((d['loop_iterations'], d['loop_time_max']), (1, 0.5))
+
+  def test_webservice(self):
+    self._receive()
+    old_core = webservice.core
+    webservice.core = MockCore(self.con)
+    try:
+      get_io_stats = webservice.OFRequestHandler._exec_get_io_stats.im_func
+      r = get_io_stats(None, "00-00-00-00-00-01")['result']
+      self.assertEqual(r['msgs_in'], {'OFPT_HELLO':1, 'OFPT_ECHO_REQUEST':1})
+      r = get_io_stats(None)['result']
+      self.assertEqual(r['msgs_out']['OFPT_ECHO_REPLY'], 1)
+      self.assertEqual(r['switches']['00-00-00-00-00-01']['reads'], 2)
+      self.assertTrue('error' in get_io_stats(None, "00-00-00-00-00-02"))
+    finally:
+      webservice.core = old_core
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import sys
+import os.path
+
+sys.path.append(os.path.dirname(__file__) + "/../../..")
+from pox.openflow.discovery import Link, LinkState, LinkEvent
+import pox.openflow.spanning_tree as spanning_tree
+
+class MockDiscovery(object):
+  send_cycle_time = 5
+  def __init__(self):
+    self.adjacency = LinkState()
+
+class MockOpenFlow(object):
+  connections = []
+  def getConnection(self, dpid):
+    return None
+
+class MockCore(object):
+  def __init__(self):
+    self.openflow_discovery = MockDiscovery()
+    self.openflow = MockOpenFlow()
+    self.later = []
+  def callLater(self, f, *args, **kw):
+    self.later.append((f, args, kw))
+  def run_later(self):
+    later, self.later = self.later, []
+    for f,args,kw in later:
+      f(*args, **kw)
+
+class SpanningTreeTest(unittest.TestCase):
+  def setUp(self):
+    self.core = MockCore()
+    self.old_core = spanning_tree.core
+    spanning_tree.core = self.core
+    spanning_tree._tree.clear()
+    spanning_tree._changed_pairs.clear()
+    spanning_tree._dirty_ports.clear()
+    spanning_tree._tree_generation = None
+    spanning_tree._listening = False
+
+  def tearDown(self):
+    spanning_tree.core = self.old_core
+    spanning_tree._listening = False
+
+  def add_link(self, dpid1, port1, dpid2, port2):
+    """ adds a link in both directions, raising LinkEvents if listening """
+    for link in (Link(dpid1,port1, dpid2,port2), Link(dpid2,port2, dpid1,port1)):
+      self.core.openflow_discovery.adjacency[link] = 0
+      if spanning_tree._listening:
+        spanning_tree._handle_LinkEvent(LinkEvent(True, link))
+
+  def remove_link(self, dpid1, port1, dpid2, port2):
+    """ removes a link the way discovery does: events first """
+    links = [Link(dpid1,port1, dpid2,port2), Link(dpid2,port2, dpid1,port1)]
+    if spanning_tree._listening:
+      for link in links:
+        spanning_tree._handle_LinkEvent(LinkEvent(False, link))
+    for link in links:
+      self.core.openflow_discovery.adjacency.pop(link)
+    self.core.run_later()
+
+  def edges(self, tree):
+    return sorted((s1,s2) for s1,ports in tree.items() for s2,p in ports
+                  if s1 < s2)
+
+  def check_spanning(self, tree, switches):
+    """ checks that tree is a tree over exactly the given switches """
+    seen = set([min(switches)])
+    frontier = [min(switches)]
+    while frontier:
+      for s2,p in tree.get(frontier.pop(), ()):
+        if s2 not in seen:
+          seen.add(s2)
+          frontier.append(s2)
+    self.assertEqual(seen, set(switches))
+    self.assertEqual(len(self.edges(tree)), len(switches) - 1)
+
+  def make_ring(self):
+    # 1 - 2 - 3 - 4 - 1, using port n on switch n's side toward n+1
+    for a,b in ((1,2),(2,3),(3,4),(4,1)):
+      self.add_link(a, 10+b, b, 20+a)
+
+  def test_add_without_listener(self):
+    """ _calc_spanning_tree() works on its own (e.g., for l2_flowvisor) """
+    self.add_link(1, 2, 2, 1)
+    tree = spanning_tree._calc_spanning_tree()
+    self.assertEqual(dict(tree), {1:set([(2,2)]), 2:set([(1,1)])})
+    self.add_link(2, 3, 3, 2)
+    tree = spanning_tree._calc_spanning_tree()
+    self.assertEqual(self.edges(tree), [(1,2), (2,3)])
+    self.assertEqual(tree[3], set([(2,2)]))
+
+  def test_remove_without_listener(self):
+    self.add_link(1, 2, 2, 1)
+    self.add_link(2, 3, 3, 2)
+    spanning_tree._calc_spanning_tree()
+    self.remove_link(2, 3, 3, 2)
+    tree = spanning_tree._calc_spanning_tree()
+    self.assertEqual(self.edges(tree), [(1,2)])
+
+  def test_add_with_listener(self):
+    spanning_tree._listening = True
+    self.make_ring()
+    tree = spanning_tree._calc_spanning_tree()
+    self.check_spanning(tree, [1,2,3,4])
+    # A new link between switches already on the tree doesn't change it
+    before = self.edges(tree)
+    self.add_link(1, 13, 3, 21)
+    self.assertEqual(self.edges(spanning_tree._calc_spanning_tree()), before)
+
+  def test_repair_after_cut(self):
+    spanning_tree._listening = True
+    self.make_ring()
+    tree = spanning_tree._calc_spanning_tree()
+    self.check_spanning(tree, [1,2,3,4])
+    kept = self.edges(tree)
+
+    # Cut a tree edge; the ring's spare link should take over
+    s1,s2 = kept[0]
+    p1 = dict(tree[s1])[s2]
+    p2 = dict(tree[s2])[s1]
+    self.remove_link(s1, p1, s2, p2)
+    tree = spanning_tree._calc_spanning_tree()
+    self.check_spanning(tree, [1,2,3,4])
+    self.assertFalse((s1,s2) in self.edges(tree))
+    # The rest of the tree was left alone
+    for e in kept[1:]:
+      self.assertTrue(e in self.edges(tree))
+
+    # Now there are no spare links, so another cut splits the tree
+    s1,s2 = self.edges(tree)[0]
+    self.remove_link(s1, dict(tree[s1])[s2], s2, dict(tree[s2])[s1])
+    tree = spanning_tree._calc_spanning_tree()
+    self.assertEqual(len(self.edges(tree)), 2)
+
+  def test_stale_generation_rebuilds(self):
+    """ changes we weren't told about still show up """
+    spanning_tree._listening = True
+    self.make_ring()
+    spanning_tree._calc_spanning_tree()
+    # Removed behind our back (no LinkEvents)
+    for link in list(self.core.openflow_discovery.adjacency):
+      if 4 in (link.dpid1, link.dpid2):
+        self.core.openflow_discovery.adjacency.pop(link)
+    tree = spanning_tree._calc_spanning_tree()
+    self.check_spanning(tree, [1,2,3])
+    self.assertFalse(4 in tree)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -31,7 +31,7 @@ from pox.openflow import *
 from pox.openflow.topology import *
 
 class MockSwitch(EventMixin):
-  _eventMixin_events = [FlowRemoved, BarrierIn, SwitchConnectionUp, SwitchConnectionDown ]
+  _eventMixin_events = [FlowRemoved, BarrierIn, SwitchConnectionUp, SwitchConnectionDown, FlowStatsReceived ]
   def __init__(self):
     EventMixin.__init__(self)
     self.connected = True
@@ -128,6 +128,111 @@ class OFSyncFlowTableTest(unittest.TestCase):
     self.assertEqual(len(seen_ft_events), 2)
     self.assertTrue(isinstance(seen_ft_events[-1], FlowTableModification) and seen_ft_events[-1].removed == [entry])
 
+  def _entry(self, n, port):
+    return TableEntry(priority=5, cookie=n, match=ofp_match(dl_src=EthAddr("00:00:00:00:00:0%d" % n)), actions=[ofp_action_output(port=port)])
+
+  def _barrier_in(self):
+    for m in self.s.sent:
+      if isinstance(m, ofp_barrier_request):
+        self.s.raiseEvent(BarrierIn(self.conn, ofp_barrier_reply(xid=m.xid)))
+
+  def test_reconcile(self):
+    t = self.t
+    s = self.s
+
+    self.assertEqual(t.reconcile([self._entry(1, 5), self._entry(2, 6)]), 2)
+    self.assertEqual(len(s.sent), 3)
+    # pending entries count as there already
+    self.assertEqual(t.reconcile([self._entry(1, 5), self._entry(2, 6)]), 0)
+    self._barrier_in()
+    self.assertEqual(len(t), 2)
+    self.assertEqual(t.num_pending, 0)
+
+    # an equal set of entries doesn't send anything
+    s.sent = []
+    self.assertEqual(t.reconcile([self._entry(2, 6), self._entry(1, 5)]), 0)
+    self.assertEqual(s.sent, [])
+
+    # changed actions get re-added, and unwanted entries removed
+    self.assertEqual(t.reconcile([self._entry(1, 7), self._entry(3, 8)]), 3)
+    commands = sorted((m.command, m.match.dl_src) for m in s.sent if isinstance(m, ofp_flow_mod))
+    self.assertEqual(commands, [(OFPFC_ADD, EthAddr("00:00:00:00:00:01")),
+                                (OFPFC_ADD, EthAddr("00:00:00:00:00:03")),
+                                (OFPFC_DELETE_STRICT, EthAddr("00:00:00:00:00:02"))])
+    self._barrier_in()
+    self.assertEqual(sorted((e.cookie, e.actions[0].port) for e in t.entries), [(1, 7), (3, 8)])
+
+  def test_reconcile_batches(self):
+    t = self.t
+    s = self.s
+    old_size = OFSyncFlowTable.BATCH_SIZE
+    OFSyncFlowTable.BATCH_SIZE = 2
+    try:
+      t.reconcile([self._entry(n, n) for n in range(1, 6)])
+    finally:
+      OFSyncFlowTable.BATCH_SIZE = old_size
+    self.assertEqual([type(m) for m in s.sent],
+                     [ofp_flow_mod, ofp_flow_mod, ofp_barrier_request] * 2 +
+                     [ofp_flow_mod, ofp_barrier_request])
+
+  def _stats_reply(self, xid, stats):
+    """ the stats as they'd come from a switch, with wire wildcards """
+    for flow in stats:
+      match = ofp_match()
+      match.unpack(flow.match.pack(flow_mod=True))
+      flow.match = match
+    reply = ofp_stats_reply()
+    reply.unpack(ofp_stats_reply(xid=xid, type=OFPST_FLOW, body=stats).pack())
+    return reply
+
+  def _verify(self, stats, **kw):
+    t = self.t
+    s = self.s
+    t.reconcile([self._entry(1, 5), self._entry(2, 6)])
+    self._barrier_in()
+
+    verified = []
+    t.addListener(FlowTableVerified, lambda(event): verified.append(event))
+    s.sent = []
+    t.verify(**kw)
+    request = s.last
+    self.assertTrue(isinstance(request, ofp_stats_request))
+
+    reply = self._stats_reply(request.xid, stats)
+    s.raiseEvent(FlowStatsReceived(self.conn, [reply], reply.body))
+    self.assertEqual(len(verified), 1)
+    return verified[0]
+
+  def test_verify(self):
+    # the switch lost flow 2 and has a flow we don't know about
+    stats = [ ofp_flow_stats(priority=5, match=self._entry(1, 5).match, actions=[ofp_action_output(port=5)]),
+              ofp_flow_stats(priority=5, match=self._entry(4, 5).match, actions=[]) ]
+    verified = self._verify(stats)
+    self.assertEqual([e.cookie for e in verified.missing], [2])
+    self.assertEqual([f.match.dl_src for f in verified.extra], [EthAddr("00:00:00:00:00:04")])
+    # unknown flows are only reported
+    commands = sorted((m.command, m.match.dl_src) for m in self.s.sent if isinstance(m, ofp_flow_mod))
+    self.assertEqual(commands, [(OFPFC_ADD, EthAddr("00:00:00:00:00:02"))])
+
+  def test_verify_in_sync(self):
+    stats = [ ofp_flow_stats(priority=5, match=self._entry(1, 5).match, actions=[ofp_action_output(port=5)]),
+              ofp_flow_stats(priority=5, match=self._entry(2, 6).match, actions=[ofp_action_output(port=6)]) ]
+    # the flows come back with wire wildcards, but are still ours
+    self.assertNotEqual(self._stats_reply(1, stats).body[0].match.wildcards,
+                        self._entry(1, 5).match.wildcards)
+    verified = self._verify(stats)
+    self.assertTrue(verified.ok)
+    self.assertFalse([m for m in self.s.sent if isinstance(m, ofp_flow_mod)])
+
+  def test_verify_remove_unknown(self):
+    stats = [ ofp_flow_stats(priority=5, match=self._entry(1, 5).match, actions=[ofp_action_output(port=5)]),
+              ofp_flow_stats(priority=5, match=self._entry(2, 6).match, actions=[ofp_action_output(port=6)]),
+              ofp_flow_stats(priority=5, match=self._entry(4, 5).match, actions=[]) ]
+    verified = self._verify(stats, remove_unknown=True)
+    self.assertEqual(verified.missing, [])
+    commands = sorted((m.command, m.match.dl_src) for m in self.s.sent if isinstance(m, ofp_flow_mod))
+    self.assertEqual(commands, [(OFPFC_DELETE_STRICT, EthAddr("00:00:00:00:00:04"))])
+
   def test_handle_FlowRemoved(self):
     """ test that simple removal of a flow works"""
     t = self.t